@@ -1,6 +1,9 @@
 # app.py
 import json
 import logging
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -8,26 +11,36 @@ from fastapi.templating import Jinja2Templates
 
 from config.models import list_model_ids
 from prompt.get_system_prompt import PROMPT_FILES
-from prompt.get_system_prompt import get_system_prompt
-from utils.persona_loader import list_personas, get_default_personas
+from prompt.get_system_prompt import get_system_prompt, preload_prompts
+from utils.lifecycle import lifecycle, RETRY_AFTER_SECONDS
+from utils.log_config import setup_logging
+from utils.persona_loader import list_personas, get_default_personas, load_personas
 from utils.stream_chat_app import execute_model_for_app, chat_history
 
 # -----------------------------
 # 日志配置
 # -----------------------------
+setup_logging()  # JSON 日志经队列在后台线程输出，见 utils/log_config.py
 logger = logging.getLogger("chat_app")
-logger.setLevel(logging.INFO)
-if not logger.handlers:
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(
-        "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-    ))
-    logger.addHandler(handler)
 
 # -----------------------------
 # FastAPI 初始化
 # -----------------------------
-app = FastAPI(title="Stream Chat API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # SIGTERM 时先排空进行中的生成，再交给 uvicorn 停机
+    lifecycle.install_signal_handler()
+    # 预读提示词与人物，完成后 /readyz 才就绪
+    prompts = preload_prompts()
+    load_personas()
+    lifecycle.mark_warm({"prompts": "ok" if all(prompts.values()) else f"missing: {[n for n, ok in prompts.items() if not ok]}",
+                         "personas": "ok"})
+    yield
+    await lifecycle.shutdown()
+    chat_history.save_history()
+
+
+app = FastAPI(title="Stream Chat API", lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
@@ -61,6 +74,13 @@ async def chat(
 ):
     logger.info(f"[chat] 接收到表单参数: model={model}, system_rule={system_rule}, nsfw={nsfw}")
 
+    if lifecycle.draining:
+        return JSONResponse(
+            {"error": "服务正在重启，请稍后重试"},
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+
     if model not in list_model_ids():
         raise HTTPException(status_code=400, detail=f"模型 '{model}' 不存在")
 
@@ -74,17 +94,18 @@ async def chat(
 
     try:
         async def event_stream():
-            async for chunk in execute_model_for_app(
-                model_name=model,
-                user_input=prompt,
-                system_instructions=system_prompt,
-                personas=current_personas,
-                web_input=web_input,
-                nsfw=nsfw_enabled,
-                stream=stream_enabled
-            ):
-                # 转成 JSON 行（NDJSON）
-                yield json.dumps(chunk, ensure_ascii=False) + "\n"
+            async with lifecycle.track():
+                async for chunk in execute_model_for_app(
+                    model_name=model,
+                    user_input=prompt,
+                    system_instructions=system_prompt,
+                    personas=current_personas,
+                    web_input=web_input,
+                    nsfw=nsfw_enabled,
+                    stream=stream_enabled
+                ):
+                    # 转成 JSON 行（NDJSON）
+                    yield json.dumps(chunk, ensure_ascii=False) + "\n"
 
         # 修改 media_type，前端方便解析
         return StreamingResponse(event_stream(), media_type="application/json")
@@ -176,6 +197,22 @@ async def remove_last_entry():
         logger.error(f"[remove_last_entry] 删除最后一条记录失败: {e}", exc_info=True)
         return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
+# -----------------------------
+# 就绪检查
+# -----------------------------
+@app.get("/readyz")
+async def readyz():
+    """预热完成前、排空开始后返回 503，负载均衡据此摘除实例"""
+    ready, report = lifecycle.readiness()
+    return JSONResponse(report, status_code=200 if ready else 503)
+
+# -----------------------------
+# 存活检查
+# -----------------------------
+@app.get("/healthz")
+async def healthz():
+    return JSONResponse({"status": "ok"})
+
 # -----------------------------
 # 启动服务
 # -----------------------------
@@ -186,6 +223,7 @@ if __name__ == "__main__":
         "app:app",
         host="0.0.0.0",
         port=8080,
-        reload=True,
+        # 开发时设置 UVICORN_RELOAD=true 开启自动重载；模型 / client 配置改动无需重启，见 config/registry.py
+        reload=os.getenv("UVICORN_RELOAD", "false").lower() == "true",
         log_level="info"
     )
@@ -0,0 +1,78 @@
+# benchmark/conditional_get.py
+"""
+对比前端加载时常用 GET 接口的完整响应（200）与条件请求（If-None-Match -> 304）的开销
+
+用法：
+    python benchmark/conditional_get.py                  # 每个接口各请求 500 次
+    python benchmark/conditional_get.py --requests 2000 --json bench_output.txt
+
+使用进程内 TestClient，不经过网络，数值反映的是服务端处理开销。
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+ENDPOINTS = ["/personas", "/system_rules", "/system_model", "/get_chat_history"]
+
+
+def measure(client, path: str, n: int, headers: dict | None = None) -> dict:
+    """连续请求 n 次，返回平均耗时（微秒）、状态码与响应体大小"""
+    status = size = 0
+    start = time.perf_counter()
+    for _ in range(n):
+        response = client.get(path, headers=headers)
+        status = response.status_code
+        size = len(response.content)
+    elapsed = time.perf_counter() - start
+    return {"status": status, "bytes": size, "avg_us": round(elapsed / n * 1e6, 1)}
+
+
+def run(n: int) -> list:
+    from fastapi.testclient import TestClient
+    import main
+
+    results = []
+    with TestClient(main.app) as client:
+        for path in ENDPOINTS:
+            first = client.get(path)
+            etag = first.headers.get("etag")
+            full = measure(client, path, n)
+            conditional = measure(client, path, n, {"If-None-Match": etag} if etag else None)
+            results.append({
+                "path": path,
+                "etag": etag,
+                "full": full,
+                "conditional": conditional,
+                "saved_pct": round((1 - conditional["avg_us"] / full["avg_us"]) * 100, 1) if full["avg_us"] else 0,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="条件 GET（ETag/304）开销对比")
+    parser.add_argument("--requests", type=int, default=500, help="每个接口的请求次数")
+    parser.add_argument("--json", dest="json_path", help="把结果写入该 JSON 文件")
+    args = parser.parse_args()
+
+    results = run(args.requests)
+    print(f"{'接口':<20}{'200 耗时(us)':>14}{'200 字节':>10}{'304 耗时(us)':>14}{'304 字节':>10}{'节省':>8}")
+    for item in results:
+        full, cond = item["full"], item["conditional"]
+        print(f"{item['path']:<20}{full['avg_us']:>14}{full['bytes']:>10}"
+              f"{cond['avg_us']:>14}{cond['bytes']:>10}{item['saved_pct']:>7}%")
+        if cond["status"] != 304:
+            print(f"  警告：{item['path']} 条件请求返回 {cond['status']}，未命中 304")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
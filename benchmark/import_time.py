@@ -0,0 +1,85 @@
+# benchmark/import_time.py
+"""
+统计服务冷启动的导入耗时（基于 python -X importtime）
+
+用法：
+    python benchmark/import_time.py                 # 默认统计 import main
+    python benchmark/import_time.py --module app --top 30
+    python benchmark/import_time.py --json bench_output.txt
+
+输出总耗时与累计耗时最高的模块，--json 时写出完整报告，便于在 CI 中追踪趋势。
+子进程的聊天历史目录（CHAT_HISTORY_DIR）指向临时目录：导入时创建的数据库不会写入工作区，
+也不会读取 / 迁移已有的历史，每次测量的都是空目录下的冷启动。
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+LINE_PATTERN = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(module: str, runs: int = 1) -> dict:
+    """
+    在独立子进程中导入 module，解析 -X importtime 报告
+
+    Returns:
+        dict: {"module", "total_us", "modules": [{"name", "self_us", "cumulative_us", "depth"}]}
+    """
+    best = None
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory(prefix="import_time_") as history_dir:
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=PROJECT_ROOT,
+                env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1", "CHAT_HISTORY_DIR": history_dir},
+                capture_output=True,
+                text=True,
+            )
+        if proc.returncode != 0:
+            raise RuntimeError(f"导入 {module} 失败:\n{proc.stderr[-2000:]}")
+
+        modules = []
+        for line in proc.stderr.splitlines():
+            m = LINE_PATTERN.match(line)
+            if not m:
+                continue
+            modules.append({
+                "name": m.group(4),
+                "self_us": int(m.group(1)),
+                "cumulative_us": int(m.group(2)),
+                "depth": (len(m.group(3)) - 1) // 2,
+            })
+        total = sum(item["cumulative_us"] for item in modules if item["depth"] == 0)
+        if best is None or total < best["total_us"]:
+            best = {"module": module, "total_us": total, "modules": modules}
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统计导入耗时（python -X importtime）")
+    parser.add_argument("--module", default="main", help="要导入的模块，默认 main")
+    parser.add_argument("--top", type=int, default=20, help="输出累计耗时最高的前 N 个模块")
+    parser.add_argument("--runs", type=int, default=3, help="重复次数，取最快一次")
+    parser.add_argument("--json", dest="json_path", help="将完整报告写入该文件")
+    args = parser.parse_args()
+
+    report = measure(args.module, args.runs)
+    print(f"import {report['module']} 总耗时: {report['total_us'] / 1000:.1f} ms")
+    print(f"{'cumulative(ms)':>15} {'self(ms)':>10}  module")
+    for item in sorted(report["modules"], key=lambda x: x["cumulative_us"], reverse=True)[:args.top]:
+        print(f"{item['cumulative_us'] / 1000:>15.1f} {item['self_us'] / 1000:>10.1f}  {item['name']}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
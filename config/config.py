@@ -1,33 +1,81 @@
 # prompt.py
+import os
+from collections.abc import Mapping
+
 from config.decrypt_message import decrypt_message
 
-CLIENT_CONFIGS = {
+# 延迟模式：api_key 在首次使用对应 client 时才解密（LAZY_CONFIG=false 时导入即全部解密）
+LAZY_CONFIG = os.getenv("LAZY_CONFIG", "true").lower() != "false"
+
+# api_key_encrypted 为 Fernet 密文，由 SECRET_KEY 解密
+ENCRYPTED_CLIENT_CONFIGS = {
     # deepseek
     "deepseek": {
         "base_url": "https://api.deepseek.com/chat/completions",
-        "api_key": decrypt_message("gAAAAABoySFC3kuOW6knCccmuo4tEfridSxwGubYuzaqgYiPJ3Il1c4HH26N1GZT2CjbZR0F3weJjztTSW0lz8azQ4ioSaTRvnIqdMx_TYJTuPBZAV4iNL0ixY2nT1cE7Lfrbz-U45-0")
+        "api_key_encrypted": "gAAAAABoySFC3kuOW6knCccmuo4tEfridSxwGubYuzaqgYiPJ3Il1c4HH26N1GZT2CjbZR0F3weJjztTSW0lz8azQ4ioSaTRvnIqdMx_TYJTuPBZAV4iNL0ixY2nT1cE7Lfrbz-U45-0"
     },
     # 单独购买 claude_api
     "claude_api": {
         "base_url": "https://chat.cloudapi.vip/v1/chat/completions",
-        "api_key": decrypt_message("gAAAAABow8ZKhmf8JW3S29GXjaJMqtnaHQglS8u7T8AMefKK4JoqfhV9y5J6vJIRBtRlmxf9Upb_XgUkRqqJLFgU_Inwrg2pGCktnUz5weLhB3RYjFif5lvtIAoCtMvit5rs2O_909i_ZwPkMKYEGRWOuhuKrwOgiA==")
+        "api_key_encrypted": "gAAAAABow8ZKhmf8JW3S29GXjaJMqtnaHQglS8u7T8AMefKK4JoqfhV9y5J6vJIRBtRlmxf9Upb_XgUkRqqJLFgU_Inwrg2pGCktnUz5weLhB3RYjFif5lvtIAoCtMvit5rs2O_909i_ZwPkMKYEGRWOuhuKrwOgiA=="
     },
     # api_key：chat_runrp
     "link_api": {
         "base_url": "https://api.linkapi.org/v1/chat/completions",
-        "api_key": decrypt_message(
-            "gAAAAABpS4zxZ2eSYYKKWQg3utIPeohS4XCL2LsNeJTCeHfOmxySJsaPt3KDYGvFZEIktgHo2qMKz2ALp48_YrPq6a4NoEvD2LYyop6zv-c3ZdXcuwYhqN7TztuteiyX4DvutiJrcHuyA3FCt8cXXzZ_IQ04QO07ig==")
+        "api_key_encrypted":
+            "gAAAAABpS4zxZ2eSYYKKWQg3utIPeohS4XCL2LsNeJTCeHfOmxySJsaPt3KDYGvFZEIktgHo2qMKz2ALp48_YrPq6a4NoEvD2LYyop6zv-c3ZdXcuwYhqN7TztuteiyX4DvutiJrcHuyA3FCt8cXXzZ_IQ04QO07ig=="
     },
     # api_key: chat_runrp_gemini
     "runrp_gemini": {
         "base_url": "https://api.linkapi.org/v1beta/models/gemini-2.5-pro:generateContent",
-        "api_key": decrypt_message(
-            "gAAAAABo50kq7Giw4Gr4cbcDJHRoaNZ5OealtpGHcrepgmbRkcsVjB1aPMhIToLXooMIVeBadYV8A33dspd2xDIUqcAOeEmQ7AXPyvKg_GJ1MvnPJo8rcvUWBVVxdQzCU56HeQfd6kyFIbI5bp1B01s4i9J9ddJTzw==")
+        "api_key_encrypted":
+            "gAAAAABo50kq7Giw4Gr4cbcDJHRoaNZ5OealtpGHcrepgmbRkcsVjB1aPMhIToLXooMIVeBadYV8A33dspd2xDIUqcAOeEmQ7AXPyvKg_GJ1MvnPJo8rcvUWBVVxdQzCU56HeQfd6kyFIbI5bp1B01s4i9J9ddJTzw=="
     },
     # google_key：google_api_changxr
     "google_changxr_key": {
         "base_url": "https://generativelanguage.googleapis.com/v1beta/openai/",
-        "api_key": decrypt_message(
-            "gAAAAABpO3MNDKf1O-dsNMBzvy7KUIxpV0FxC3iTzlD59FrS3inaLDL3JovrAN2F4JYLVUkHpT-qdMfUzD0Lv0YhvA_G8Srcwj1bBT7uxS8bcvFqPbR2srtuApsJzRk3f7H3RnaArKfu")
+        "api_key_encrypted":
+            "gAAAAABpO3MNDKf1O-dsNMBzvy7KUIxpV0FxC3iTzlD59FrS3inaLDL3JovrAN2F4JYLVUkHpT-qdMfUzD0Lv0YhvA_G8Srcwj1bBT7uxS8bcvFqPbR2srtuApsJzRk3f7H3RnaArKfu"
     },
 }
+
+
+class LazyClientConfigs(Mapping):
+    """
+    只读的 client 配置表：按 client 名首次访问时解密 api_key 并缓存
+    用法与普通 dict 相同：CLIENT_CONFIGS[name]["api_key"]
+    """
+
+    def __init__(self, raw_configs: dict, resolved: dict | None = None):
+        self._raw = raw_configs
+        self._resolved: dict = dict(resolved or {})
+
+    def __getitem__(self, name: str) -> dict:
+        config = self._resolved.get(name)
+        if config is None:
+            raw = self._raw[name]
+            config = {k: v for k, v in raw.items() if k != "api_key_encrypted"}
+            if "api_key_encrypted" in raw:
+                config["api_key"] = decrypt_message(raw["api_key_encrypted"])
+            self._resolved[name] = config
+        return config
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self) -> int:
+        return len(self._raw)
+
+    def resolved(self, name: str) -> dict | None:
+        """返回已解密的配置，未解密时返回 None（不触发解密）"""
+        return self._resolved.get(name)
+
+    def resolve_all(self) -> None:
+        """立即解密全部 client（预热 / 非延迟模式）"""
+        for name in self._raw:
+            self[name]
+
+
+CLIENT_CONFIGS = LazyClientConfigs(ENCRYPTED_CLIENT_CONFIGS)
+if not LAZY_CONFIG:
+    CLIENT_CONFIGS.resolve_all()
@@ -1,6 +1,5 @@
 import os
-
-from cryptography.fernet import Fernet
+from functools import lru_cache
 
 
 # 读取密钥
@@ -10,17 +9,21 @@ def load_key():
         raise ValueError("未设置环境变量 SECRET_KEY")
     return key.encode()  # Fernet 期待字节类型的密钥
 
+# 全进程共用一个 Fernet 实例（首次使用时创建，cryptography 也延迟导入）
+@lru_cache(maxsize=1)
+def get_fernet():
+    from cryptography.fernet import Fernet
+    return Fernet(load_key())
+
 # 加密信息
 def encrypt_message(message):
-    key = load_key()
-    f = Fernet(key)
+    f = get_fernet()
     encrypted_message = f.encrypt(message.encode())
     return encrypted_message.decode()
 
 # 解密信息
 def decrypt_message(encrypted_message):
-    key = load_key()
-    f = Fernet(key)
+    f = get_fernet()
     try:
         decrypted_message = f.decrypt(encrypted_message.encode())
         return decrypted_message.decode()
@@ -1,9 +1,14 @@
 # models.py
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
 # 预置模型
+# pricing（可选，美元）：per_1k_tokens 按总 token 计费；input_per_1k / output_per_1k 按输入 / 输出分别计费；
+# per_request 按次计费。未配置的模型费用记为未知
+# prompt_cache（可选）："cache_control" 表示需要在 messages 中显式标注缓存断点（Anthropic 系模型，仅 PROMPT_LAYOUT=cache 与批量生成时生效）；
+# DeepSeek / OpenAI / Gemini 按前缀自动缓存，无需配置
 DEFAULT_MODELS = {
     # deepseek-reasoner
     "deepseek-reasoner": {
@@ -21,29 +26,33 @@ DEFAULT_MODELS = {
     },
     # link_api for gemini
     "gemini-3-flash-preview": {
-        "label": "gemini-3-flash-preview",  # $0.0005/K tokens（default）
+        "label": "gemini-3-flash-preview",  # （default 分组）
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_1k_tokens": 0.0005},
     },
     "gemini-3-flash-preview-thinking": {
-        "label": "gemini-3-flash-preview-thinking-*",  # $0.002/K tokens（default）
+        "label": "gemini-3-flash-preview-thinking-*",  # （default 分组）
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_1k_tokens": 0.002},
     },
     "gemini-3-pro-preview-thinking": {
-        "label": "gemini-3-pro-preview-thinking-*",  # $0.002/K tokens（default）
+        "label": "gemini-3-pro-preview-thinking-*",  # （default 分组）
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_1k_tokens": 0.002},
     },
     # link_api for grok
     "grok-4.1": {
-        "label": "grok-4.1",       # $0.02/次（default）
+        "label": "grok-4.1",       # （default 分组）
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_request": 0.02},
     },
     # link_api for chatgpt gpt-4o-mini
     "gpt-5-chat": {
@@ -51,24 +60,28 @@ DEFAULT_MODELS = {
         # "label": "gpt-5.2-2025-12-11",    # $0.00175/K（vip）
         # "label": "gpt-5.2-chat-latest",    # $0.007/K（vip）
         # "label": "gpt-5.1-thinking",    # $0.001/K（vip）
-        "label": "gpt-5-chat",  # $0.00125/K
+        "label": "gpt-5-chat",
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_1k_tokens": 0.00125},
     },
     # link_api for chatgpt gpt-4o-mini
     "gpt-4o-mini": {
-        "label": "gpt-4o-mini",  # $0.01/次
+        "label": "gpt-4o-mini",
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_request": 0.01},
     },
     # link_api for claude
     "claude-sonnet-4-5": {
-        "label": "claude-opus-4-5-20251101-thinking",  # $0.0024/K tokens（cc）
+        "label": "claude-opus-4-5-20251101-thinking",  # （cc 分组）
         "supports_streaming": True,
         "default_temperature": 0.4,
         "client_name": "link_api",
+        "pricing": {"per_1k_tokens": 0.0024},
+        "prompt_cache": "cache_control",
     },
     # google_api
     "google_api": {
@@ -79,14 +92,45 @@ DEFAULT_MODELS = {
     },
 }
 
+# "auto" 伪模型：按实时 TTFT / 吞吐 / 错误率在候选模型中选择（见 utils/model_router.py）
+AUTO_MODEL = "auto"
+# 各 system_rule 的候选模型（按偏好排序，统计数据相近时靠前者优先）；未列出的规则使用 "*"
+AUTO_ROUTES = {
+    "*": ["gemini-3-flash-preview", "deepseek-chat", "gpt-5-chat", "grok-4.1"],
+    "Python": ["deepseek-chat", "gpt-5-chat", "claude-sonnet-4-5"],
+    "角色卡设定架构师": ["gemini-3-flash-preview", "gpt-5-chat", "deepseek-chat"],
+}
+# 快速草稿（/chat 表单 draft=true）：首字很慢的思考模型 -> 先行输出草稿的快速模型；未列出的模型忽略该参数
+DRAFT_MODELS = {
+    "claude-sonnet-4-5": "gemini-3-flash-preview",
+    "gemini-3-pro-preview-thinking": "gemini-3-flash-preview",
+}
+# 单次请求的预估费用上限（美元，0 表示不限）；设置后未配置 pricing 的模型不参与自动选择
+AUTO_MAX_COST_PER_REQUEST = float(os.getenv("AUTO_MAX_COST_PER_REQUEST", "0"))
+
 def model_registry(model_name: str = None):
+    # 读取当前注册表快照（支持热加载，见 config/registry.py）
+    from config.registry import current_registry
+    models = current_registry().models
     if model_name:
-        return DEFAULT_MODELS.get(model_name)
-    return DEFAULT_MODELS
+        return models.get(model_name)
+    return models
 
 def list_model_ids() -> list:
     """返回所有可用的模型ID列表"""
-    return list(DEFAULT_MODELS.keys())
+    from config.registry import current_registry
+    return current_registry().model_ids()
+
+def estimate_cost(model_details: dict, prompt_tokens: int = 0, completion_tokens: int = 0) -> float | None:
+    """按 pricing 估算一次调用的费用（美元），未配置价格时返回 None"""
+    pricing = (model_details or {}).get("pricing")
+    if not pricing:
+        return None
+    cost = pricing.get("per_request", 0.0)
+    cost += (prompt_tokens + completion_tokens) / 1000 * pricing.get("per_1k_tokens", 0.0)
+    cost += prompt_tokens / 1000 * pricing.get("input_per_1k", 0.0)
+    cost += completion_tokens / 1000 * pricing.get("output_per_1k", 0.0)
+    return cost
 
 if __name__ == "__main__":
     data = model_registry('google_api')
@@ -0,0 +1,213 @@
+# config/registry.py
+"""
+模型注册表 / client 配置的热加载
+
+- 默认值来自代码中的 DEFAULT_MODELS 与 ENCRYPTED_CLIENT_CONFIGS（version 0）
+- 若存在 config/registry.json（或环境变量 MODEL_REGISTRY_FILE 指定的文件），其内容按 key 覆盖默认值，
+  值为 null 表示删除该模型 / client
+- 重新加载时整体替换快照（单次赋值），正在进行的请求继续使用它拿到的旧快照
+
+文件格式：
+{
+  "version": 2,
+  "models": {"new-model": {"label": "...", "supports_streaming": true, "default_temperature": 0.4, "client_name": "link_api"}},
+  "clients": {"link_api": {"base_url": "...", "api_key_encrypted": "gAAAA..."}}
+}
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Optional
+
+from config.config import ENCRYPTED_CLIENT_CONFIGS, LazyClientConfigs
+from config.models import DEFAULT_MODELS
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_FILE = Path(os.getenv("MODEL_REGISTRY_FILE", Path(__file__).resolve().parent / "registry.json"))
+
+
+_generation = itertools.count()
+
+
+class RegistrySnapshot:
+    """某一版本的模型注册表与 client 配置（创建后不再修改）"""
+
+    def __init__(self, version: int, models: dict, raw_clients: dict, inherited: Optional[dict] = None):
+        self.version = version
+        self.generation = next(_generation)  # 进程内单调递增，每次切换快照都会变化（用于 ETag）
+        self.models = models
+        self.raw_clients = raw_clients
+        self.clients = LazyClientConfigs(raw_clients, resolved=inherited)
+
+    def model(self, model_name: str) -> Optional[dict]:
+        return self.models.get(model_name)
+
+    def model_ids(self) -> list:
+        return list(self.models.keys())
+
+
+def _merge(defaults: dict, overrides: dict) -> dict:
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _validate(models: dict, clients: dict, names) -> dict:
+    """
+    校验合并后的配置，返回可用的模型表
+
+    - 字段完整性只校验配置文件中新增 / 修改的模型（代码默认值保持原有行为）
+    - 每个模型引用的 client 都必须存在：配置文件中的模型，或配置文件删除了默认模型仍在使用的 client，均拒绝加载；
+      代码默认值中本就缺少 client 的模型（无法调用）记录警告并从快照中去掉，避免请求时 KeyError
+    """
+    for name in names:
+        details = models.get(name)
+        if details is None:
+            continue
+        if not isinstance(details, dict):
+            raise ValueError(f"模型 {name} 的配置必须是对象")
+        for field in ("label", "client_name"):
+            if field not in details:
+                raise ValueError(f"模型 {name} 缺少字段 {field}")
+    for name, settings in clients.items():
+        if not isinstance(settings, dict) or "base_url" not in settings:
+            raise ValueError(f"client {name} 缺少字段 base_url")
+    usable = {}
+    for name, details in models.items():
+        client_name = details.get("client_name")
+        if client_name in clients:
+            usable[name] = details
+        elif name in names or client_name in ENCRYPTED_CLIENT_CONFIGS:
+            raise ValueError(f"模型 {name} 引用了不存在的 client: {client_name}")
+        else:
+            logger.warning(f"[Registry] 默认模型 {name} 引用的 client {client_name} 未配置，已忽略")
+    return usable
+
+
+def load_snapshot(path: Path = REGISTRY_FILE, previous: Optional[RegistrySnapshot] = None) -> RegistrySnapshot:
+    """
+    读取配置文件生成新快照（文件不存在时返回代码默认值）
+    未变化的 client 复用上一快照中已解密的配置
+    """
+    version, model_overrides, client_overrides = 0, {}, {}
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        version = int(data.get("version", 0))
+        model_overrides = data.get("models") or {}
+        client_overrides = data.get("clients") or {}
+
+    models = _merge(DEFAULT_MODELS, model_overrides)
+    raw_clients = _merge(ENCRYPTED_CLIENT_CONFIGS, client_overrides)
+    models = _validate(models, raw_clients, model_overrides)
+
+    inherited = {}
+    if previous is not None:
+        for name in raw_clients:
+            if previous.raw_clients.get(name) == raw_clients[name]:
+                resolved = previous.clients.resolved(name)
+                if resolved is not None:
+                    inherited[name] = resolved
+    return RegistrySnapshot(version, models, raw_clients, inherited)
+
+
+def changed_clients(old: RegistrySnapshot, new: RegistrySnapshot) -> set:
+    """返回配置有变化（含新增 / 删除）的 client 名"""
+    names = set(old.raw_clients) | set(new.raw_clients)
+    return {n for n in names if old.raw_clients.get(n) != new.raw_clients.get(n)}
+
+
+# -----------------------------
+# 当前快照
+# -----------------------------
+_current: RegistrySnapshot = load_snapshot()
+_listeners: list = []
+
+
+def current_registry() -> RegistrySnapshot:
+    """获取当前快照；单个请求内应只取一次并一直使用它"""
+    return _current
+
+
+def on_registry_change(listener: Callable[[RegistrySnapshot, set], None]) -> None:
+    """注册变更回调：listener(新快照, 变化的 client 名集合)"""
+    _listeners.append(listener)
+
+
+def reload_registry(path: Path = REGISTRY_FILE) -> dict:
+    """
+    重新加载配置文件并原子替换当前快照
+
+    Returns:
+        dict: {"version", "changed": bool, "changed_clients": [...]}
+    Raises:
+        ValueError / json.JSONDecodeError: 配置文件无效（当前快照保持不变）
+    """
+    global _current
+    old = _current
+    new = load_snapshot(path, previous=old)
+    if new.models == old.models and new.raw_clients == old.raw_clients:
+        return {"version": old.version, "changed": False, "changed_clients": []}
+    if path.exists() and new.version <= old.version:
+        logger.warning(f"[Registry] 配置内容已变化但 version 未递增（{old.version} -> {new.version}）")
+
+    diff = changed_clients(old, new)
+    _current = new
+    logger.info(f"[Registry] 已切换到 version={new.version}，模型 {len(new.models)} 个，变化的 client: {sorted(diff)}")
+    for listener in _listeners:
+        try:
+            listener(new, diff)
+        except Exception:
+            logger.exception("[Registry] 变更回调执行失败")
+    return {"version": new.version, "changed": True, "changed_clients": sorted(diff)}
+
+
+class RegistryWatcher:
+    """轮询配置文件的修改时间，变化时自动 reload_registry"""
+
+    def __init__(self, path: Path = REGISTRY_FILE, interval: float = 5.0):
+        self.path = path
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._mtime = self._stat()
+
+    def _stat(self):
+        try:
+            st = self.path.stat()
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="registry-watcher")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self._stat()
+            if mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                reload_registry(self.path)
+            except Exception as e:
+                logger.error(f"[Registry] 配置文件无效，继续使用旧配置: {e}")
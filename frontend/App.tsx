@@ -138,14 +138,11 @@ function App() {
   // Initial Data Load
   useEffect(() => {
     const init = async () => {
-      const [m, r, p] = await Promise.all([
-        api.getModels(),
-        api.getRules(),
-        api.getPersonas(),
-      ]);
+      const data = await api.bootstrap();
+      const m = data.models.map((model) => model.id);
       setModels(m);
-      setRules(r);
-      setPersonas(p);
+      setRules(data.rules);
+      setPersonas(data.personas);
 
       // Set defaults if available
       if (m.length > 0) setConfig(c => ({ ...c, model: m[0] }));
@@ -1,5 +1,5 @@
 import {GoogleGenAI} from "@google/genai";
-import {Persona} from '../types.ts';
+import {BootstrapData, Persona} from '../types.ts';
 
 // Helper to handle form data creation
 const createFormData = (data: Record<string, string | boolean>) => {
@@ -11,6 +11,34 @@ const createFormData = (data: Record<string, string | boolean>) => {
 };
 
 export const api = {
+  // One request for everything the page needs on load; falls back to the individual endpoints
+  bootstrap: async (): Promise<BootstrapData> => {
+    try {
+      const res = await fetch('/bootstrap');
+      if (!res.ok) throw new Error(`HTTP ${res.status}`);
+      const data = await res.json();
+      return {
+        models: data.models || [],
+        rules: data.rules || [],
+        personas: data.personas || [],
+        history: data.history ?? null,
+      };
+    } catch (e) {
+      console.warn('Bootstrap endpoint unavailable, loading data separately', e);
+      const [models, rules, personas] = await Promise.all([
+        api.getModels(),
+        api.getRules(),
+        api.getPersonas(),
+      ]);
+      return {
+        models: models.map((id) => ({id, supports_streaming: true, default_temperature: null})),
+        rules,
+        personas,
+        history: null,
+      };
+    }
+  },
+
   getModels: async (): Promise<string[]> => {
     try {
       const res = await fetch('/system_model');
@@ -3,6 +3,19 @@ export interface Persona {
   selected: boolean;
 }
 
+export interface ModelInfo {
+  id: string;
+  supports_streaming: boolean;
+  default_temperature: number | null;
+}
+
+export interface BootstrapData {
+  models: ModelInfo[];
+  rules: string[];
+  personas: Persona[];
+  history: any;
+}
+
 export interface ChatConfig {
   model: string;
   systemRule: string;
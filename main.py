@@ -1,29 +1,47 @@
 # main.py
+import asyncio
+import hmac
 import json
 import logging
 import os
+import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Form, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
 
-from config.models import list_model_ids
+from config.models import AUTO_MODEL, DRAFT_MODELS, list_model_ids
+from config.registry import RegistryWatcher, current_registry, reload_registry
 from prompt.get_system_prompt import PROMPT_FILES, get_system_prompt
 from utils import read_chat_history
-from utils.new_stream_chat_app import execute_model_for_app, chat_history
-from utils.persona_loader import list_personas, get_default_personas
+from utils.new_stream_chat_app import (
+    commit_compare,
+    compare_models,
+    execute_model_for_app,
+    MAX_COMPARE_MODELS,
+    REASONING_MAX_CHARS,
+    chat_history,
+    client_pool,
+    history_compactor,
+    probe_providers,
+    wait_persisted,
+    warm_up,
+    READINESS_PROBE,
+    ENABLE_HISTORY_COMPACTION,
+)
+from utils.lifecycle import lifecycle, RETRY_AFTER_SECONDS
+from utils.log_config import setup_logging
+from utils.loop_watchdog import LOOP_WATCHDOG, RequestIdMiddleware, loop_watchdog
+from utils.model_router import model_router
+from utils.http_cache import json_with_etag, not_modified, version_etag
+from utils.persona_loader import list_personas, get_default_personas, persona_file_version
+from utils.static_assets import InMemoryPage, PrecompressedStaticFiles, load_all
 
 # -----------------------------
 # 日志配置
 # -----------------------------
+setup_logging()  # JSON 日志经队列在后台线程输出，见 utils/log_config.py
 logger = logging.getLogger("chat_app")
-logger.setLevel(logging.INFO)
-if not logger.handlers:
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(
-        "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-    ))
-    logger.addHandler(handler)
 
 # -----------------------------
 # FastAPI 初始化
@@ -32,35 +50,90 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FRONTEND_DIST = os.path.join(BASE_DIR, "frontend", "dist")
 ASSETS_DIR = os.path.join(FRONTEND_DIST, "assets")
 
-app = FastAPI(title="Nebula Chat API")
+# 管理 / 调试接口令牌；未设置时这些接口一律拒绝访问
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
-# 托管 Vite 构建后的静态资源
+
+def require_admin(x_admin_token: str = Header("")) -> None:
+    """管理 / 调试接口的公共校验：必须已配置 ADMIN_TOKEN 且请求头 X-Admin-Token 与之一致"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="未配置 ADMIN_TOKEN，管理接口已禁用")
+    if not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="无权限")
+
+# 是否自动监视 config/registry.json 的变化
+WATCH_REGISTRY = os.getenv("WATCH_REGISTRY", "true").lower() == "true"
+registry_watcher = RegistryWatcher()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 读取并预压缩前端静态资源（在线程中执行；导入 main 时不读文件）
+    await load_all(static_sites)
+    # 启动后台历史压缩任务（不在请求路径上）
+    if ENABLE_HISTORY_COMPACTION:
+        history_compactor.start()
+    # 后台预热提示词 / 人物 / 密钥 / tokenizer / 上游连接，完成后 /readyz 才就绪
+    warm_up_task = asyncio.create_task(warm_up())
+    # 模型注册表热加载
+    if WATCH_REGISTRY:
+        registry_watcher.start()
+    # SIGTERM 时先排空进行中的生成，再交给 uvicorn 停机
+    lifecycle.install_signal_handler()
+    # 事件循环阻塞监测
+    if LOOP_WATCHDOG:
+        loop_watchdog.start()
+    yield
+    await lifecycle.shutdown()
+    warm_up_task.cancel()
+    await registry_watcher.stop()
+    await loop_watchdog.stop()
+    await history_compactor.stop()
+    # 落盘历史并关闭连接
+    chat_history.save_history()
+    if hasattr(chat_history, "close"):
+        chat_history.close()
+    await client_pool.aclose()
+    logger.info("[停机] 历史已保存，连接池已关闭")
+
+
+app = FastAPI(title="Nebula Chat API", lifespan=lifespan)
+app.add_middleware(RequestIdMiddleware)
+
+# 托管 Vite 构建后的静态资源（启动时读入内存并预压缩，文件名带 hash，可永久缓存）
+static_sites: list = []  # lifespan 启动时统一加载
 if os.path.exists(ASSETS_DIR):
-    app.mount("/assets", StaticFiles(directory=ASSETS_DIR), name="assets")
+    static_sites.append(PrecompressedStaticFiles(ASSETS_DIR, immutable=True))
+    app.mount("/assets", static_sites[-1], name="assets")
 else:
     logger.warning(" 未检测到 frontend/dist/assets，请先执行：npm run build")
 
 # 托管 static 目录（如果还需要）
 if os.path.exists(os.path.join(BASE_DIR, "static")):
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+    static_sites.append(PrecompressedStaticFiles(os.path.join(BASE_DIR, "static")))
+    app.mount("/static", static_sites[-1], name="static")
+
+# index.html 常驻内存，每次导航不再访问文件系统
+index_page = InMemoryPage(os.path.join(FRONTEND_DIST, "index.html"))
+static_sites.append(index_page)
 
 # -----------------------------
 # 全局变量
 # -----------------------------
 current_personas = get_default_personas()
+personas_revision = 0  # 每次更新出场人物递增（用于 ETag）
 
 # -----------------------------
 # 前端入口（替代 Flask + templates）
 # -----------------------------
 @app.get("/", response_class=HTMLResponse)
-async def index():
-    index_file = os.path.join(FRONTEND_DIST, "index.html")
-    if not os.path.exists(index_file):
+async def index(request: Request):
+    response = await index_page.response(request.scope)
+    if response is None:
         return HTMLResponse(
             content="前端尚未构建，请先在 frontend 目录执行：npm run build",
             status_code=500
         )
-    return FileResponse(index_file)
+    return response
 
 # -----------------------------
 # 聊天接口
@@ -73,9 +146,18 @@ async def chat(
     web_input: str = Form(""),
     nsfw: str = Form("true"),
     stream: str = Form("true"),
+    reasoning: str = Form("false"),  # 为 true 时转发思考过程（reasoning 事件）
+    reasoning_max_chars: int = Form(REASONING_MAX_CHARS),
+    draft: str = Form("false"),  # 为 true 时先用快速模型输出草稿（仅流式，见 DRAFT_MODELS）
 ):
-    logger.info(f"[chat] 接收到表单参数: model={model}, system_rule={system_rule}, stream={stream}, nsfw={nsfw}")
-    if model not in list_model_ids():
+    logger.info(f"[chat] 接收到表单参数: model={model}, system_rule={system_rule}, stream={stream}, nsfw={nsfw}, reasoning={reasoning}, draft={draft}")
+    if lifecycle.draining:
+        return JSONResponse(
+            {"error": "服务正在重启，请稍后重试"},
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    if model != AUTO_MODEL and model not in list_model_ids():
         raise HTTPException(status_code=400, detail=f"模型 '{model}' 不存在")
     try:
         system_prompt = get_system_prompt(system_rule)
@@ -83,20 +165,28 @@ async def chat(
         raise HTTPException(status_code=400, detail=f"system_rule '{system_rule}' 不存在")
     nsfw_enabled = nsfw.lower() == "true"
     stream_enabled = stream.lower() == "true"
+    reasoning_limit = max(0, min(reasoning_max_chars, REASONING_MAX_CHARS)) if reasoning.lower() == "true" else 0
+    draft_model = DRAFT_MODELS.get(model) if draft.lower() == "true" else None
+    if draft_model not in list_model_ids():
+        draft_model = None
     try:
         if stream_enabled:
             async def event_stream():
                 try:
-                    async for chunk in execute_model_for_app(
-                            model_name=model,
-                            user_input=prompt,
-                            system_instructions=system_prompt,
-                            personas=current_personas,
-                            web_input=web_input,
-                            nsfw=nsfw_enabled,
-                            stream=True
-                    ):
-                        yield json.dumps(chunk, ensure_ascii=False) + "\n"
+                    async with lifecycle.track():
+                        async for chunk in execute_model_for_app(
+                                model_name=model,
+                                user_input=prompt,
+                                system_instructions=system_prompt,
+                                personas=current_personas,
+                                web_input=web_input,
+                                nsfw=nsfw_enabled,
+                                stream=True,
+                                session=system_rule,
+                                reasoning_limit=reasoning_limit,
+                                draft_model=draft_model,
+                        ):
+                            yield json.dumps(chunk, ensure_ascii=False) + "\n"
                 except Exception as e:
                     logger.error("[chat-stream] 中断", exc_info=True)
                     yield json.dumps({"error": "stream interrupted"}, ensure_ascii=False) + "\n"
@@ -104,41 +194,106 @@ async def chat(
         else:
             # 非流式：一次性获取完整结果
             result_chunks = []
-            async for chunk in execute_model_for_app(
-                model_name=model,
-                user_input=prompt,
-                system_instructions=system_prompt,
-                personas=current_personas,
-                web_input=web_input,
-                nsfw=nsfw_enabled,
-                stream=False
-            ):
-                result_chunks.append(chunk)
+            async with lifecycle.track():
+                async for chunk in execute_model_for_app(
+                    model_name=model,
+                    user_input=prompt,
+                    system_instructions=system_prompt,
+                    personas=current_personas,
+                    web_input=web_input,
+                    nsfw=nsfw_enabled,
+                    stream=False,
+                    session=system_rule,
+                    reasoning_limit=reasoning_limit,
+                ):
+                    result_chunks.append(chunk)
             full_result = {"results": result_chunks}
             return JSONResponse(full_result)
     except Exception as e:
         logger.error(f"[chat] 响应出错: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="服务器处理请求时出错")
+
+# -----------------------------
+# 多模型对比：并发请求多个模型，NDJSON 中每个事件带 model 字段
+# -----------------------------
+@app.post("/chat/compare")
+async def chat_compare(
+    models: str = Form(...),  # 逗号分隔，如 deepseek-chat,gemini-3-flash-preview,grok-4.1
+    prompt: str = Form(...),
+    system_rule: str = Form("default"),
+    web_input: str = Form(""),
+    nsfw: str = Form("true"),
+):
+    model_names = list(dict.fromkeys(m.strip() for m in models.split(",") if m.strip()))
+    logger.info(f"[chat/compare] models={model_names}, system_rule={system_rule}")
+    if lifecycle.draining:
+        return JSONResponse(
+            {"error": "服务正在重启，请稍后重试"},
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    if not 2 <= len(model_names) <= MAX_COMPARE_MODELS:
+        raise HTTPException(status_code=400, detail=f"请选择 2~{MAX_COMPARE_MODELS} 个模型")
+    unknown = [m for m in model_names if m not in list_model_ids()]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"模型 {unknown} 不存在")
+    system_prompt = get_system_prompt(system_rule)
+
+    async def event_stream():
+        try:
+            async with lifecycle.track():
+                async for event in compare_models(
+                        model_names,
+                        user_input=prompt,
+                        system_instructions=system_prompt,
+                        personas=current_personas,
+                        web_input=web_input,
+                        nsfw=nsfw.lower() == "true",
+                        session=system_rule,
+                ):
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+        except Exception:
+            logger.error("[chat/compare] 中断", exc_info=True)
+            yield json.dumps({"error": "stream interrupted"}, ensure_ascii=False) + "\n"
+    return StreamingResponse(event_stream(), media_type="application/json")
+
+
+@app.post("/chat/compare/commit")
+async def chat_compare_commit(compare_id: str = Form(...), model: str = Form(...)):
+    """把对比结果中选定的一个写入聊天历史"""
+    try:
+        entry = await commit_compare(compare_id, model)
+    except KeyError:
+        return JSONResponse({"status": "error", "message": "对比结果不存在或已过期"}, status_code=404)
+    except ValueError:
+        return JSONResponse({"status": "error", "message": f"模型 '{model}' 不在该组对比结果中"}, status_code=400)
+    logger.info(f"[chat/compare] 已保存 compare_id={compare_id} 的 {model} 回复")
+    return JSONResponse({"status": "ok", "model": entry["model"], "full": entry["full"]})
     
 # -----------------------------
 # 获取人物列表
 # -----------------------------
 @app.get("/personas")
-async def get_persona_list():
+async def get_persona_list(request: Request):
+    etag = version_etag("personas", *persona_file_version(), personas_revision)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
     all_personas = list_personas()
-    return JSONResponse({
+    return json_with_etag({
         "personas": [{"name": name, "selected": name in current_personas} for name in all_personas]
-    })
+    }, etag)
 
 # -----------------------------
 # 更新人物列表
 # -----------------------------
 @app.post("/personas")
 async def update_personas(selected: str = Form(...)):
-    global current_personas
+    global current_personas, personas_revision
     available = set(list_personas())
     names = [name.strip() for name in selected.split(",") if name.strip()]
     current_personas = [name for name in names if name in available]
+    personas_revision += 1
     logger.info(f"[人物更新] 当前出场人物: {current_personas}")
     return JSONResponse({"status": "ok", "current_personas": current_personas})
 
@@ -148,6 +303,7 @@ async def update_personas(selected: str = Form(...)):
 @app.post("/reload_history")
 async def reload_history():
     try:
+        await wait_persisted()
         chat_history.reload()
         logger.info("[操作] 历史记录已从文件重新加载")
         return JSONResponse({"status": "ok"})
@@ -160,6 +316,7 @@ async def reload_history():
 # -----------------------------
 @app.post("/clear_history")
 async def clear_history():
+    await wait_persisted()  # 先让排队中的写入完成，避免清空后又写入上一轮
     chat_history.clear_history()
     logger.info("[操作] 历史记录已清空")
     return JSONResponse({"status": "ok"})
@@ -167,16 +324,26 @@ async def clear_history():
 # -----------------------------
 # 获取 system_rules
 # -----------------------------
+SYSTEM_RULES_ETAG = version_etag("rules", len(PROMPT_FILES))  # PROMPT_FILES 运行期间不变
+
 @app.get("/system_rules")
-async def get_system_rules():
-    return JSONResponse({"rules": list(PROMPT_FILES.keys())})
+async def get_system_rules(request: Request):
+    cached = not_modified(request, SYSTEM_RULES_ETAG)
+    if cached:
+        return cached
+    return json_with_etag({"rules": list(PROMPT_FILES.keys())}, SYSTEM_RULES_ETAG)
 
 # -----------------------------
 # 获取模型列表
 # -----------------------------
 @app.get("/system_model")
-async def get_system_models():
-    return JSONResponse({"rules": list(list_model_ids())})
+async def get_system_models(request: Request):
+    registry = current_registry()
+    etag = version_etag("models", registry.version, registry.generation)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    return json_with_etag({"rules": registry.model_ids() + [AUTO_MODEL]}, etag)
 
 # -----------------------------
 # 删除最后一条聊天记录
@@ -184,6 +351,7 @@ async def get_system_models():
 @app.post("/remove_last_entry")
 async def remove_last_entry():
     try:
+        await wait_persisted()
         if chat_history.is_empty():
             return JSONResponse({"status": "empty", "message": "没有可删除的记录"}, status_code=400)
 
@@ -198,13 +366,127 @@ async def remove_last_entry():
 # 读取最后一条历史记录
 # -----------------------------
 @app.get("/get_chat_history")
-async def get_chat_history():
-    data = read_chat_history.main()
-    return JSONResponse(data)
+async def get_chat_history(request: Request):
+    await wait_persisted()
+    etag = version_etag("history", chat_history.version)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    data = read_chat_history.main(chat_history)
+    return json_with_etag(data, etag)
+
+# -----------------------------
+# 全文检索历史记录
+# -----------------------------
+@app.get("/history/search")
+async def search_history(
+    q: str = Query(..., min_length=1),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    session: str | None = None,
+    model: str | None = None,
+):
+    if not hasattr(chat_history, "search"):
+        raise HTTPException(status_code=501, detail="当前历史存储不支持检索，请使用 sqlite 后端")
+    try:
+        result = chat_history.search(q, page=page, page_size=page_size, session=session, model=model)
+    except Exception as e:
+        logger.error(f"[history/search] 检索失败: {e}", exc_info=True)
+        raise HTTPException(status_code=400, detail="检索语句无效")
+    return JSONResponse(result)
+
+# -----------------------------
+# 按模型汇总上游返回的 token 用量与费用
+# -----------------------------
+@app.get("/history/usage")
+async def history_usage(session: str | None = None):
+    if not hasattr(chat_history, "usage_summary"):
+        raise HTTPException(status_code=501, detail="当前历史存储不支持用量统计，请使用 sqlite 后端")
+    return JSONResponse({"models": chat_history.usage_summary(session)})
+
+# -----------------------------
+# 热加载模型注册表 / client 配置
+# -----------------------------
+@app.post("/admin/reload_registry", dependencies=[Depends(require_admin)])
+async def admin_reload_registry():
+    try:
+        result = reload_registry()
+    except Exception as e:
+        logger.error(f"[admin/reload_registry] 配置无效，保持旧配置: {e}")
+        raise HTTPException(status_code=400, detail=f"配置无效: {e}")
+    logger.info(f"[操作] 模型注册表已重新加载: {result}")
+    return JSONResponse({"status": "ok", **result})
+
+# -----------------------------
+# 事件循环延迟直方图与最近的阻塞调用栈
+# -----------------------------
+@app.get("/debug/loop_lag", dependencies=[Depends(require_admin)])
+async def debug_loop_lag():
+    return JSONResponse(loop_watchdog.snapshot())
+
+# -----------------------------
+# "auto" 路由使用的各模型 / provider 实时统计
+# -----------------------------
+@app.get("/debug/model_stats", dependencies=[Depends(require_admin)])
+async def debug_model_stats():
+    return JSONResponse(model_router.snapshot())
+
+# -----------------------------
+# 存活检查（进程能响应即可）
+# -----------------------------
+@app.get("/healthz")
+async def healthz():
+    return JSONResponse({"status": "ok"})
+
+# -----------------------------
+# 就绪检查：预热完成前、排空开始后返回 503
+# -----------------------------
+PROBE_INTERVAL = float(os.getenv("READINESS_PROBE_INTERVAL", "30"))  # 上游探测结果的有效期（秒）
+_probe_task: asyncio.Task | None = None
+
+@app.get("/readyz")
+async def readyz():
+    global _probe_task
+    ready, report = lifecycle.readiness()
+    # 探测结果过期时在后台刷新，本次直接返回上次结果
+    if lifecycle.warmed_up and READINESS_PROBE != "off" and (_probe_task is None or _probe_task.done()):
+        checked = [p["checked_at"] for p in lifecycle.providers.values()]
+        if checked and time.time() - min(checked) > PROBE_INTERVAL:
+            _probe_task = asyncio.create_task(probe_providers())
+    return JSONResponse(report, status_code=200 if ready else 503)
+
+# -----------------------------
+# 前端首屏数据（一次请求返回模型、规则、人物与最新状态）
+# -----------------------------
+@app.get("/bootstrap")
+async def bootstrap(request: Request):
+    await wait_persisted()
+    registry = current_registry()
+    etag = version_etag(
+        "bootstrap", registry.version, registry.generation,
+        *persona_file_version(), personas_revision, chat_history.version,
+    )
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    all_personas = list_personas()
+    return json_with_etag({
+        "models": [
+            {
+                "id": name,
+                "supports_streaming": details.get("supports_streaming", True),
+                "default_temperature": details.get("default_temperature"),
+            }
+            for name, details in registry.models.items()
+        ] + [{"id": AUTO_MODEL, "supports_streaming": True, "default_temperature": None}],
+        "rules": list(PROMPT_FILES.keys()),
+        "personas": [{"name": name, "selected": name in current_personas} for name in all_personas],
+        "history": read_chat_history.main(chat_history),
+    }, etag)
 
 # SPA 前端兜底路由（必须放在所有 API 之后）
 @app.get("/{full_path:path}", response_class=HTMLResponse)
-async def spa_fallback(full_path: str):
+async def spa_fallback(full_path: str, request: Request):
     # 排除后端 API 与静态资源路径
     if full_path.startswith("chat") \
         or full_path.startswith("personas") \
@@ -215,12 +497,18 @@ async def spa_fallback(full_path: str):
         or full_path.startswith("remove_last_entry") \
         or full_path.startswith("assets") \
             or full_path.startswith("get_chat_history") \
+            or full_path.startswith("history") \
+            or full_path.startswith("admin") \
+            or full_path.startswith("readyz") \
+            or full_path.startswith("healthz") \
+            or full_path.startswith("bootstrap") \
+            or full_path.startswith("debug") \
             or full_path.startswith("static"):
         return JSONResponse({"error": "Not Found"}, status_code=404)
-    index_file = os.path.join(FRONTEND_DIST, "index.html")
-    if os.path.exists(index_file):
-        return FileResponse(index_file)
-    return HTMLResponse("Frontend not built", status_code=404)
+    response = await index_page.response(request.scope)
+    if response is None:
+        return HTMLResponse("Frontend not built", status_code=404)
+    return response
 
 # -----------------------------
 # 启动服务（生产安全版）
@@ -16,6 +16,7 @@ PROMPT_FILES = {
     "deepseek": "system_prompt_deepseek.md",
 }
 
+# 提示词缓存：filename -> (mtime_ns, 内容)；文件修改后自动重新读取
 PROMPT_CACHE = {}
 
 def get_system_prompt(name: str) -> str:
@@ -23,8 +24,27 @@ def get_system_prompt(name: str) -> str:
     filename = PROMPT_FILES.get(name, PROMPT_FILES["default"])
     file_path = Path(__file__).parent / filename
     try:
-        return file_path.read_text(encoding="utf-8").strip()
+        mtime = file_path.stat().st_mtime_ns
+        cached = PROMPT_CACHE.get(filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        content = file_path.read_text(encoding="utf-8").strip()
     except FileNotFoundError:
         raise FileNotFoundError(f"未找到系统提示文件: {file_path}")
+    PROMPT_CACHE[filename] = (mtime, content)
+    return content
+
+
+def preload_prompts() -> dict:
+    """预读全部提示词文件（启动预热用），返回 {name: 是否成功}"""
+    result = {}
+    for name in PROMPT_FILES:
+        try:
+            get_system_prompt(name)
+            result[name] = True
+        except FileNotFoundError:
+            result[name] = False
+    return result
+
 if __name__ == "__main__":
     print(get_system_prompt("system_prompt_def.md"))
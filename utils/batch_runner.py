@@ -0,0 +1,360 @@
+# utils/batch_runner.py
+"""
+离线批量生成
+
+从 JSONL 读取请求，并发调用模型，结果逐行追加写入 JSONL。
+messages 与在线 /chat 一样由 build_messages 构建（不带聊天历史），上游调用与后台任务共用 utils/completion.py；
+不读写交互会话的 ChatHistory。
+
+输入每行一个请求（只有 input 必填）：
+    {"id": "card-001", "model": "gemini-3-flash-preview", "system_rule": "角色卡设定架构师",
+     "personas": ["安清雪"], "input": "...", "web_input": "", "nsfw": false, "temperature": 0.4}
+
+输出每行一个结果：
+    {"id", "model", "status": "ok" | "error", "output", "usage", "usage_source", "cost", "latency_ms", "attempts", "error"}
+
+用法：
+    python -m utils.batch_runner cards.jsonl -o cards.out.jsonl
+    python -m utils.batch_runner cards.jsonl -o cards.out.jsonl --concurrency 16 --rate link_api=120 --provider-concurrency link_api=8
+
+- 重新运行同一命令时，输出文件中已成功（status=ok）的 id 会被跳过；失败的会重试
+- 每个 provider 单独限流：并发数（--provider-concurrency，或 client 配置中的 batch_concurrency）
+  与每分钟请求数（--rate，或 client 配置中的 batch_rpm）
+- 费用按 DEFAULT_MODELS 中的 pricing 估算；上游未返回 usage 时用 tiktoken 在线程中估算 token 数
+- messages 使用 cache 布局（同一 system_rule 的请求前缀一致），报告中给出上游前缀缓存的命中率
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+from config.models import estimate_cost
+from config.registry import current_registry
+from prompt.get_system_prompt import get_system_prompt
+from utils.client_pool import ClientPool
+from utils.completion import cache_hit_rate, completion_text, completion_usage, post_completion
+from utils.log_config import setup_logging
+from utils.message_builder import apply_cache_breakpoints, build_messages
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8  # 全局同时进行的请求数
+DEFAULT_PROVIDER_CONCURRENCY = 4  # 单个 provider 同时进行的请求数
+DEFAULT_RETRIES = 2
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+PROGRESS_EVERY = 10  # 每完成多少条输出一次进度
+
+
+# -----------------------------
+# 输入 / 输出
+# -----------------------------
+def load_requests(path: Path) -> list[dict]:
+    """读取请求文件；没有 id 的请求按行号生成（line-N），保证重跑时 id 不变"""
+    requests = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{lineno} 不是合法 JSON: {e}") from e
+            if not isinstance(item, dict):
+                raise ValueError(f"{path}:{lineno} 应为 JSON 对象")
+            if not isinstance(item.get("input"), str) or not item["input"].strip():
+                raise ValueError(f"{path}:{lineno} 缺少 input 字段或不是字符串")
+            if item.get("id") is not None and not isinstance(item["id"], (str, int)):
+                raise ValueError(f"{path}:{lineno} id 应为字符串或整数")
+            personas = item.get("personas")
+            if personas is not None and not (isinstance(personas, list) and all(isinstance(p, str) for p in personas)):
+                raise ValueError(f"{path}:{lineno} personas 应为字符串列表")
+            item["id"] = str(item.get("id") or f"line-{lineno}")
+            if item["id"] in seen:
+                raise ValueError(f"{path}:{lineno} id 重复: {item['id']}")
+            seen.add(item["id"])
+            requests.append(item)
+    return requests
+
+
+def completed_ids(path: Path) -> set:
+    """输出文件中已成功的 id（文件不存在时为空）；末尾写了一半的行忽略"""
+    done = set()
+    if not path.exists():
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if item.get("status") == "ok":
+                done.add(str(item.get("id")))
+    return done
+
+
+def _parse_limits(items: list[str]) -> Dict[str, float]:
+    """解析 ["link_api=60", "deepseek=30"]"""
+    limits = {}
+    for item in items or []:
+        name, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"格式应为 provider=数值: {item}")
+        limits[name.strip()] = float(value)
+    return limits
+
+
+# -----------------------------
+# 限流
+# -----------------------------
+class ProviderLimiter:
+    """单个 provider 的并发上限 + 每分钟请求数（按固定间隔放行）"""
+
+    def __init__(self, concurrency: int, rpm: float = 0):
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._interval = 60.0 / rpm if rpm else 0.0
+        self._next_slot = 0.0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._semaphore:
+            if self._interval:
+                # 先占位再等待，同一时刻到达的请求依次排开
+                now = asyncio.get_running_loop().time()
+                start = max(now, self._next_slot)
+                self._next_slot = start + self._interval
+                if start > now:
+                    await asyncio.sleep(start - now)
+            yield
+
+
+# -----------------------------
+# 执行
+# -----------------------------
+def _estimate_usage(messages: list[dict], output: str) -> Optional[dict]:
+    """上游未返回 usage 时本地估算（在线程中调用）"""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.debug(f"[Batch] tokenizer 不可用，跳过 token 估算: {e}")
+        return None
+    return {
+        "prompt_tokens": sum(len(encoding.encode(m.get("content", ""))) for m in messages),
+        "completion_tokens": len(encoding.encode(output)),
+    }
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """可重试时返回等待秒数，否则返回 None"""
+    if isinstance(error, httpx.HTTPStatusError):
+        if error.response.status_code not in RETRY_STATUS:
+            return None
+        retry_after = error.response.headers.get("retry-after", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+    elif not isinstance(error, httpx.TransportError):
+        return None
+    return min(30.0, 2.0 ** attempt)
+
+
+class BatchRunner:
+    def __init__(self, output: Path, concurrency: int = DEFAULT_CONCURRENCY,
+                 provider_concurrency: Optional[Dict[str, float]] = None,
+                 rates: Optional[Dict[str, float]] = None, retries: int = DEFAULT_RETRIES,
+                 default_model: Optional[str] = None):
+        self.output = output
+        self.concurrency = concurrency
+        self.provider_concurrency = provider_concurrency or {}
+        self.rates = rates or {}
+        self.retries = retries
+        self.default_model = default_model
+        self.registry = current_registry()  # 整批使用同一份注册表快照
+        self.client_pool = ClientPool(lambda: httpx.AsyncClient(timeout=httpx.Timeout(connect=10.0, read=300.0, write=10.0, pool=None)))
+        self._limiters: Dict[str, ProviderLimiter] = {}
+        self.stats = {
+            "ok": 0, "error": 0, "skipped": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+            "cost": 0.0, "unpriced": 0,
+            "by_model": defaultdict(lambda: {"ok": 0, "error": 0, "tokens": 0, "cost": 0.0}),
+        }
+
+    def _limiter(self, client_name: str) -> ProviderLimiter:
+        limiter = self._limiters.get(client_name)
+        if limiter is None:
+            settings = self.registry.raw_clients.get(client_name, {})
+            concurrency = self.provider_concurrency.get(client_name, settings.get("batch_concurrency", DEFAULT_PROVIDER_CONCURRENCY))
+            rpm = self.rates.get(client_name, settings.get("batch_rpm", 0))
+            limiter = self._limiters[client_name] = ProviderLimiter(int(concurrency), float(rpm))
+        return limiter
+
+    async def run_one(self, request: dict) -> dict:
+        model_name = request.get("model") or self.default_model
+        result = {"id": request["id"], "model": model_name}
+        model_details = self.registry.model(model_name) if model_name else None
+        if not model_details:
+            return {**result, "status": "error", "error": f"模型 '{model_name}' 不存在"}
+        client_name = model_details["client_name"]
+
+        try:
+            messages = build_messages(
+                get_system_prompt(request.get("system_rule", "default")),
+                request.get("personas"),
+                None,  # 批量任务不带聊天历史
+                request["input"],
+                request.get("web_input", ""),
+                nsfw=bool(request.get("nsfw", False)),
+                layout="cache",
+            )
+        except Exception as e:
+            # 未知的 system_rule / 人物等只影响这一条，记为失败（重跑时会重试），不中断整批
+            logger.warning(f"[Batch] {request['id']} 构建 messages 失败: {type(e).__name__}: {e}")
+            return {**result, "status": "error", "error": f"构建 messages 失败: {type(e).__name__}: {e}", "attempts": 0}
+        payload_messages = apply_cache_breakpoints(messages) if model_details.get("prompt_cache") == "cache_control" else messages
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self._limiter(client_name).slot():
+                    async with self.client_pool.lease(client_name) as client:
+                        data = await post_completion(
+                            client, self.registry.clients[client_name], model_details["label"], payload_messages,
+                            temperature=request.get("temperature"),
+                        )
+                break
+            except Exception as e:
+                delay = _retry_delay(e, attempt) if attempt <= self.retries else None
+                if delay is None:
+                    return {**result, "status": "error", "error": f"{type(e).__name__}: {e}", "attempts": attempt,
+                            "latency_ms": round((time.perf_counter() - start) * 1000)}
+                logger.warning(f"[Batch] {request['id']} 第 {attempt} 次失败（{e}），{delay:.0f}s 后重试")
+                await asyncio.sleep(delay)
+
+        output = completion_text(data)
+        usage = completion_usage(data)
+        usage_source = "provider"
+        if usage is None:
+            usage = await asyncio.to_thread(_estimate_usage, messages, output)
+            usage_source = "estimated" if usage else None
+        tokens = usage or {"prompt_tokens": 0, "completion_tokens": 0}
+        cost = estimate_cost(model_details, tokens["prompt_tokens"], tokens["completion_tokens"])
+        return {
+            **result,
+            "status": "ok",
+            "output": output,
+            "usage": usage,
+            "usage_source": usage_source,
+            "cost": round(cost, 6) if cost is not None else None,
+            "latency_ms": round((time.perf_counter() - start) * 1000),
+            "attempts": attempt,
+        }
+
+    def _record(self, result: dict) -> None:
+        stats = self.stats
+        by_model = stats["by_model"][result.get("model")]
+        stats[result["status"]] += 1
+        by_model[result["status"]] += 1
+        usage = result.get("usage") or {}
+        stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        stats["completion_tokens"] += usage.get("completion_tokens", 0)
+        stats["cached_tokens"] += usage.get("cached_tokens", 0)
+        by_model["tokens"] += usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        if result["status"] == "ok":
+            if result.get("cost") is None:
+                stats["unpriced"] += 1
+            else:
+                stats["cost"] += result["cost"]
+                by_model["cost"] += result["cost"]
+
+    async def run(self, requests: list[dict]) -> dict:
+        done = completed_ids(self.output)
+        pending = [r for r in requests if r["id"] not in done]
+        self.stats["skipped"] = len(requests) - len(pending)
+        logger.info(f"[Batch] 共 {len(requests)} 条，已完成 {self.stats['skipped']} 条，本次执行 {len(pending)} 条")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for request in pending:
+            queue.put_nowait(request)
+        started = time.perf_counter()
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.output, "a", encoding="utf-8") as out:
+            async def worker():
+                while True:
+                    try:
+                        request = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    result = await self.run_one(request)
+                    # 逐条写入并 flush，中断后重跑可从断点继续
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    self._record(result)
+                    finished = self.stats["ok"] + self.stats["error"]
+                    if finished % PROGRESS_EVERY == 0 or finished == len(pending):
+                        elapsed = time.perf_counter() - started
+                        logger.info(f"[Batch] 进度 {finished}/{len(pending)}，{finished / elapsed:.2f} 条/秒")
+
+            try:
+                await asyncio.gather(*(worker() for _ in range(max(1, self.concurrency))))
+            finally:
+                await self.client_pool.aclose()
+
+        self.stats["elapsed"] = time.perf_counter() - started
+        return self.stats
+
+
+def format_report(stats: dict) -> str:
+    elapsed = stats.get("elapsed") or 0.0
+    finished = stats["ok"] + stats["error"]
+    completion_tokens = stats["completion_tokens"]
+    lines = [
+        f"完成 {stats['ok']} 条，失败 {stats['error']} 条，跳过（已完成）{stats['skipped']} 条",
+        f"耗时 {elapsed:.1f}s，吞吐 {finished / elapsed if elapsed else 0:.2f} 条/秒，"
+        f"输出 {completion_tokens / elapsed if elapsed else 0:.1f} tokens/秒",
+        f"token：输入 {stats['prompt_tokens']}（缓存命中 {cache_hit_rate(stats):.0%}），输出 {completion_tokens}",
+        f"费用（估算）：${stats['cost']:.4f}" + (f"，另有 {stats['unpriced']} 条模型未配置价格" if stats["unpriced"] else ""),
+    ]
+    for model, item in sorted(stats["by_model"].items(), key=lambda kv: str(kv[0])):
+        lines.append(f"  {model}: 成功 {item['ok']}，失败 {item['error']}，tokens {item['tokens']}，${item['cost']:.4f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量生成（JSONL 输入 / 输出，可断点续跑）")
+    parser.add_argument("input", type=Path, help="请求 JSONL 文件")
+    parser.add_argument("-o", "--output", type=Path, help="结果 JSONL 文件（默认 <input>.out.jsonl）")
+    parser.add_argument("--model", help="请求未指定 model 时使用的模型")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="全局并发数")
+    parser.add_argument("--provider-concurrency", action="append", metavar="PROVIDER=N",
+                        help="单个 provider 的并发上限，可重复")
+    parser.add_argument("--rate", action="append", metavar="PROVIDER=RPM", help="单个 provider 每分钟请求数上限，可重复")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="429 / 5xx / 网络错误的重试次数")
+    args = parser.parse_args()
+
+    setup_logging()
+    output = args.output or args.input.with_suffix(".out.jsonl")
+    runner = BatchRunner(
+        output,
+        concurrency=args.concurrency,
+        provider_concurrency=_parse_limits(args.provider_concurrency),
+        rates=_parse_limits(args.rate),
+        retries=args.retries,
+        default_model=args.model,
+    )
+    stats = asyncio.run(runner.run(load_requests(args.input)))
+    print(format_report(stats))
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
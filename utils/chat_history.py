@@ -2,13 +2,18 @@
 
 import json
 import logging
-import re
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
+from utils.summary_extractor import SUMMARY_PATTERN
+
 logger = logging.getLogger(__name__)
 
+# 聊天历史文件所在目录，可用环境变量 CHAT_HISTORY_DIR 指定（如基准测试指向临时目录，不改动工作区）
+HISTORY_DIR = Path(os.getenv("CHAT_HISTORY_DIR") or Path(__file__).resolve().parent.parent / "log")
+
 class ChatHistory:
     """
     管理聊天历史
@@ -18,9 +23,11 @@ class ChatHistory:
     - 支持格式化输出用于拼接系统 prompt
     - 自动持久化到文件
     - 提取故事摘要
+    - 保存分层剧情摘要（由 HistoryCompactor 在后台生成）
     """
 
-    HISTORY_FILE = Path(__file__).resolve().parent.parent / "log/chat_history.json"
+    HISTORY_FILE = HISTORY_DIR / "chat_history.json"
+    SUMMARY_FILE = HISTORY_DIR / "chat_summaries.json"
 
     def __init__(self, max_entries: int = 50):
         """
@@ -31,7 +38,14 @@ class ChatHistory:
         """
         self.max_entries = max_entries
         self.entries: List[Dict[str, Any]] = []
+        self.summaries: List[Dict[str, Any]] = []  # 分层摘要：{"tier", "start_id", "end_id", "content", "timestamp"}
+        self.version = 0  # 每次内容变化自增，供检索索引 / 缓存判断是否失效
         self.load_history()
+        self.load_summaries()
+
+    def _touch(self) -> None:
+        """标记历史记录已变化"""
+        self.version += 1
 
     def reload(self) -> None:
         """
@@ -41,30 +55,66 @@ class ChatHistory:
         before_count = len(self.entries)
         logger.info(f"[ChatHistory] 重新加载历史记录，当前内存中有 {before_count} 条记录。")
         self.load_history()
+        self.load_summaries()
         after_count = len(self.entries)
         logger.info(f"[ChatHistory] 重新加载完成，最新记录条数：{after_count}。")
 
-    def add_entry(self, user: str, assistant: str) -> None:
+    def add_entry(self, user: str, assistant: str, model: Optional[str] = None, session: Optional[str] = None,
+                  usage: Optional[Dict[str, Any]] = None) -> None:
         """
         添加一条对话记录
 
         Args:
             user: 用户输入文本
             assistant: 模型回复文本
+            model: 可选，生成该回复的模型
+            session: 可选，会话 / 剧情线标识
+            usage: 可选，上游返回的 token 用量（prompt / completion / cached / reasoning tokens 与 cost）
         """
         entry = {
+            "id": self._next_id(),
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "user": user.strip(),
             "assistant": assistant.strip()
         }
+        if model:
+            entry["model"] = model
+        if session:
+            entry["session"] = session
+        if usage:
+            entry["usage"] = usage
         self.entries.append(entry)
 
         # 超出最大条数时，保留最新 max_entries 条
         if len(self.entries) > self.max_entries:
             self.entries = self.entries[-self.max_entries:]
 
+        self._touch()
         self.save_history()
 
+    def _next_id(self) -> int:
+        """下一条记录的自增 id（摘要用 id 区间标记覆盖范围）"""
+        return max((e.get("id", 0) for e in self.entries), default=0) + 1
+
+    def _ensure_ids(self) -> None:
+        """旧版历史文件没有 id 字段，按顺序补齐"""
+        next_id = max((e.get("id", 0) for e in self.entries), default=0) + 1
+        for e in self.entries:
+            if "id" not in e:
+                e["id"] = next_id
+                next_id += 1
+
+    def entries_after(self, after_id: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        返回 id 大于 after_id 的记录（按时间顺序）
+
+        Args:
+            after_id: 起始 id（不包含）
+            limit: 可选，最多返回条数
+        """
+        result = [e for e in self.entries if e.get("id", 0) > after_id]
+        return result[:limit] if limit is not None else result
+
     def format_history(self, max_entries: Optional[int] = None) -> str:
         """
         格式化历史记录，便于拼接到系统 prompt
@@ -98,9 +148,8 @@ class ChatHistory:
             str: 提取的故事星记忆回廊，如果没有找到则返回 None
         """
         # 匹配 ##时间戳## 到文本结尾的部分（包含时间戳本身）
-        # pattern = r'**\s*动态角色状态机-\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}\s*##.*'
-        pattern = r'\动态角色状态机-\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}[\s\S]*$'
-        match = re.search(pattern, assistant_text, re.DOTALL)
+        # 流式场景请使用 StreamingSummaryExtractor，避免对全文二次扫描
+        match = SUMMARY_PATTERN.search(assistant_text)
         # print("match = ",match)
         if match:
             return match.group(0).strip()
@@ -125,15 +174,49 @@ class ChatHistory:
             except Exception as e:
                 print(f"[警告] 加载历史失败: {e}")
                 self.entries = []
+        self._ensure_ids()
+        self._touch()
+
+    def save_summaries(self) -> None:
+        """将分层摘要保存到文件"""
+        try:
+            self.SUMMARY_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.SUMMARY_FILE, "w", encoding="utf-8") as f:
+                json.dump(self.summaries, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"[警告] 保存摘要失败: {e}")
+
+    def load_summaries(self) -> None:
+        """从文件加载分层摘要"""
+        self.summaries = []
+        if self.SUMMARY_FILE.exists():
+            try:
+                with open(self.SUMMARY_FILE, "r", encoding="utf-8") as f:
+                    self.summaries = json.load(f)
+            except Exception as e:
+                print(f"[警告] 加载摘要失败: {e}")
+
+    def format_summaries(self) -> str:
+        """
+        按时间顺序拼接分层摘要（高层摘要覆盖更早的剧情）
+
+        Returns:
+            str: 摘要文本，没有摘要时返回空字符串
+        """
+        ordered = sorted(self.summaries, key=lambda s: s.get("start_id", 0))
+        return "\n".join(s.get("content", "") for s in ordered if s.get("content"))
 
     def clear_history(self) -> None:
         """清空历史记录，并删除文件"""
         self.entries = []
-        if self.HISTORY_FILE.exists():
-            try:
-                self.HISTORY_FILE.unlink()
-            except Exception as e:
-                print(f"[警告] 删除历史文件失败: {e}")
+        self.summaries = []
+        self._touch()
+        for path in (self.HISTORY_FILE, self.SUMMARY_FILE):
+            if path.exists():
+                try:
+                    path.unlink()
+                except Exception as e:
+                    print(f"[警告] 删除历史文件失败: {e}")
 
     def is_empty(self) -> bool:
         """
@@ -155,6 +238,7 @@ class ChatHistory:
             return
 
         removed_entry = self.entries.pop()  # 删除最后一条
+        self._touch()
         logger.info(
             f"[ChatHistory] 已删除最后一条记录，时间: {removed_entry.get('timestamp', '未知')}，"
             f"用户内容: {removed_entry.get('user', '')[:30]}..."
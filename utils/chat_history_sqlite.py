@@ -0,0 +1,474 @@
+# utils/chat_history_sqlite.py
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+from utils.chat_history import HISTORY_DIR, ChatHistory
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# 表结构
+# -----------------------------
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    session   TEXT NOT NULL DEFAULT 'default',
+    model     TEXT,
+    user      TEXT NOT NULL DEFAULT '',
+    assistant TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_turns_timestamp ON turns(timestamp);
+CREATE INDEX IF NOT EXISTS idx_turns_session ON turns(session, id);
+CREATE INDEX IF NOT EXISTS idx_turns_model ON turns(model);
+-- 上游返回的 token 用量（每轮一行，未返回 usage 的轮次没有记录）
+CREATE TABLE IF NOT EXISTS turn_usage (
+    turn_id           INTEGER PRIMARY KEY,
+    prompt_tokens     INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens     INTEGER NOT NULL DEFAULT 0,
+    reasoning_tokens  INTEGER NOT NULL DEFAULT 0,
+    cost              REAL
+);
+CREATE TRIGGER IF NOT EXISTS turn_usage_ad AFTER DELETE ON turns BEGIN
+    DELETE FROM turn_usage WHERE turn_id = old.id;
+END;
+-- 一次性操作的标记（如旧版 JSON 历史是否已导入）
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    tier      INTEGER NOT NULL,
+    start_id  INTEGER NOT NULL,
+    end_id    INTEGER NOT NULL,
+    content   TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+"""
+
+# FTS5 外部内容表 + 触发器，保证索引与 turns 同步
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(
+    user, assistant, content='turns', content_rowid='id', tokenize='{tokenizer}'
+);
+CREATE TRIGGER IF NOT EXISTS turns_ai AFTER INSERT ON turns BEGIN
+    INSERT INTO turns_fts(rowid, user, assistant) VALUES (new.id, new.user, new.assistant);
+END;
+CREATE TRIGGER IF NOT EXISTS turns_ad AFTER DELETE ON turns BEGIN
+    INSERT INTO turns_fts(turns_fts, rowid, user, assistant) VALUES ('delete', old.id, old.user, old.assistant);
+END;
+CREATE TRIGGER IF NOT EXISTS turns_au AFTER UPDATE ON turns BEGIN
+    INSERT INTO turns_fts(turns_fts, rowid, user, assistant) VALUES ('delete', old.id, old.user, old.assistant);
+    INSERT INTO turns_fts(rowid, user, assistant) VALUES (new.id, new.user, new.assistant);
+END;
+"""
+
+# trigram 分词器按字符切分，适合中文；少于 3 个字的词走 LIKE 兜底
+TRIGRAM_MIN_CHARS = 3
+
+
+class SQLiteChatHistory(ChatHistory):
+    """
+    基于 SQLite 的聊天历史
+
+    功能：
+    - 全量保存所有对话，不再按 max_entries 丢弃
+    - timestamp / session / model 建有索引
+    - FTS5 全文索引覆盖 user / assistant 文本
+    - 内存中只保留最近 max_entries 条（供 build_messages 使用）
+    - 分层摘要保存在同一数据库的 summaries 表
+    """
+
+    DB_FILE = HISTORY_DIR / "chat_history.db"
+
+    def __init__(self, max_entries: int = 50, db_file: Optional[Path] = None):
+        """
+        Args:
+            max_entries: 内存窗口大小（仅影响 entries，不影响数据库中保存的条数）
+            db_file: 可选，数据库文件路径
+        """
+        self.db_file = Path(db_file) if db_file else self.DB_FILE
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        super().__init__(max_entries=max_entries)
+
+    # -----------------------------
+    # 连接与建表
+    # -----------------------------
+    def _connect(self) -> sqlite3.Connection:
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        try:
+            conn.executescript(_FTS_SCHEMA.format(tokenizer="trigram"))
+            self.fts_tokenizer = "trigram"
+        except sqlite3.OperationalError:
+            # SQLite < 3.34 不支持 trigram，退回 unicode61
+            logger.warning("[SQLiteChatHistory] 当前 SQLite 不支持 trigram 分词，退回 unicode61")
+            conn.executescript(_FTS_SCHEMA.format(tokenizer="unicode61"))
+            self.fts_tokenizer = "unicode61"
+        conn.commit()
+        self._migrate_json_history(conn)
+        return conn
+
+    def _migrate_json_history(self, conn: sqlite3.Connection) -> None:
+        """
+        存在旧版 JSON 历史时一次性导入，完成后在 meta 表中记录标记
+        以标记而不是"表为空"判断，清空历史后重启不会再次导入；JSON 文件保留，便于切回 json 后端
+        """
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        if not self.HISTORY_FILE.exists() or conn.execute("SELECT 1 FROM turns LIMIT 1").fetchone():
+            # 没有旧文件，或加标记之前的版本已经导入过
+            self._mark_json_migrated(conn)
+            return
+        try:
+            with open(self.HISTORY_FILE, "r", encoding="utf-8") as f:
+                old_entries = json.load(f)
+        except Exception as e:
+            logger.warning(f"[SQLiteChatHistory] 读取旧版 JSON 历史失败: {e}")
+            return
+        if not isinstance(old_entries, list):
+            self._mark_json_migrated(conn)
+            return
+        conn.executemany(
+            "INSERT INTO turns(timestamp, session, model, user, assistant) VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    e.get("timestamp") or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    e.get("session") or "default",
+                    e.get("model"),
+                    e.get("user", ""),
+                    e.get("assistant", ""),
+                )
+                for e in old_entries if isinstance(e, dict)
+            ],
+        )
+        self._mark_json_migrated(conn)  # 与导入的数据在同一事务中提交
+        logger.info(f"[SQLiteChatHistory] 已从 {self.HISTORY_FILE} 导入 {len(old_entries)} 条历史记录")
+
+    @staticmethod
+    def _mark_json_migrated(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO meta(key, value) VALUES ('json_migrated', ?)",
+            (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),),
+        )
+        conn.commit()
+
+    # -----------------------------
+    # ChatHistory 接口
+    # -----------------------------
+    def add_entry(self, user: str, assistant: str, model: Optional[str] = None, session: Optional[str] = None,
+                  usage: Optional[Dict[str, Any]] = None) -> None:
+        """
+        添加一条对话记录（立即写入数据库）
+
+        Args:
+            user: 用户输入文本
+            assistant: 模型回复文本
+            model: 可选，生成该回复的模型
+            session: 可选，会话 / 剧情线标识
+            usage: 可选，上游返回的 token 用量（prompt / completion / cached / reasoning tokens 与 cost）
+        """
+        entry = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "session": session or "default",
+            "model": model,
+            "user": user.strip(),
+            "assistant": assistant.strip(),
+        }
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO turns(timestamp, session, model, user, assistant) VALUES (?, ?, ?, ?, ?)",
+                (entry["timestamp"], entry["session"], entry["model"], entry["user"], entry["assistant"]),
+            )
+            if usage:
+                self._conn.execute(
+                    "INSERT INTO turn_usage(turn_id, prompt_tokens, completion_tokens, cached_tokens, reasoning_tokens, cost) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cur.lastrowid, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                     usage.get("cached_tokens", 0), usage.get("reasoning_tokens", 0), usage.get("cost")),
+                )
+            self._conn.commit()
+        entry["id"] = cur.lastrowid
+        if usage:
+            entry["usage"] = usage
+        self.entries.append(entry)
+        if len(self.entries) > self.max_entries:
+            self.entries = self.entries[-self.max_entries:]
+        self._touch()
+
+    def save_history(self) -> None:
+        """每次写入都已提交，这里只做 WAL checkpoint"""
+        try:
+            with self._lock:
+                self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except Exception as e:
+            logger.warning(f"[SQLiteChatHistory] checkpoint 失败: {e}")
+
+    def load_history(self) -> None:
+        """从数据库加载最近 max_entries 条到内存"""
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, timestamp, session, model, user, assistant FROM turns ORDER BY id DESC LIMIT ?",
+                    (self.max_entries,),
+                ).fetchall()
+            self.entries = [dict(r) for r in reversed(rows)]
+        except Exception as e:
+            logger.warning(f"[SQLiteChatHistory] 加载历史失败: {e}")
+            self.entries = []
+        self._touch()
+
+    def entries_after(self, after_id: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """从数据库读取 id 大于 after_id 的记录（不受内存窗口限制）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, timestamp, session, model, user, assistant FROM turns WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, -1 if limit is None else limit),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def save_summaries(self) -> None:
+        """用内存中的摘要整体替换 summaries 表（摘要条数有上限，开销很小）"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM summaries")
+                self._conn.executemany(
+                    "INSERT INTO summaries(tier, start_id, end_id, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    [(s["tier"], s["start_id"], s["end_id"], s["content"], s["timestamp"]) for s in self.summaries],
+                )
+
+    def load_summaries(self) -> None:
+        """从数据库加载分层摘要"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT tier, start_id, end_id, content, timestamp FROM summaries ORDER BY start_id"
+            ).fetchall()
+        self.summaries = [dict(r) for r in rows]
+
+    def clear_history(self) -> None:
+        """清空历史记录（删除数据库中所有对话与摘要）"""
+        self.entries = []
+        self.summaries = []
+        self._touch()
+        with self._lock:
+            self._conn.execute("DELETE FROM turns")
+            self._conn.execute("DELETE FROM summaries")
+            self._conn.commit()
+
+    def remove_last_entry(self) -> None:
+        """删除最后一条对话记录"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, timestamp, user FROM turns ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                logger.warning("[SQLiteChatHistory] 无法删除：当前没有任何历史记录。")
+                return
+            self._conn.execute("DELETE FROM turns WHERE id = ?", (row["id"],))
+            self._conn.commit()
+        logger.info(
+            f"[SQLiteChatHistory] 已删除最后一条记录，时间: {row['timestamp']}，"
+            f"用户内容: {row['user'][:30]}..."
+        )
+        self.load_history()
+
+    def is_empty(self) -> bool:
+        if self.entries:
+            return False
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM turns LIMIT 1").fetchone() is None
+
+    def count(self, session: Optional[str] = None) -> int:
+        """数据库中的对话总条数"""
+        with self._lock:
+            if session:
+                return self._conn.execute("SELECT COUNT(*) FROM turns WHERE session = ?", (session,)).fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+
+    def usage_summary(self, session: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按模型汇总 token 用量与费用，cache_hit_rate 为输入 token 中命中上游前缀缓存的比例"""
+        sql = (
+            "SELECT t.model AS model, COUNT(*) AS turns, SUM(u.prompt_tokens) AS prompt_tokens, "
+            "SUM(u.completion_tokens) AS completion_tokens, SUM(u.cached_tokens) AS cached_tokens, "
+            "SUM(u.reasoning_tokens) AS reasoning_tokens, SUM(u.cost) AS cost "
+            "FROM turn_usage u JOIN turns t ON t.id = u.turn_id"
+        )
+        params: tuple = ()
+        if session:
+            sql += " WHERE t.session = ?"
+            params = (session,)
+        with self._lock:
+            rows = self._conn.execute(sql + " GROUP BY t.model ORDER BY t.model", params).fetchall()
+        summary = [dict(r) for r in rows]
+        for item in summary:
+            prompt = item["prompt_tokens"] or 0
+            item["cache_hit_rate"] = round((item["cached_tokens"] or 0) / prompt, 4) if prompt else None
+        return summary
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # -----------------------------
+    # 全文检索
+    # -----------------------------
+    def search(
+            self,
+            query: str,
+            page: int = 1,
+            page_size: int = 20,
+            session: Optional[str] = None,
+            model: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        全文检索历史对话，按相关度排序（无可用全文词时按时间倒序）
+
+        Args:
+            query: 检索词，空格分隔多个词（AND）
+            page: 页码，从 1 开始
+            page_size: 每页条数
+            session: 可选，按会话过滤
+            model: 可选，按模型过滤
+        Returns:
+            dict: {"total", "page", "page_size", "items": [...]}
+        """
+        page = max(1, page)
+        page_size = max(1, min(page_size, 100))
+        terms = [t for t in query.split() if t]
+
+        fts_terms, like_terms = [], []
+        for t in terms:
+            if self.fts_tokenizer == "trigram" and len(t) < TRIGRAM_MIN_CHARS:
+                like_terms.append(t)
+            else:
+                fts_terms.append('"' + t.replace('"', '""') + '"')
+
+        where, params = [], []
+        if fts_terms:
+            where.append("turns_fts MATCH ?")
+            params.append(" AND ".join(fts_terms))
+        for t in like_terms:
+            where.append("(t.user LIKE ? ESCAPE '\\' OR t.assistant LIKE ? ESCAPE '\\')")
+            pattern = "%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            params += [pattern, pattern]
+        if session:
+            where.append("t.session = ?")
+            params.append(session)
+        if model:
+            where.append("t.model = ?")
+            params.append(model)
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+        if fts_terms:
+            from_sql = "FROM turns_fts JOIN turns t ON t.id = turns_fts.rowid"
+            select_sql = (
+                "SELECT t.id, t.timestamp, t.session, t.model, t.user, t.assistant, "
+                "snippet(turns_fts, -1, '[', ']', '…', 32) AS snippet"
+            )
+            order_sql = "ORDER BY bm25(turns_fts), t.id DESC"
+        else:
+            from_sql = "FROM turns t"
+            select_sql = "SELECT t.id, t.timestamp, t.session, t.model, t.user, t.assistant, NULL AS snippet"
+            order_sql = "ORDER BY t.id DESC"
+
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) {from_sql} {where_sql}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"{select_sql} {from_sql} {where_sql} {order_sql} LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size],
+            ).fetchall()
+
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "items": [dict(r) for r in rows],
+        }
+
+    def related_entries(self, query: str, limit: int = 3, exclude_ids=()) -> List[Dict[str, Any]]:
+        """
+        召回与 query 相关的记录，供 HistoryRetriever 注入 prompt；不受内存窗口限制
+        query 为自然语言输入，切成检索词后任一命中即可：
+        - 先按 FTS5 相关度（bm25）召回（trigram 分词时为相邻三字）
+        - 不足 limit 条时，再用双字词在最近 RELATED_LIKE_SCAN_ROWS 条中按命中词数补充（双字无法走 trigram 索引）
+
+        Args:
+            query: 当前用户输入
+            limit: 最多返回条数
+            exclude_ids: 不需要返回的记录 id（如已作为最近对话注入的记录）
+        """
+        if limit <= 0:
+            return []
+        fts_terms, like_terms = _related_terms(query, self.fts_tokenizer)
+        exclude = [i for i in exclude_ids if i is not None]
+        rows: List[sqlite3.Row] = []
+        with self._lock:
+            if fts_terms:
+                exclude_sql = f"AND t.id NOT IN ({', '.join('?' * len(exclude))})" if exclude else ""
+                rows = self._conn.execute(
+                    "SELECT t.id, t.timestamp, t.session, t.model, t.user, t.assistant "
+                    f"FROM turns_fts JOIN turns t ON t.id = turns_fts.rowid WHERE turns_fts MATCH ? {exclude_sql} "
+                    "ORDER BY bm25(turns_fts) LIMIT ?",
+                    [" OR ".join(fts_terms), *exclude, limit],
+                ).fetchall()
+            if like_terms and len(rows) < limit:
+                skip = exclude + [r["id"] for r in rows]
+                skip_sql = f"AND id NOT IN ({', '.join('?' * len(skip))})" if skip else ""
+                hits_sql = " + ".join("(instr(user || assistant, ?) > 0)" for _ in like_terms)
+                rows += self._conn.execute(
+                    f"SELECT id, timestamp, session, model, user, assistant, {hits_sql} AS hits FROM turns "
+                    f"WHERE id > (SELECT COALESCE(MAX(id), 0) FROM turns) - ? {skip_sql} AND hits > 0 "
+                    "ORDER BY hits DESC, id DESC LIMIT ?",
+                    [*like_terms, RELATED_LIKE_SCAN_ROWS, *skip, limit - len(rows)],
+                ).fetchall()
+        return [{k: r[k] for k in ("id", "timestamp", "session", "model", "user", "assistant")} for r in rows]
+
+
+# 自然语言输入切分检索词的上限（输入过长时只取前面部分，控制查询开销）
+MAX_RELATED_TERMS = 48
+MAX_RELATED_LIKE_TERMS = 16
+RELATED_LIKE_SCAN_ROWS = 5000  # 双字词补充召回时扫描的最近记录条数
+_CJK_RUN = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+_WORD = re.compile(r"[A-Za-z0-9_]+")
+_STOP_CHARS = set("的了是在我你他她它们这那就也都和与着过吗呢吧啊么之而哪里")
+
+
+def _related_terms(query: str, tokenizer: str) -> tuple[List[str], List[str]]:
+    """
+    把自然语言输入切分为 (FTS 短语, 双字词)
+    trigram 分词时中文取相邻三字、英文取 3 个字符以上的单词，另取不含虚词的相邻双字；
+    unicode61 时直接取中文片段与单词，不需要双字补充
+    """
+    fts_terms: List[str] = []
+    like_terms: List[str] = []
+    for run in _CJK_RUN.findall(query):
+        if tokenizer == "trigram":
+            fts_terms.extend(run[i:i + TRIGRAM_MIN_CHARS] for i in range(len(run) - TRIGRAM_MIN_CHARS + 1))
+            like_terms.extend(
+                run[i:i + 2] for i in range(len(run) - 1) if not (_STOP_CHARS & set(run[i:i + 2]))
+            )
+        else:
+            fts_terms.append(run)
+    fts_terms.extend(w for w in _WORD.findall(query) if tokenizer != "trigram" or len(w) >= TRIGRAM_MIN_CHARS)
+    fts_terms = list(dict.fromkeys(fts_terms))[:MAX_RELATED_TERMS]
+    like_terms = list(dict.fromkeys(like_terms))[:MAX_RELATED_LIKE_TERMS]
+    return ['"' + t.replace('"', '""') + '"' for t in fts_terms], like_terms
+
+if __name__ == "__main__":
+    history = SQLiteChatHistory()
+    print(f"共 {history.count()} 条历史记录")
+    print(json.dumps(history.search("动态角色状态机", page_size=3), ensure_ascii=False, indent=2))
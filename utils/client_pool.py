@@ -0,0 +1,89 @@
+# utils/client_pool.py
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class _PooledClient:
+    __slots__ = ("client", "leases", "retired")
+
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.leases = 0
+        self.retired = False
+
+
+class ClientPool:
+    """
+    按 provider（client_name）划分的 httpx.AsyncClient 连接池
+
+    - 每个 provider 一个长连接池，跨请求复用
+    - 注册表热加载时只重建配置有变化的 provider：旧连接池标记为退役，
+      正在使用它的请求结束（租约归零）后再关闭，不会中断进行中的流
+    """
+
+    def __init__(self, client_factory: Callable[[], httpx.AsyncClient]):
+        self._factory = client_factory
+        self._clients: Dict[str, _PooledClient] = {}
+        self._retired: List[_PooledClient] = []
+
+    def _get(self, name: str) -> _PooledClient:
+        entry = self._clients.get(name)
+        if entry is None or entry.client.is_closed:
+            entry = _PooledClient(self._factory())
+            self._clients[name] = entry
+        return entry
+
+    @asynccontextmanager
+    async def lease(self, name: str) -> AsyncIterator[httpx.AsyncClient]:
+        """借出某个 provider 的 client，退出时归还"""
+        entry = self._get(name)
+        entry.leases += 1
+        try:
+            yield entry.client
+        finally:
+            entry.leases -= 1
+            if entry.retired and entry.leases == 0:
+                await self._close(entry)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """直接获取 client（不计租约，适合短请求 / 预热）"""
+        return self._get(name).client
+
+    def refresh(self, names) -> None:
+        """让指定 provider 的连接池退役，下次借出时重新创建"""
+        for name in names:
+            entry = self._clients.pop(name, None)
+            if entry is None:
+                continue
+            entry.retired = True
+            if entry.leases == 0:
+                asyncio.get_running_loop().create_task(self._close(entry))
+            else:
+                self._retired.append(entry)
+            logger.info(f"[ClientPool] provider {name} 配置已变化，连接池将重建")
+
+    async def _close(self, entry: _PooledClient) -> None:
+        if entry in self._retired:
+            self._retired.remove(entry)
+        if not entry.client.is_closed:
+            await entry.client.aclose()
+
+    def in_flight(self) -> int:
+        """当前借出的租约总数"""
+        return sum(e.leases for e in self._clients.values()) + sum(e.leases for e in self._retired)
+
+    async def aclose(self) -> None:
+        """关闭全部连接池（停机时调用）"""
+        entries = list(self._clients.values()) + list(self._retired)
+        self._clients.clear()
+        self._retired.clear()
+        for entry in entries:
+            if not entry.client.is_closed:
+                await entry.client.aclose()
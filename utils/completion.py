@@ -0,0 +1,72 @@
+# utils/completion.py
+"""
+非流式调用上游（OpenAI 兼容接口）的公共部分
+
+服务端的后台任务（历史压缩）与离线批量生成（utils/batch_runner.py）共用，
+请求头、payload 与返回解析只维护一份。
+"""
+import httpx
+
+
+def completion_headers(client_settings: dict) -> dict:
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {client_settings['api_key']}",
+    }
+
+
+async def post_completion(client: httpx.AsyncClient, client_settings: dict, model_label: str,
+                          messages: list[dict], **options) -> dict:
+    """
+    发送一次非流式请求并返回解析后的 JSON，非 2xx 时抛出 httpx.HTTPStatusError
+
+    Args:
+        options: 额外的 payload 字段（如 temperature），值为 None 的字段不发送
+    """
+    payload = {"model": model_label, "stream": False, "messages": messages}
+    payload.update({k: v for k, v in options.items() if v is not None})
+    response = await client.post(client_settings["base_url"], headers=completion_headers(client_settings), json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+def completion_text(data: dict) -> str:
+    """拼接返回中全部 choice 的文本"""
+    return "".join(
+        choice.get("message", {}).get("content") or choice.get("text") or ""
+        for choice in data.get("choices", [])
+    )
+
+
+def completion_usage(data: dict) -> dict | None:
+    """
+    读取上游返回的 token 用量，统一为 {"prompt_tokens", "completion_tokens", "cached_tokens", "reasoning_tokens"}
+    兼容 OpenAI 风格的 usage（含 DeepSeek 的 prompt_cache_hit_tokens）与 Gemini 风格的 usageMetadata；
+    未返回时为 None。流式响应中同样适用（OpenAI 在最后一个 chunk 返回，Gemini 每个 chunk 返回累计值）
+    """
+    usage = data.get("usage")
+    if usage:
+        prompt_details = usage.get("prompt_tokens_details") or {}
+        completion_details = usage.get("completion_tokens_details") or {}
+        return {
+            "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+            "completion_tokens": int(usage.get("completion_tokens") or 0),
+            "cached_tokens": int(prompt_details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0),
+            "reasoning_tokens": int(completion_details.get("reasoning_tokens") or 0),
+        }
+    usage = data.get("usageMetadata")
+    if usage:
+        return {
+            "prompt_tokens": int(usage.get("promptTokenCount") or 0),
+            "completion_tokens": int(usage.get("candidatesTokenCount") or 0),
+            "cached_tokens": int(usage.get("cachedContentTokenCount") or 0),
+            "reasoning_tokens": int(usage.get("thoughtsTokenCount") or 0),
+        }
+    return None
+
+
+def cache_hit_rate(usage: dict | None) -> float:
+    """输入 token 中命中上游前缀缓存的比例（0 ~ 1）"""
+    if not usage or not usage.get("prompt_tokens"):
+        return 0.0
+    return min(1.0, usage.get("cached_tokens", 0) / usage["prompt_tokens"])
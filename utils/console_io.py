@@ -0,0 +1,122 @@
+# utils/console_io.py
+"""
+异步控制台输入
+
+input() 会阻塞事件循环，正在进行的流式输出、超时处理都会停住。
+这里用一个后台线程读取 stdin，每行通过 call_soon_threadsafe 放入 asyncio.Queue，
+协程中 await console.readline() 即可，不阻塞事件循环。
+
+生成过程中按回车可以中断当前生成（见 run_cancellable）。
+"""
+import asyncio
+import sys
+import threading
+from typing import Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class AsyncConsole:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdin
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_started(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._reader, name="console-reader", daemon=True)
+            self._thread.start()
+        return self._queue
+
+    def _reader(self) -> None:
+        while True:
+            line = self.stream.readline()
+            loop, queue = self._loop, self._queue
+            if loop is None or loop.is_closed():
+                return
+            # 读到 EOF 时放入 None
+            loop.call_soon_threadsafe(queue.put_nowait, line.rstrip("\n") if line else None)
+            if not line:
+                return
+
+    async def readline(self, prompt: str = "") -> str:
+        """读取一行（不含换行符）；stdin 结束时抛出 EOFError"""
+        queue = self._ensure_started()
+        if prompt:
+            print(prompt, end="", flush=True)
+        line = await queue.get()
+        if line is None:
+            raise EOFError
+        return line
+
+    async def read_block(self, end_marker: str = "END", blank_lines: int = 1) -> str:
+        """
+        读取多行输入：遇到 end_marker 或连续 blank_lines 个空行结束
+        """
+        lines = []
+        empty = 0
+        while True:
+            line = await self.readline()
+            if line.strip() == end_marker:
+                break
+            if line.strip() == "":
+                empty += 1
+                if empty >= blank_lines:
+                    break
+                continue
+            empty = 0
+            lines.append(line)
+        return "\n".join(lines).strip()
+
+    def drain(self) -> None:
+        """丢弃已缓存但尚未读取的输入"""
+        if self._queue is not None:
+            while not self._queue.empty():
+                if self._queue.get_nowait() is None:
+                    # 保留 EOF 标记，后续 readline 仍能感知输入结束
+                    self._queue.put_nowait(None)
+                    return
+
+    async def run_cancellable(self, coro: Awaitable[T]) -> tuple[bool, Optional[T]]:
+        """
+        运行 coro，期间按回车即取消
+
+        Returns:
+            (是否完成, 结果)；被取消时返回 (False, None)
+        """
+        queue = self._ensure_started()
+        self.drain()
+        task = asyncio.ensure_future(coro)
+        key = asyncio.ensure_future(queue.get())
+        try:
+            done, _ = await asyncio.wait({task, key}, return_when=asyncio.FIRST_COMPLETED)
+            if task not in done and key.result() is None:
+                # stdin 已结束（如管道输入），无法再中断，等待生成完成
+                queue.put_nowait(None)
+                await task
+                done = {task}
+        finally:
+            if not key.done():
+                key.cancel()
+        if task in done:
+            return True, task.result()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return False, None
+
+
+# 默认实例：同一进程只需要一个 stdin 读取线程
+console = AsyncConsole()
+
+
+async def ainput(prompt: str = "") -> str:
+    """input() 的异步版本"""
+    return await console.readline(prompt)
@@ -0,0 +1,181 @@
+# utils/history_compactor.py
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_TIER_NAMES = {1: "近期剧情", 2: "中期剧情", 3: "远期剧情"}
+
+
+class HistoryCompactor:
+    """
+    后台滚动摘要：把较早的对话折叠为分层剧情摘要
+
+    规则：
+    - 最近 keep_recent 条原始对话不参与压缩（直接传给模型）
+    - 更早、尚未被摘要覆盖的对话每满 chunk_size 条，生成一条 1 级摘要
+    - 某一级摘要超过 fanout 条时，把最早的 fanout 条合并为上一级摘要
+    - 最高级（max_tier）摘要超过 fanout 条时在同级内合并
+    因此摘要总条数不超过 fanout * max_tier，上下文大小有上界
+
+    每次唤醒最多执行 max_steps 步（每步一次摘要调用），积压的对话在之后的唤醒中继续处理；
+    数据库读写在线程中执行，不阻塞事件循环
+    """
+
+    def __init__(
+            self,
+            chat_history,
+            summarize: Callable[[str, int], Awaitable[str]],
+            chunk_size: int = 8,
+            fanout: int = 4,
+            max_tier: int = 3,
+            keep_recent: int = 10,
+            interval: float = 60.0,
+            max_steps: int = 4,
+    ):
+        """
+        Args:
+            chat_history: ChatHistory / SQLiteChatHistory 对象
+            summarize: 异步摘要函数 (待压缩文本, 目标层级) -> 摘要文本
+            chunk_size: 每条 1 级摘要覆盖的原始对话条数
+            fanout: 每一级最多保留的摘要条数
+            max_tier: 最高摘要层级
+            keep_recent: 不参与压缩的最近对话条数
+            interval: 后台检查间隔（秒）
+            max_steps: 每次唤醒最多执行的压缩步数（即摘要调用次数）
+        """
+        self.chat_history = chat_history
+        self.summarize = summarize
+        self.chunk_size = chunk_size
+        self.fanout = fanout
+        self.max_tier = max_tier
+        self.keep_recent = keep_recent
+        self.interval = interval
+        self.max_steps = max_steps
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    # -----------------------------
+    # 生命周期
+    # -----------------------------
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="history-compactor")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def notify(self) -> None:
+        """有新对话写入时调用，提前唤醒后台任务"""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                for _ in range(self.max_steps):
+                    if not await self.compact_once():
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("[HistoryCompactor] 压缩历史失败，稍后重试")
+
+    # -----------------------------
+    # 压缩逻辑
+    # -----------------------------
+    def _covered_until(self) -> int:
+        return max((s.get("end_id", 0) for s in self.chat_history.summaries), default=0)
+
+    async def compact_once(self) -> bool:
+        """
+        执行一步压缩（生成一条 1 级摘要，或合并一次高层摘要）
+
+        Returns:
+            bool: 本次是否做了压缩
+        """
+        if await self._fold_tiers():
+            return True
+
+        # 只需判断是否已攒够 chunk_size 条（且之后还有 keep_recent 条），不读取全部积压
+        summaries = self.chat_history.summaries
+        pending = await asyncio.to_thread(
+            self.chat_history.entries_after, self._covered_until(), self.chunk_size + self.keep_recent,
+        )
+        if len(pending) - self.keep_recent < self.chunk_size:
+            return False
+
+        batch = pending[:self.chunk_size]
+        text = "\n\n".join(
+            f"[{e.get('timestamp', '')}] 用户: {e.get('user', '')}\n助手: {e.get('assistant', '')}" for e in batch
+        )
+        content = (await self.summarize(text, 1)).strip()
+        if not content:
+            logger.warning("[HistoryCompactor] 摘要模型返回空内容，跳过本轮")
+            return False
+        # 摘要调用期间历史可能被清空 / 重新加载 / 删除，此时丢弃本次结果
+        if self.chat_history.summaries is not summaries or not await self._batch_unchanged(batch):
+            logger.info("[HistoryCompactor] 摘要期间历史已变化，丢弃本次结果")
+            return False
+
+        await self._replace([], self._make_summary(1, batch[0]["id"], batch[-1]["id"], content))
+        logger.info(f"[HistoryCompactor] 已压缩对话 {batch[0]['id']}-{batch[-1]['id']} 为 1 级摘要")
+        return True
+
+    async def _fold_tiers(self) -> bool:
+        for tier in range(1, self.max_tier + 1):
+            same_tier = sorted(
+                (s for s in self.chat_history.summaries if s.get("tier") == tier),
+                key=lambda s: s.get("start_id", 0),
+            )
+            if len(same_tier) <= self.fanout:
+                continue
+            group = same_tier[:self.fanout]
+            target_tier = min(tier + 1, self.max_tier)
+            text = "\n\n".join(s["content"] for s in group)
+            content = (await self.summarize(text, target_tier)).strip()
+            if not content:
+                return False
+            current = {id(s) for s in self.chat_history.summaries}
+            if any(id(s) not in current for s in group):
+                logger.info("[HistoryCompactor] 合并期间摘要已变化，丢弃本次结果")
+                return False
+            await self._replace(group, self._make_summary(target_tier, group[0]["start_id"], group[-1]["end_id"], content))
+            logger.info(f"[HistoryCompactor] 已合并 {len(group)} 条 {tier} 级摘要为 {target_tier} 级摘要")
+            return True
+        return False
+
+    async def _batch_unchanged(self, batch: List[Dict[str, Any]]) -> bool:
+        """batch 中的对话是否仍原样存在（按 id 与时间比对）"""
+        current = await asyncio.to_thread(self.chat_history.entries_after, batch[0]["id"] - 1, len(batch))
+        return [(e["id"], e.get("timestamp")) for e in current] == [(e["id"], e.get("timestamp")) for e in batch]
+
+    @staticmethod
+    def _make_summary(tier: int, start_id: int, end_id: int, content: str) -> Dict[str, Any]:
+        return {
+            "tier": tier,
+            "start_id": start_id,
+            "end_id": end_id,
+            "content": f"【{SUMMARY_TIER_NAMES.get(tier, '剧情')} {start_id}-{end_id}】{content}",
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    async def _replace(self, removed: List[Dict[str, Any]], added: Dict[str, Any]) -> None:
+        # 先在内存中整体替换（单步赋值，build_messages 读到的总是一致状态），再在线程中持久化
+        removed_ids = {id(s) for s in removed}
+        self.chat_history.summaries = [s for s in self.chat_history.summaries if id(s) not in removed_ids] + [added]
+        await asyncio.to_thread(self.chat_history.save_summaries)
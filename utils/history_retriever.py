@@ -0,0 +1,184 @@
+# utils/history_retriever.py
+
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import List, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 中日韩字符按单字 + 双字切分，其余按单词切分
+_CJK_RUN = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+_WORD = re.compile(r"[A-Za-z0-9_]+")
+# 高频虚词不作为单字词项，避免无关记录因“的/了”等被召回
+_STOP_CHARS = set("的了是在我你他她它们这那就也都和与着过吗呢吧啊么之而")
+_CJK_CHAR = re.compile(r"[　-ヿ㐀-䶿一-鿿豈-﫿＀-￯]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    适合中文的分词：CJK 连续片段输出单字与相邻双字，英文/数字输出小写单词
+    """
+    if not text:
+        return []
+    tokens: List[str] = []
+    for run in _CJK_RUN.findall(text):
+        tokens.extend(c for c in run if c not in _STOP_CHARS)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(w.lower() for w in _WORD.findall(text))
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算 token 数（不加载 tokenizer）：中文约 1 字 1 token，其余约 4 字符 1 token
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class HistoryRetriever:
+    """
+    基于 BM25 的历史记录检索器
+
+    功能：
+    - SQLite 后端（提供 related_entries）：候选来自数据库的 FTS5 索引，内存窗口之外的早期对话也能召回
+    - JSON 后端：对 ChatHistory.entries 建立内存倒排索引
+    - 根据 ChatHistory.version 增量同步：只对新增记录分词，删除的记录移出索引
+    - 按当前用户输入挑选最相关的 top-k 条历史，并受 token 预算约束
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: Dict[int, Tuple[Dict[str, Any], Counter, int]] = {}  # id(entry) -> (entry, 词频, 长度)
+        self._postings: Dict[str, Dict[int, int]] = {}  # 词 -> {doc_id: 词频}
+        self._total_len = 0
+        self._history_id: int | None = None
+        self._version: int | None = None
+        self._lock = threading.Lock()  # build_messages 在线程中调用，并发请求共用同一份内存索引
+
+    # -----------------------------
+    # 索引维护
+    # -----------------------------
+    def _add(self, entry: Dict[str, Any]) -> None:
+        doc_id = id(entry)
+        tf = Counter(tokenize(f"{entry.get('user', '')}\n{entry.get('assistant', '')}"))
+        length = sum(tf.values())
+        self._docs[doc_id] = (entry, tf, length)
+        self._total_len += length
+        for term, freq in tf.items():
+            self._postings.setdefault(term, {})[doc_id] = freq
+
+    def _remove(self, doc_id: int) -> None:
+        _, tf, length = self._docs.pop(doc_id)
+        self._total_len -= length
+        for term in tf:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(doc_id, None)
+            if not posting:
+                del self._postings[term]
+
+    def sync(self, chat_history) -> None:
+        """与 ChatHistory 同步索引（版本未变化时直接返回）"""
+        if self._history_id == id(chat_history) and self._version == chat_history.version:
+            return
+        if self._history_id != id(chat_history):
+            self._docs.clear()
+            self._postings.clear()
+            self._total_len = 0
+            self._history_id = id(chat_history)
+
+        current = {id(e): e for e in chat_history.entries}
+        # 索引中保存了 entry 的引用，id() 不会被复用；对象不同则视为新记录
+        for doc_id in [d for d, (e, _, _) in self._docs.items() if current.get(d) is not e]:
+            self._remove(doc_id)
+        added = 0
+        for doc_id, entry in current.items():
+            if doc_id not in self._docs:
+                self._add(entry)
+                added += 1
+        self._version = chat_history.version
+        if added:
+            logger.debug(f"[HistoryRetriever] 新增索引 {added} 条，共 {len(self._docs)} 条")
+
+    # -----------------------------
+    # 检索
+    # -----------------------------
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[float, Dict[str, Any]]]:
+        """返回 [(得分, entry)]，按得分从高到低"""
+        if not self._docs:
+            return []
+        n = len(self._docs)
+        avg_len = self._total_len / n if n else 0.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self._postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, freq in posting.items():
+                length = self._docs[doc_id][2]
+                norm = freq + self.k1 * (1 - self.b + self.b * length / avg_len) if avg_len else freq + self.k1
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (self.k1 + 1) / norm
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        return [(score, self._docs[doc_id][0]) for doc_id, score in ranked]
+
+    def select_entries(
+            self,
+            chat_history,
+            query: str,
+            top_k: int = 3,
+            token_budget: int = 3000,
+            keep_recent: int = 1,
+    ) -> List[Dict[str, Any]]:
+        """
+        挑选要注入 prompt 的历史记录
+
+        Args:
+            chat_history: ChatHistory 对象
+            query: 当前用户输入
+            top_k: 额外召回的相关记录条数上限
+            token_budget: 召回记录（不含最近记录）的 assistant 文本 token 预算
+            keep_recent: 始终保留最近几条，保证剧情连续
+        Returns:
+            list: 按时间顺序排列的 entry 列表
+        """
+        entries = chat_history.entries
+        if not entries:
+            return []
+
+        recent = entries[-keep_recent:] if keep_recent > 0 else []
+        if hasattr(chat_history, "related_entries"):
+            # 多取一些候选，超出 token 预算的跳过后仍有机会凑满 top_k
+            candidates = chat_history.related_entries(query, top_k * 2, exclude_ids=[e.get("id") for e in recent])
+            picked = self._within_budget(candidates, top_k, token_budget)
+            return sorted(recent + picked, key=lambda e: e.get("id", 0))
+
+        with self._lock:
+            self.sync(chat_history)
+            ranked = self.search(query, top_k + len(recent))
+        recent_ids = {id(e) for e in recent}
+        candidates = [entry for _, entry in ranked if id(entry) not in recent_ids]
+        chosen = recent_ids | {id(e) for e in self._within_budget(candidates, top_k, token_budget)}
+        return [e for e in entries if id(e) in chosen]
+
+    @staticmethod
+    def _within_budget(candidates: List[Dict[str, Any]], top_k: int, token_budget: int) -> List[Dict[str, Any]]:
+        """按相关度顺序挑选，最多 top_k 条，assistant 文本总量不超过 token_budget"""
+        picked, used = [], 0
+        for entry in candidates:
+            if len(picked) >= top_k:
+                break
+            cost = estimate_tokens(entry.get("assistant", ""))
+            if used + cost > token_budget:
+                continue
+            picked.append(entry)
+            used += cost
+        return picked
@@ -0,0 +1,50 @@
+# utils/http_cache.py
+
+import hashlib
+import time
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+
+def strong_etag(data: bytes) -> str:
+    """根据内容生成强 ETag"""
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    判断请求头 If-None-Match 是否命中 etag（支持 * 与逗号分隔的多个值，忽略弱校验前缀 W/）
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+# 进程启动标识：版本计数器重启后会归零，拼进 ETag 避免重启后误判 304
+BOOT_ID = format(time.time_ns(), "x")
+
+
+def version_etag(*parts) -> str:
+    """根据版本号 / mtime 等拼出弱 ETag（JSON 接口使用，无需计算内容哈希）"""
+    return 'W/"' + "-".join(str(p) for p in (BOOT_ID, *parts)) + '"'
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """If-None-Match 命中时返回 304，否则返回 None（调用方再构建响应体）"""
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
+def json_with_etag(content, etag: str) -> JSONResponse:
+    return JSONResponse(content, headers={"ETag": etag, "Cache-Control": "no-cache"})
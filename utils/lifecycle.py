@@ -0,0 +1,172 @@
+# utils/lifecycle.py
+"""
+服务生命周期：启动预热就绪 + 停机排空（graceful drain）
+
+启动后：预热（提示词、人物、tokenizer、密钥、上游连接）完成前 /readyz 返回未就绪
+
+收到 SIGTERM 后：
+1. 立即进入排空状态：/readyz 返回未就绪，新的 /chat 请求返回 503 + Retry-After
+2. 等待进行中的生成结束，最多等待 DRAIN_GRACE_SECONDS 秒
+3. 再交给 uvicorn 原有的信号处理继续停机（lifespan 关闭阶段等待后台历史写入完成、落盘历史、关闭连接池）
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+DRAIN_GRACE_SECONDS = float(os.getenv("DRAIN_GRACE_SECONDS", "20"))  # 进行中请求的最长等待时间
+RETRY_AFTER_SECONDS = int(os.getenv("DRAIN_RETRY_AFTER", "5"))  # 503 响应建议的重试间隔
+# 为 true 时，任一上游不可达即视为未就绪；默认只报告不阻塞
+REQUIRE_PROVIDERS = os.getenv("READINESS_REQUIRE_PROVIDERS", "false").lower() == "true"
+
+
+class Lifecycle:
+    """记录预热 / 排空状态与进行中的请求数"""
+
+    def __init__(self):
+        self.draining = False
+        self.in_flight = 0
+        self.warmed_up = False
+        self.warm_up_steps: Dict[str, str] = {}  # 步骤 -> "ok" / 错误信息
+        self.providers: Dict[str, dict] = {}  # client_name -> {"reachable", "latency_ms", "error", "checked_at"}
+        self._idle: Optional[asyncio.Event] = None
+        self._drain_task: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()  # 响应结束后仍需完成的任务（如历史写入）
+
+    # -----------------------------
+    # 就绪状态
+    # -----------------------------
+    def mark_warm(self, steps: Dict[str, str]) -> None:
+        self.warm_up_steps = dict(steps)
+        self.warmed_up = True
+        logger.info(f"[Lifecycle] 预热完成: {steps}")
+
+    def set_provider_status(self, name: str, reachable: bool, latency_ms: float | None = None,
+                            error: str | None = None) -> None:
+        self.providers[name] = {
+            "reachable": reachable,
+            "latency_ms": latency_ms,
+            "error": error,
+            "checked_at": time.time(),
+        }
+
+    def readiness(self) -> tuple[bool, dict]:
+        """返回 (是否就绪, 报告)"""
+        if self.draining:
+            status = "draining"
+        elif not self.warmed_up:
+            status = "warming_up"
+        elif REQUIRE_PROVIDERS and not all(p["reachable"] for p in self.providers.values()):
+            status = "provider_unreachable"
+        else:
+            status = "ready"
+        return status == "ready", {
+            "status": status,
+            "in_flight": self.in_flight,
+            "warm_up": self.warm_up_steps,
+            "providers": self.providers,
+        }
+
+    def _idle_event(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if self.in_flight == 0:
+                self._idle.set()
+        return self._idle
+
+    @asynccontextmanager
+    async def track(self) -> AsyncIterator[None]:
+        """包住一次生成（流式响应需在生成器内部使用），退出时计数减一"""
+        self.in_flight += 1
+        self._idle_event().clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle_event().set()
+
+    def track_task(self, task: asyncio.Task) -> asyncio.Task:
+        """登记不在响应路径上、但停机前必须完成的后台任务"""
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def wait_background(self, timeout: float = DRAIN_GRACE_SECONDS) -> bool:
+        """等待已登记的后台任务完成；超时返回 False"""
+        if not self._background:
+            return True
+        _, pending = await asyncio.wait(list(self._background), timeout=timeout)
+        if pending:
+            logger.warning(f"[Lifecycle] 等待后台任务超时（{timeout}s），仍有 {len(pending)} 个未完成")
+        return not pending
+
+    def begin_drain(self) -> None:
+        if not self.draining:
+            self.draining = True
+            logger.info(f"[Lifecycle] 开始排空，进行中的请求: {self.in_flight}")
+
+    async def wait_idle(self, timeout: float = DRAIN_GRACE_SECONDS) -> bool:
+        """等待进行中的请求全部结束；超时返回 False"""
+        try:
+            await asyncio.wait_for(self._idle_event().wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"[Lifecycle] 排空超时（{timeout}s），仍有 {self.in_flight} 个请求未结束")
+            return False
+
+    # -----------------------------
+    # 信号处理
+    # -----------------------------
+    def install_signal_handler(self, sig: int = signal.SIGTERM) -> None:
+        """
+        在 uvicorn 已注册的信号处理之前插入排空逻辑
+        须在 lifespan 启动阶段（事件循环内）调用
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            previous = signal.getsignal(sig)
+        except ValueError:
+            return  # 非主线程（例如测试客户端），不接管信号
+
+        def _forward(signum, frame):
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                signal.raise_signal(signum)
+
+        async def _drain_then_forward(signum, frame):
+            await self.wait_idle()
+            _forward(signum, frame)
+
+        def _start_drain(signum, frame):
+            self._drain_task = loop.create_task(_drain_then_forward(signum, frame))
+
+        def _handler(signum, frame):
+            if self.draining:
+                # 再次收到信号：不再等待，立即停机
+                _forward(signum, frame)
+                return
+            self.begin_drain()
+            loop.call_soon_threadsafe(_start_drain, signum, frame)
+
+        try:
+            signal.signal(sig, _handler)
+        except ValueError:
+            pass
+
+    async def shutdown(self, timeout: float = DRAIN_GRACE_SECONDS) -> None:
+        """lifespan 关闭阶段调用：未经信号触发时也先排空"""
+        self.begin_drain()
+        if self.in_flight:
+            await self.wait_idle(timeout)
+        await self.wait_background(timeout)
+
+
+lifecycle = Lifecycle()
@@ -0,0 +1,163 @@
+# utils/log_config.py
+"""
+服务端日志配置：QueueHandler + QueueListener
+
+- 业务代码只把日志记录放进内存队列，格式化与 stdout 写入都在后台线程完成，不阻塞事件循环
+- 默认输出 JSON 行（LOG_FORMAT=text 可改回文本格式）
+- 按类别采样：logger.info(..., extra={"category": "stream"})，采样率由 LOG_SAMPLE_RATES 配置，
+  如 "stream=0.01,tokens=0.1"；ERROR 及以上级别不采样
+- 所有字符串字段按 LOG_MAX_FIELD_CHARS 截断，避免整段 prompt / 原始流进入日志
+
+入口程序（main.py / app.py）启动时调用一次 setup_logging()，其余模块只使用 logging.getLogger(__name__)。
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from typing import Dict, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json / text
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "2000"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 队列满时丢弃新日志，不阻塞请求
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+# LogRecord 的标准属性，其余属性视为 extra 字段
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# 当前请求 ID（由 RequestIdMiddleware 设置），自动附加到每条日志
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """解析 "stream=0.01,tokens=0.1" 形式的采样配置"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(value)))
+        except ValueError:
+            continue
+    return rates
+
+
+def clip(value, limit: int = LOG_MAX_FIELD_CHARS):
+    """截断过长的字符串，保留长度信息"""
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}...<截断，共 {len(value)} 字符>"
+    return value
+
+
+class SamplingFilter(logging.Filter):
+    """按 record.category 采样；未配置的类别全部保留"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        rate = self.rates.get(getattr(record, "category", ""), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """一条记录输出一行 JSON，extra 字段一并输出，字符串字段按上限截断"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": clip(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key in _RESERVED or key.startswith("_"):
+                continue
+            if not isinstance(value, (str, int, float, bool, type(None))):
+                try:
+                    value = json.dumps(value, ensure_ascii=False, default=str)
+                except Exception:
+                    value = repr(value)
+            data[key] = clip(value)
+        if record.exc_info:
+            data["exc"] = clip(self.formatException(record.exc_info), LOG_MAX_FIELD_CHARS * 4)
+        elif record.exc_text:
+            data["exc"] = clip(record.exc_text, LOG_MAX_FIELD_CHARS * 4)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """文本格式，消息同样截断"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.msg = clip(record.getMessage())
+        record.args = None
+        return super().format(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    只在调用线程合并 msg % args（参数可能随后被修改），格式化留给监听线程
+    队列满时丢弃，不阻塞调用方
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not hasattr(record, "request_id"):
+            request_id = request_id_var.get()
+            if request_id != "-":
+                record.request_id = request_id
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT) -> logging.handlers.QueueListener:
+    """配置根 logger（可重复调用，只生效一次）"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging() -> None:
+    """停机时调用：写出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,245 @@
+# utils/loop_watchdog.py
+"""
+事件循环延迟（lag）看门狗
+
+- 心跳协程每隔 interval 休眠一次，实际醒来时间与预期之差即调度延迟，计入直方图
+- 独立的监视线程检查心跳：超过阈值仍未醒来，说明事件循环正被同步代码阻塞，
+  此时抓取事件循环线程的调用栈，连同当前请求 ID 写入日志（每次阻塞只抓取一次）
+- 直方图与最近的阻塞记录通过 snapshot() 导出（main.py 的 /debug/loop_lag）
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+import weakref
+from collections import deque
+from typing import Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from utils.log_config import request_id_var
+
+logger = logging.getLogger(__name__)
+
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "true").lower() == "true"
+LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))  # 超过该阻塞时长才抓取调用栈
+HEARTBEAT_MS = float(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "50"))
+
+# 直方图桶上限（毫秒），最后一个桶为 +Inf
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class LagHistogram:
+    """累积直方图（Prometheus 风格的桶计数）"""
+
+    def __init__(self, buckets=LAG_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, lag_ms: float) -> None:
+        self.count += 1
+        self.total_ms += lag_ms
+        self.max_ms = max(self.max_ms, lag_ms)
+        for i, bound in enumerate(self.buckets):
+            if lag_ms <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """按桶上限估算分位数"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return float(self.buckets[i]) if i < len(self.buckets) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        labels = [f"le_{b}" for b in self.buckets] + ["le_inf"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+def _active_task(loop: asyncio.AbstractEventLoop) -> Optional[asyncio.Task]:
+    """从其他线程读取事件循环当前正在执行的任务（只读，尽力而为）"""
+    try:
+        return asyncio.tasks._current_tasks.get(loop)  # noqa: SLF001
+    except Exception:
+        return None
+
+
+class LoopWatchdog:
+    def __init__(self, threshold_ms: float = LAG_THRESHOLD_MS, interval_ms: float = HEARTBEAT_MS,
+                 max_stalls: int = 50):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.histogram = LagHistogram()
+        self.stalls: deque = deque(maxlen=max_stalls)  # 最近的阻塞记录
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._open_stall: Optional[dict] = None  # 已抓取、尚未结束的阻塞记录
+        # 任务 -> 请求 ID：监视线程读不到事件循环线程的 contextvar，
+        # 因此在创建任务时登记（子任务继承父任务的 request_id，如 StreamingResponse 的发送任务）
+        self._task_requests: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    # -----------------------------
+    # 请求登记
+    # -----------------------------
+    def bind_request(self, request_id: str) -> None:
+        """在处理请求的任务中调用：设置 request_id 并登记当前任务"""
+        request_id_var.set(request_id)
+        task = asyncio.current_task()
+        if task is not None:
+            self._task_requests[task] = request_id
+
+    def _install_task_factory(self, loop: asyncio.AbstractEventLoop) -> None:
+        previous = loop.get_task_factory()
+
+        def factory(loop, coro, **kwargs):
+            if previous is not None:
+                task = previous(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            context = kwargs.get("context")
+            request_id = context.get(request_id_var, "-") if context is not None else request_id_var.get()
+            if request_id != "-":
+                self._task_requests[task] = request_id
+            return task
+
+        loop.set_task_factory(factory)
+
+    # -----------------------------
+    # 启停
+    # -----------------------------
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._install_task_factory(self._loop)
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-watchdog")
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"[Watchdog] 已启动，阈值 {self.threshold * 1000:.0f}ms")
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    # -----------------------------
+    # 内部实现
+    # -----------------------------
+    async def _heartbeat(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.histogram.observe(lag * 1000)
+            self._last_beat = time.monotonic()
+            stall, self._open_stall = self._open_stall, None
+            if stall is not None:
+                stall["total_ms"] = round(lag * 1000, 1)  # 阻塞结束后补记总时长
+
+    def _monitor(self) -> None:
+        captured_for = None  # 已为哪次心跳抓取过调用栈
+        while not self._stop.wait(self.interval / 2):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or captured_for == beat:
+                continue
+            captured_for = beat
+            self._capture(blocked)
+
+    def _capture(self, blocked: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=20)) if frame is not None else ""
+        task = _active_task(self._loop) if self._loop is not None else None
+        request_id = self._task_requests.get(task, "-") if task is not None else "-"
+        record = {
+            "at": time.time(),
+            "blocked_ms": round(blocked * 1000, 1),  # 抓取调用栈时已阻塞的时长
+            "total_ms": None,
+            "request_id": request_id,
+            "task": task.get_name() if task is not None else None,
+            "stack": stack,
+        }
+        self.stalls.append(record)
+        self._open_stall = record
+        logger.warning(
+            "[Watchdog] 事件循环已阻塞 %.0fms，request_id=%s", record["blocked_ms"], request_id,
+            extra={"category": "watchdog", "request_id": request_id, "stack": stack},
+        )
+
+    def snapshot(self) -> dict:
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "interval_ms": self.interval * 1000,
+            "lag": self.histogram.to_dict(),
+            "stalls": list(self.stalls),
+        }
+
+
+loop_watchdog = LoopWatchdog()
+
+
+class RequestIdMiddleware:
+    """
+    为每个 HTTP 请求分配 request_id（优先使用请求头 X-Request-ID），
+    写入日志上下文与看门狗，并在响应头中返回
+    """
+
+    def __init__(self, app: ASGIApp, watchdog: LoopWatchdog = loop_watchdog):
+        self.app = app
+        self.watchdog = watchdog
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = ""
+        for key, value in scope.get("headers", []):
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:12]
+        self.watchdog.bind_request(request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_id)
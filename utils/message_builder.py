@@ -4,6 +4,13 @@ from utils.persona_loader import load_persona
 
 # MAX_HISTORY_ENTRIES = 1  # 最近几条对话传给模型
 
+# messages 布局：
+# legacy：原有顺序，历史以一条 assistant 消息插在当前输入之前
+# cache：按变化频率从低到高排列（规则 -> NSFW -> 人物 -> 长期摘要 -> 历史 -> 当前输入），
+#        人物按名称排序，历史按 user / assistant 轮次展开；开头的 system 消息逐轮不变，可命中上游的前缀缓存
+PROMPT_LAYOUTS = ("legacy", "cache")
+MAX_CACHE_BREAKPOINTS = 4  # Anthropic 每个请求最多 4 个 cache_control 断点
+
 def append_personas_to_messages(messages: list[dict], personas: list[str] | None) -> None:
     """
     将指定角色信息加载到 messages 中（作为 system message）
@@ -30,7 +37,12 @@ def build_messages(system_instructions: str,
                    web_input: str = "",
                    nsfw: bool = False,
                    max_history_entries: int = 10,
-                   optional_message: str = None):
+                   optional_message: str = None,
+                   retriever=None,
+                   retrieval_top_k: int = 3,
+                   retrieval_token_budget: int = 3000,
+                   long_term_summary: str = "",
+                   layout: str = "legacy"):
     """
     构建 messages 列表，供模型调用
     Args:
@@ -40,7 +52,15 @@ def build_messages(system_instructions: str,
         user_input: 用户输入
         web_input: 可选的 Web 前端输入（用于区分）
         optional_message: 可选消息，如果有值则插入
+        retriever: 可选，HistoryRetriever；传入时按相关度召回历史，而不是只取最近 N 条
+        retrieval_top_k: 额外召回的相关历史条数
+        retrieval_token_budget: 召回历史的 token 预算
+        long_term_summary: 可选，HistoryCompactor 生成的分层剧情摘要
+        layout: messages 布局，legacy 或 cache（见 PROMPT_LAYOUTS）
     """
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"未知的 messages 布局: {layout}")
+    cache_layout = layout == "cache"
     MAX_HISTORY_ENTRIES = max_history_entries
     messages = []
 
@@ -58,31 +78,73 @@ def build_messages(system_instructions: str,
 
     # ③ 出场人物
     if personas:
-        append_personas_to_messages(messages, personas)
+        # cache 布局下人物顺序与勾选顺序无关，同一组人物的前缀保持一致
+        append_personas_to_messages(messages, sorted(personas) if cache_layout else personas)
+
+    # ④ 长期剧情摘要（后台压缩生成，覆盖较早的对话）
+    if long_term_summary:
+        messages.append({"role": "system", "content": f"长期剧情摘要（按时间顺序）：\n{long_term_summary}"})
 
-    # ④ 历史摘要（仅当 chat_history 是有效对象时加载）
+    # ⑤ 历史摘要（仅当 chat_history 是有效对象时加载）
     if chat_history and hasattr(chat_history, "entries"):
-        history_entries = chat_history.entries[-MAX_HISTORY_ENTRIES:]
-        if history_entries:
+        if retriever is not None:
+            # 最近 N 条 + 与当前输入最相关的 top-k 条
+            history_entries = retriever.select_entries(
+                chat_history,
+                user_input,
+                top_k=retrieval_top_k,
+                token_budget=retrieval_token_budget,
+                keep_recent=MAX_HISTORY_ENTRIES,
+            )
+        else:
+            history_entries = chat_history.entries[-MAX_HISTORY_ENTRIES:]
+        if history_entries and cache_layout:
+            for e in history_entries:
+                if e.get("user"):
+                    messages.append({"role": "user", "content": e["user"]})
+                if e.get("assistant"):
+                    messages.append({"role": "assistant", "content": e["assistant"]})
+        elif history_entries:
             assistant_texts = [e.get("assistant") for e in history_entries if e.get("assistant")]
             if assistant_texts:
                 summary_text = "\n".join(assistant_texts)
                 summary_content = f"以下是历史信息：\n{summary_text}\n##"
                 messages.append({"role": "assistant", "content": summary_content})
 
-    # ⑤ 当前输入
+    # ⑥ 当前输入
     current_user_message = {
         "role": "user",
         "content": f"{web_input} 用户输入内容：{user_input}" if web_input else user_input
     }
     messages.append(current_user_message)
 
-    # ⑥ 可选插入消息
+    # ⑦ 可选插入消息
     if optional_message:  # 只有有值才插入
         messages.append({"role": "system", "content": optional_message})
 
     return messages
 
+
+def apply_cache_breakpoints(messages: list[dict], max_breakpoints: int = MAX_CACHE_BREAKPOINTS) -> list[dict]:
+    """
+    为开头连续的 system 消息加上 cache_control 断点（Anthropic 风格，content 改为分段格式），返回新列表，不修改传入的 messages
+    同一份 messages 可能同时发给多个 provider（/chat/compare、"auto" 重试），只在确认支持的模型上调用
+    DeepSeek / OpenAI / Gemini 的前缀缓存是自动的，无需标注，只要前缀稳定即可命中
+    """
+    leading = 0
+    while leading < len(messages) and messages[leading]["role"] == "system":
+        leading += 1
+    marked = range(max(0, leading - max_breakpoints), leading)  # 超出上限时保留最长的几个前缀
+    result = list(messages)
+    for i in marked:
+        message = messages[i]
+        result[i] = {
+            **message,
+            "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}],
+        }
+    return result
+
+
 if __name__ == "__main__":
     from utils.persona_loader import get_default_personas
     from utils.chat_history import ChatHistory
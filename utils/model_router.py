@@ -0,0 +1,149 @@
+# utils/model_router.py
+"""
+"auto" 伪模型的路由
+
+- 每次上游调用结束后记录：TTFT（首个内容片段的延迟）、输出速度、成功 / 失败，
+  按模型和 provider 各维护一份 EWMA（generate_reply 中调用 observe）
+- 选择时只看该 system_rule 的候选模型（config.models.AUTO_ROUTES）：
+  去掉超出费用上限的、处于熔断冷却期的，其余按预计耗时（TTFT + 预计输出长度 / 输出速度，再按错误率加权）排序
+- 连续失败或错误率过高时熔断一段时间；冷却结束后重新参与选择，成功一次即逐步恢复，再失败则再次熔断
+- 从未调用过的模型优先试一次；之后少量请求随机分给其他健康候选，让统计保持新鲜
+
+输出速度按流式片段数计算（大多数 provider 每个片段约一个 token），只用于模型之间的相对比较。
+"""
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config.models import AUTO_MAX_COST_PER_REQUEST, AUTO_ROUTES, estimate_cost
+
+EWMA_ALPHA = float(os.getenv("AUTO_EWMA_ALPHA", "0.3"))
+EXPLORE_RATE = float(os.getenv("AUTO_EXPLORE_RATE", "0.05"))
+FAILURES_TO_TRIP = 3  # 连续失败多少次后熔断
+MAX_ERROR_RATE = 0.5  # 错误率 EWMA 超过该值时，下一次失败即熔断
+COOLDOWN_SECONDS = float(os.getenv("AUTO_COOLDOWN_SECONDS", "30"))
+ERROR_PENALTY = 4.0  # 预计耗时按 (1 + 错误率 * ERROR_PENALTY) 加权
+EXPECTED_OUTPUT_TOKENS = 800  # 估算耗时与费用时假设的输出长度
+PRIOR_TTFT_MS = 1500.0  # 只有失败记录、尚无成功样本时使用的先验值
+PRIOR_TPS = 30.0
+
+
+def _ewma(old: Optional[float], new: float) -> float:
+    return new if old is None else old + EWMA_ALPHA * (new - old)
+
+
+class EndpointStats:
+    """单个模型或 provider 的实时统计"""
+
+    def __init__(self):
+        self.ttft_ms: Optional[float] = None
+        self.tps: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def observe(self, ok: bool, ttft_ms: Optional[float] = None, tps: Optional[float] = None) -> None:
+        self.samples += 1
+        self.error_rate = _ewma(self.error_rate, 0.0 if ok else 1.0)
+        if ok:
+            self.consecutive_failures = 0
+            if ttft_ms is not None:
+                self.ttft_ms = _ewma(self.ttft_ms, ttft_ms)
+            if tps:
+                self.tps = _ewma(self.tps, tps)
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= FAILURES_TO_TRIP or self.error_rate > MAX_ERROR_RATE:
+            self.cooldown_until = time.monotonic() + COOLDOWN_SECONDS
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def expected_ms(self, output_tokens: int = EXPECTED_OUTPUT_TOKENS) -> float:
+        if not self.samples:
+            return 0.0  # 从未调用过的模型优先试一次
+        ttft = self.ttft_ms if self.ttft_ms is not None else PRIOR_TTFT_MS
+        tps = self.tps or PRIOR_TPS
+        return (ttft + output_tokens / tps * 1000) * (1 + self.error_rate * ERROR_PENALTY)
+
+    def to_dict(self) -> dict:
+        now = time.monotonic()
+        return {
+            "ttft_ms": round(self.ttft_ms, 1) if self.ttft_ms is not None else None,
+            "tps": round(self.tps, 2) if self.tps is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "samples": self.samples,
+            "consecutive_failures": self.consecutive_failures,
+            "cooldown_remaining_s": round(max(0.0, self.cooldown_until - now), 1),
+        }
+
+
+class ModelRouter:
+    def __init__(self, routes: Dict[str, List[str]] = AUTO_ROUTES,
+                 max_cost_per_request: float = AUTO_MAX_COST_PER_REQUEST):
+        self.routes = routes
+        self.max_cost = max_cost_per_request
+        self.models: Dict[str, EndpointStats] = {}
+        self.providers: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()  # observe 也可能在线程中调用（批量 / 后台任务）
+
+    def _stats(self, table: Dict[str, EndpointStats], name: str) -> EndpointStats:
+        stats = table.get(name)
+        if stats is None:
+            stats = table[name] = EndpointStats()
+        return stats
+
+    def observe(self, model_name: str, provider: str, ok: bool,
+                ttft_ms: Optional[float] = None, tps: Optional[float] = None) -> None:
+        """记录一次调用结果（失败时 ttft / tps 不计入）"""
+        with self._lock:
+            self._stats(self.models, model_name).observe(ok, ttft_ms, tps)
+            self._stats(self.providers, provider).observe(ok, ttft_ms, tps)
+
+    def candidates(self, system_rule: str) -> List[str]:
+        return self.routes.get(system_rule) or self.routes.get("*", [])
+
+    def rank(self, system_rule: str, registry, prompt_tokens: int = 0) -> List[str]:
+        """
+        返回按优先级排序的候选模型（第一个即本次选择），失败时调用方可依次改用后面的模型
+        全部候选都在熔断期时仍返回最早恢复的那个，不会返回空列表（除非没有可用候选）
+        """
+        now = time.monotonic()
+        scored = []
+        for order, name in enumerate(self.candidates(system_rule)):
+            details = registry.model(name)
+            if not details:
+                continue
+            if self.max_cost:
+                cost = estimate_cost(details, prompt_tokens, EXPECTED_OUTPUT_TOKENS)
+                if cost is None or cost > self.max_cost:
+                    continue
+            model = self._stats(self.models, name)
+            provider = self._stats(self.providers, details["client_name"])
+            healthy = model.healthy(now) and provider.healthy(now)
+            recover_at = max(model.cooldown_until, provider.cooldown_until)
+            # 排序键：健康优先 -> 预计耗时 -> 配置顺序
+            scored.append((not healthy, recover_at if not healthy else model.expected_ms(), order, name))
+        scored.sort()
+        ranked = [item[-1] for item in scored]
+        healthy = [item[-1] for item in scored if not item[0]]
+        if len(healthy) > 1 and random.random() < EXPLORE_RATE:
+            explore = random.choice(healthy[1:])
+            ranked.remove(explore)
+            ranked.insert(0, explore)
+        return ranked
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "routes": self.routes,
+                "max_cost_per_request": self.max_cost or None,
+                "models": {name: s.to_dict() for name, s in self.models.items()},
+                "providers": {name: s.to_dict() for name, s in self.providers.items()},
+            }
+
+
+model_router = ModelRouter()
@@ -3,43 +3,71 @@
 import asyncio
 import json
 import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import lru_cache
 from typing import AsyncGenerator
 
 import httpx
-import tiktoken
-from colorama import init
 
-from config.config import CLIENT_CONFIGS
-from config.models import model_registry
+from config.models import AUTO_MODEL, estimate_cost
+from config.registry import current_registry, on_registry_change
 from utils.chat_history import ChatHistory
-from utils.message_builder import build_messages
-from utils.print_messages_colored import print_messages_colored
-
-# -----------------------------
-# 初始化 colorama
-# -----------------------------
-init(autoreset=True)
+from utils.chat_history_sqlite import SQLiteChatHistory
+from prompt.get_system_prompt import preload_prompts
+from utils.client_pool import ClientPool
+from utils.completion import cache_hit_rate, completion_text, completion_usage, post_completion
+from utils.history_compactor import HistoryCompactor
+from utils.history_retriever import HistoryRetriever, estimate_tokens as estimate_text_tokens
+from utils.lifecycle import lifecycle
+from utils.log_config import clip
+from utils.message_builder import PROMPT_LAYOUTS, apply_cache_breakpoints, build_messages
+from utils.model_router import model_router
+from utils.persona_loader import load_personas
+from utils.stream_json import StreamingJsonBlockParser
+from utils.summary_extractor import StreamingSummaryExtractor
 
 # -----------------------------
 # 日志配置
 # -----------------------------
+# handler 由入口程序 setup_logging() 统一配置；热路径日志使用 % 参数延迟格式化
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 # -----------------------------
 # 全局变量
 # -----------------------------
-chat_history = ChatHistory(max_entries=50)  # 只保留最近 50 条对话
+HISTORY_BACKEND = os.getenv("CHAT_HISTORY_BACKEND", "sqlite")  # sqlite：全量保存 + 全文检索；json：旧版文件
+if HISTORY_BACKEND == "json":
+    chat_history = ChatHistory(max_entries=50)  # 只保留最近 50 条对话
+else:
+    chat_history = SQLiteChatHistory(max_entries=50)  # 内存保留最近 50 条，数据库保存全部
 MAX_HISTORY_ENTRIES = 1  # 最近几条对话传给模型
+USE_HISTORY_RETRIEVAL = True  # 按相关度额外召回历史（BM25，本地计算）
+RETRIEVAL_TOP_K = 3  # 额外召回的历史条数
+RETRIEVAL_TOKEN_BUDGET = 3000  # 召回历史的 token 预算
+history_retriever = HistoryRetriever()
+ENABLE_HISTORY_COMPACTION = True  # 后台把较早对话折叠为分层摘要
+COMPACTION_MODEL = "gemini-3-flash-preview"  # 摘要用的低价模型（DEFAULT_MODELS 中的 key）
 SAVE_STORY_SUMMARY_ONLY = True  # 只保存摘要，避免文件太大
 # SAVE_STORY_SUMMARY_ONLY = False  # 保存所有内容
-DEBUG_STREAM = False  # 是否打印原始流，调试用
+# messages 布局：legacy（默认）/ cache（稳定前缀在前，便于命中上游前缀缓存，见 utils/message_builder.py）
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "legacy").lower()
+if PROMPT_LAYOUT not in PROMPT_LAYOUTS:
+    logger.warning(f"未知的 PROMPT_LAYOUT={PROMPT_LAYOUT}，改用 legacy")
+    PROMPT_LAYOUT = "legacy"
+DEBUG_PROMPTS = os.getenv("DEBUG_PROMPTS", "false").lower() == "true"  # 是否把完整 messages 写入日志，调试用
+AUTO_MAX_ATTEMPTS = 2  # "auto" 模式下首个候选未输出内容就失败时，最多尝试几个模型
+# 本地 tiktoken 估算：fallback（默认，仅上游未返回 usage 时）/ always / off；均在线程中执行，不阻塞请求
+TOKEN_ESTIMATE = os.getenv("TOKEN_ESTIMATE", "fallback").lower()
+# 思考过程（reasoning 事件）单次请求最多转发的字符数；请求可指定更小的值，超出部分丢弃
+REASONING_MAX_CHARS = int(os.getenv("REASONING_MAX_CHARS", "8000"))
 
 # -----------------------------
 # 全局 HTTP Client & 并发控制
 # -----------------------------
-_async_client: httpx.AsyncClient | None = None
-_client_lock = asyncio.Lock()
 _stream_semaphore = asyncio.Semaphore(2)  # 同时最多 2 个流式请求，防止资源耗尽
 
 
@@ -52,102 +80,250 @@ def _build_timeout() -> httpx.Timeout:
     )
 
 
-async def get_async_client() -> httpx.AsyncClient:
-    global _async_client
-    async with _client_lock:
-        if _async_client is None or _async_client.is_closed:
-            _async_client = httpx.AsyncClient(timeout=_build_timeout())
-        return _async_client
+# 每个 provider 一个连接池；注册表热加载时只重建配置变化的 provider
+client_pool = ClientPool(lambda: httpx.AsyncClient(timeout=_build_timeout()))
+on_registry_change(lambda snapshot, changed: client_pool.refresh(changed))
 
 
 # -----------------------------
 # 工具函数
 # -----------------------------
-# 使用 tiktoken 计算总 token 数
-def total_tokens(messages, model_label: str):
+# tokenizer 按需加载（tiktoken 导入与 BPE 词表加载都较慢），同一模型只加载一次
+@lru_cache(maxsize=16)
+def get_encoding(model_label: str):
+    import tiktoken
     try:
-        encoding = tiktoken.encoding_for_model(model_label)
+        return tiktoken.encoding_for_model(model_label)
     except KeyError:
         logger.warning(f"模型 {model_label} 无法自动映射 tokenizer，使用 cl100k_base 估算")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def estimate_tokens(messages, output: str, model_label: str) -> None:
+    """
+    本地估算一轮的 token 数并写入日志（在线程中执行，不在请求路径上）
+    非 OpenAI 模型会退回 cl100k_base，结果只作参考，准确用量以上游返回的 usage 为准
+    """
+    try:
+        encoding = get_encoding(model_label)
+        prompt = sum(len(encoding.encode(msg.get("content", ""))) for msg in messages)
+        completion = len(encoding.encode(output))
+    except Exception as e:
+        logger.debug("[Token统计] 本地估算失败: %s", e, extra={"category": "tokens"})
+        return
+    logger.info("[Token统计] 本地估算 prompt=%d completion=%d", prompt, completion,
+                extra={"category": "tokens", "model": model_label, "prompt_tokens": prompt, "completion_tokens": completion})
+
+
+# 不需要等待结果的后台任务（保留引用，避免被垃圾回收）
+_background_tasks: set = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def _debug_log_messages(messages):
+    # 经日志队列在后台线程输出，单个字段按 LOG_MAX_FIELD_CHARS 截断
+    logger.info("[prompt] 构建好的 messages: %d 条", len(messages),
+                 extra={"category": "prompt", "payload": messages})
+
+
+# -----------------------------
+# 启动预热（后台执行，不阻塞启动）
+# -----------------------------
+# 上游连通性探测：READINESS_PROBE=connect（默认）发一次 HEAD 建立连接，off 跳过
+READINESS_PROBE = os.getenv("READINESS_PROBE", "connect").lower()
+PROBE_TIMEOUT = float(os.getenv("READINESS_PROBE_TIMEOUT", "5"))
+
+
+async def default_provider_probe(client: httpx.AsyncClient, settings: dict) -> None:
+    """
+    对 base_url 发 HEAD 请求，收到任何 HTTP 响应即视为可达
+    建立的 TCP / TLS 连接留在连接池中，首个真实请求可直接复用
+    """
+    await client.request("HEAD", settings["base_url"], timeout=PROBE_TIMEOUT)
+
+
+# 可替换为本地桩（测试 / 离线环境）：async probe(client, settings)，不可达时抛异常
+provider_probe = default_provider_probe
+
+
+def set_provider_probe(probe) -> None:
+    global provider_probe
+    provider_probe = probe
+
+
+async def probe_providers() -> dict:
+    """并发探测当前注册表中被模型引用的全部 provider，结果记录到 lifecycle"""
+    registry = current_registry()
+    names = sorted({m["client_name"] for m in registry.models.values()} & set(registry.clients))
+
+    async def _probe(name: str) -> None:
+        start = time.perf_counter()
+        try:
+            settings = registry.clients[name]
+            async with client_pool.lease(name) as client:
+                await provider_probe(client, settings)
+            lifecycle.set_provider_status(name, True, round((time.perf_counter() - start) * 1000, 1))
+        except Exception as e:
+            lifecycle.set_provider_status(name, False, error=f"{type(e).__name__}: {e}")
+
+    await asyncio.gather(*(_probe(name) for name in names))
+    return lifecycle.providers
+
+
+WARM_UP_STEPS = (
+    ("secrets", lambda: current_registry().clients.resolve_all()),
+    ("prompts", preload_prompts),
+    ("personas", load_personas),
+    ("tokenizer", lambda: get_encoding("cl100k_base") if TOKEN_ESTIMATE != "off" else None),
+)
+
+
+async def warm_up():
+    """
+    在线程中预读提示词 / 人物、解密密钥、加载 tokenizer，并预先建立上游连接
+    完成后 /readyz 才返回就绪；单个步骤失败只记录，首次使用时再加载
+    """
+    steps = {}
+    for name, func in WARM_UP_STEPS:
+        try:
+            await asyncio.to_thread(func)
+            steps[name] = "ok"
+        except Exception as e:
+            steps[name] = f"{type(e).__name__}: {e}"
+            logger.warning(f"[预热] {name} 失败，将在首次使用时加载: {e}")
+    if READINESS_PROBE != "off":
+        await probe_providers()
+        unreachable = [n for n, p in lifecycle.providers.items() if not p["reachable"]]
+        steps["providers"] = "ok" if not unreachable else f"unreachable: {unreachable}"
+    lifecycle.mark_warm(steps)
 
-    total = sum(len(encoding.encode(msg.get("content", ""))) for msg in messages)
-    logger.info(f"[Token统计] messages 总 token 数(估算): {total}")
-    return total
 
 # -----------------------------
 # 统一的流解析函数
 # -----------------------------
-def parse_stream_chunk(data_str: str) -> str | None:
+def _chunk_text(chunk: dict) -> str | None:
+    """从已解析的 chunk 中取出内容片段"""
+    # OpenAI 风格
+    if "choices" in chunk:
+        choices = chunk.get("choices")
+        # 防御性判断：必须是非空列表（include_usage 时最后一个 chunk 的 choices 为空）
+        if not isinstance(choices, list) or len(choices) == 0:
+            logger.debug("[空或非法 choices] %s", chunk, extra={"category": "stream"})
+            return None
+
+        choice = choices[0]
+        # 有些 chunk 只包含 finish_reason，不包含 delta
+        if "delta" not in choice:
+            logger.debug("[无 delta 字段] %s", chunk, extra={"category": "stream"})
+            return None
+
+        delta = choice.get("delta", {})
+        return delta.get("content")
+
+    # Gemini 风格
+    elif "candidates" in chunk:
+        candidates = chunk.get("candidates", [])
+        if not isinstance(candidates, list) or len(candidates) == 0:
+            logger.debug("[空 candidates] %s", chunk, extra={"category": "stream"})
+            return None
+
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(p.get("text", "") for p in parts if "text" in p and not p.get("thought"))
+
+    # 其他未知结构
+    if "usage" not in chunk and "usageMetadata" not in chunk:
+        logger.debug("[未知结构] %s", chunk, extra={"category": "stream"})
+    return None
+
+
+def _chunk_reasoning(chunk: dict) -> str | None:
     """
-    兼容 OpenAI / Gemini / 其他流式返回格式，解析内容片段1
+    从已解析的 chunk 中取出思考过程片段：
+    DeepSeek 的 delta.reasoning_content、部分中转的 delta.reasoning、Gemini 中 thought=true 的 part
+    """
+    choices = chunk.get("choices")
+    if isinstance(choices, list) and choices:
+        delta = choices[0].get("delta") or {}
+        reasoning = delta.get("reasoning_content") or delta.get("reasoning")
+        return reasoning if isinstance(reasoning, str) else None
+    candidates = chunk.get("candidates")
+    if isinstance(candidates, list) and candidates:
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(p.get("text", "") for p in parts if p.get("thought")) or None
+    return None
+
+
+def decode_stream_data(data_str: str) -> tuple[str | None, str | None, dict | None]:
+    """
+    兼容 OpenAI / Gemini / 其他流式返回格式，解析一行 data 为 (内容片段, 思考过程片段, token 用量)
+    思考过程与用量只出现在部分 chunk 中，其余为 None
     """
     try:
         chunk = json.loads(data_str)
-
-        # OpenAI 风格
-        if "choices" in chunk:
-            choices = chunk.get("choices")
-            # 防御性判断：必须是非空列表
-            if not isinstance(choices, list) or len(choices) == 0:
-                logger.debug(f"[空或非法 choices] {chunk}")
-                return None
-
-            choice = choices[0]
-            # 有些 chunk 只包含 finish_reason，不包含 delta
-            if "delta" not in choice:
-                logger.debug(f"[无 delta 字段] {chunk}")
-                return None
-
-            delta = choice.get("delta", {})
-            return delta.get("content")
-
-        # Gemini 风格
-        elif "candidates" in chunk:
-            candidates = chunk.get("candidates", [])
-            if not isinstance(candidates, list) or len(candidates) == 0:
-                logger.debug(f"[空 candidates] {chunk}")
-                return None
-
-            parts = candidates[0].get("content", {}).get("parts", [])
-            return "".join(p.get("text", "") for p in parts if "text" in p)
-
-        # 其他未知结构
-        logger.debug(f"[未知结构] {chunk}")
-        return None
-
+        return _chunk_text(chunk), _chunk_reasoning(chunk), completion_usage(chunk)
     except json.JSONDecodeError:
-        logger.warning(f"无效 JSON: {data_str}")
-        return None
+        logger.warning("无效 JSON: %s", clip(data_str, 200), extra={"category": "stream"})
+        return None, None, None
     except Exception as e:
-        logger.warning(f"[parse_stream_chunk 异常] {e} - 原始数据: {data_str}")
-        return None
+        logger.warning("[decode_stream_data 异常] %s - 原始数据: %s", e, clip(data_str, 200), extra={"category": "stream"})
+        return None, None, None
+
+
+def parse_stream_chunk(data_str: str) -> str | None:
+    """只取内容片段（兼容旧调用）"""
+    return decode_stream_data(data_str)[0]
 
 
 # -----------------------------
-# 流式调用模型（结构化输出 + 异常处理细分）
+# 非流式单次调用（后台任务用，不写历史）
 # -----------------------------
-
-async def execute_model_for_app(
-        model_name: str,
-        user_input: str,
-        system_instructions: str,
-        personas: list[str],
-        web_input: str = "",
-        nsfw: bool = True,
-        stream: bool = False,
-) -> AsyncGenerator[dict, None]:
+async def request_completion(model_name: str, messages: list[dict]) -> str:
     """
-    高稳定性 / 高效率模型调用器
-    - 支持流式 & 非流式
-    - 全局 AsyncClient 复用
-    - DONE / 非 DONE 双兜底
-    - 并发流式限流
-    - 不阻塞 event loop
+    非流式调用模型并返回完整文本，失败时抛出异常
     """
+    registry = current_registry()
+    model_details = registry.model(model_name)
+    if not model_details:
+        raise ValueError(f"模型 '{model_name}' 不存在")
+    client_settings = registry.clients[model_details["client_name"]]
+    async with client_pool.lease(model_details["client_name"]) as client:
+        data = await post_completion(client, client_settings, model_details["label"], messages)
+    return completion_text(data)
 
-    logger.info(f"[执行模型] model={model_name} stream={stream} nsfw={nsfw}")
-    # ---------- 构建 messages ----------
+
+COMPACTION_PROMPT = (
+    "你是剧情记录员。请把下面的剧情记录压缩为一段简洁的中文摘要（{limit} 字以内），"
+    "保留：人物关系与状态变化、关键事件与时间线、未解决的伏笔。不要添加原文没有的内容，只输出摘要正文。"
+)
+
+
+async def summarize_history_text(text: str, tier: int) -> str:
+    """HistoryCompactor 的摘要函数：层级越高，摘要越精简"""
+    limit = {1: 400, 2: 300}.get(tier, 200)
+    return await request_completion(COMPACTION_MODEL, [
+        {"role": "system", "content": COMPACTION_PROMPT.format(limit=limit)},
+        {"role": "user", "content": text},
+    ])
+
+
+history_compactor = HistoryCompactor(
+    chat_history,
+    summarize=summarize_history_text,
+    keep_recent=max(10, MAX_HISTORY_ENTRIES),
+)
+
+
+# -----------------------------
+# 流式调用模型（结构化输出 + 异常处理细分）
+# -----------------------------
+def build_chat_messages(user_input: str, system_instructions: str, personas: list[str],
+                        web_input: str = "", nsfw: bool = True) -> list[dict]:
+    """按当前聊天历史构建 messages（/chat 与 /chat/compare 共用；会查询数据库，在线程中调用）"""
     messages = build_messages(
         system_instructions,
         personas,
@@ -156,81 +332,190 @@ async def execute_model_for_app(
         web_input,
         nsfw=nsfw,
         max_history_entries=MAX_HISTORY_ENTRIES,
+        retriever=history_retriever if USE_HISTORY_RETRIEVAL else None,
+        retrieval_top_k=RETRIEVAL_TOP_K,
+        retrieval_token_budget=RETRIEVAL_TOKEN_BUDGET,
+        long_term_summary=chat_history.format_summaries() if ENABLE_HISTORY_COMPACTION else "",
+        layout=PROMPT_LAYOUT,
     )
-    if DEBUG_STREAM:
-        print_messages_colored(messages)
-    model_details = model_registry(model_name)
-    client_settings = CLIENT_CONFIGS[model_details["client_name"]]
+    if DEBUG_PROMPTS:
+        _debug_log_messages(messages)
+    return messages
+
+
+async def generate_reply(
+        model_name: str,
+        messages: list[dict],
+        stream: bool = False,
+        registry=None,
+        limit_concurrency: bool = True,
+        reasoning_limit: int = 0,
+) -> AsyncGenerator[dict, None]:
+    """
+    调用单个模型，产出 chunk / state_patch / state / summary 事件，成功时以 end 结束，失败时产出 error
+    上游返回 token 用量时产出 usage 事件（位于 end 之前）；reasoning_limit > 0 时转发思考过程（reasoning 事件）
+    不读写聊天历史；TTFT、输出速度与成败记入 model_router（"auto" 路由依据）
+
+    Args:
+        registry: 注册表快照，默认取当前快照
+        limit_concurrency: 流式请求是否占用 _stream_semaphore（/chat/compare 整组只占一个名额）
+        reasoning_limit: 最多转发多少字符的思考过程，0 表示不转发；思考过程不计入 end 的 full，也不写入历史
+    """
+    # 本次请求固定使用同一份注册表快照，热加载不会影响进行中的请求
+    registry = registry or current_registry()
+    model_details = registry.model(model_name)
+    if not model_details:
+        yield {"type": "error", "error": f"模型 '{model_name}' 不存在"}
+        return
+    start = time.perf_counter()
+    first_chunk_at = last_chunk_at = None
+    pieces = 0
+    ok = True
+    usage = None
+    full_text = ""
+    async for event in _request_model(model_details, messages, stream, registry, limit_concurrency, reasoning_limit):
+        if event["type"] == "chunk":
+            last_chunk_at = time.perf_counter()
+            first_chunk_at = first_chunk_at or last_chunk_at
+            pieces += 1
+        elif event["type"] == "usage":
+            usage = event["usage"]
+            logger.info("[usage] model=%s prompt=%d completion=%d cached=%d (%.0f%%) reasoning=%d",
+                        model_name, usage["prompt_tokens"], usage["completion_tokens"], usage["cached_tokens"],
+                        cache_hit_rate(usage) * 100, usage["reasoning_tokens"],
+                        extra={"category": "usage", "model": model_name, "usage": usage, "cost": event["cost"]})
+        elif event["type"] == "end":
+            full_text = event["full"]
+        elif event["type"] == "error":
+            ok = False
+        yield event
+    ok = ok and first_chunk_at is not None  # 空回复同样视为失败
+    # 输出速度：有 usage 时按实际输出 token 数，否则按片段数近似
+    tokens = usage["completion_tokens"] if usage else pieces
+    tps = None
+    if ok and tokens > 1 and last_chunk_at > first_chunk_at:
+        tps = (tokens - 1) / (last_chunk_at - first_chunk_at)
+    model_router.observe(
+        model_name, model_details["client_name"], ok,
+        ttft_ms=(first_chunk_at - start) * 1000 if ok else None, tps=tps,
+    )
+    if ok and (TOKEN_ESTIMATE == "always" or (TOKEN_ESTIMATE == "fallback" and usage is None)):
+        spawn_background(asyncio.to_thread(estimate_tokens, messages, full_text, model_details["label"]))
+
+
+def _clip_reasoning(text: str, forwarded: int, limit: int) -> dict | None:
+    """按剩余额度生成 reasoning 事件；达到上限的那一段带 truncated=true，之后返回 None"""
+    remaining = limit - forwarded
+    if remaining <= 0 or not text:
+        return None
+    if len(text) < remaining:
+        return {"type": "reasoning", "content": text}
+    return {"type": "reasoning", "content": text[:remaining], "truncated": True}
+
+
+async def _request_model(model_details: dict, messages: list[dict], stream: bool, registry,
+                         limit_concurrency: bool, reasoning_limit: int = 0) -> AsyncGenerator[dict, None]:
+    """generate_reply 的上游请求部分"""
+    client_name = model_details["client_name"]
+    client_settings = registry.clients[client_name]
+    if PROMPT_LAYOUT == "cache" and model_details.get("prompt_cache") == "cache_control":
+        # 需要显式标注缓存断点的模型（Anthropic 系）；其余 provider 按前缀自动缓存
+        # legacy 布局下人物 / NSFW 消息逐轮变化，断点无益，保持原样发送（content 仍为字符串）
+        messages = apply_cache_breakpoints(messages)
     payload = {
         "model": model_details["label"],
         "stream": stream,
         "messages": messages,
     }
+    if stream and client_settings.get("stream_usage", True):
+        # 让 OpenAI 兼容接口在流末尾返回 usage；不支持该字段的 provider 在 client 配置中设 "stream_usage": false
+        payload["stream_options"] = {"include_usage": True}
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {client_settings['api_key']}",
     }
     chunks: list[str] = []
-
-    # total_tokens
-    # print(payload)
-    total_tokens(messages, model_details["label"])
+    usage = None
+    reasoning_chars = 0  # 已转发的思考过程字符数
+    summary_extractor = StreamingSummaryExtractor()  # 边接收边识别摘要块
+    state_parser = StreamingJsonBlockParser()  # 边接收边解析 ```json 状态块
 
     try:
-        client = await get_async_client()
-        # ---------- 流式模式 ----------
-        if stream:
-            async with _stream_semaphore:
-                async with client.stream(
-                        "POST",
-                        client_settings["base_url"],
-                        headers=headers,
-                        json=payload,
-                ) as response:
-                    if response.status_code != 200:
-                        yield {
-                            "type": "error",
-                            "error": f"模型接口返回状态码 {response.status_code}",
-                        }
-                        return
-                    async for line in response.aiter_lines():
-                        if not line or not line.startswith("data:"):
-                            continue
-                        data_str = line[5:].strip()
-                        if data_str == "[DONE]":
-                            break
-                        delta = parse_stream_chunk(data_str)
-                        if not delta:
-                            continue
-                        chunks.append(delta)
-                        yield {"type": "chunk", "content": delta}
-            # 流自然结束（即使无 DONE）
-            full_text = "".join(chunks)
-        # ---------- 非流式模式 ----------
-        else:
-            response = await client.post(
-                client_settings["base_url"],
-                headers=headers,
-                json=payload,
-            )
-            if response.status_code != 200:
-                yield {
-                    "type": "error",
-                    "error": f"模型接口返回状态码 {response.status_code}",
-                }
-                return
-            data = response.json()
-            if "choices" in data:
-                for choice in data["choices"]:
-                    text = (
-                            choice.get("message", {}).get("content")
-                            or choice.get("text")
-                            or ""
-                    )
-                    if text:
-                        chunks.append(text)
-                        yield {"type": "chunk", "content": text}
-            full_text = "".join(chunks)
+        async with client_pool.lease(client_name) as client:
+            # ---------- 流式模式 ----------
+            if stream:
+                async with _stream_semaphore if limit_concurrency else nullcontext():
+                    async with client.stream(
+                            "POST",
+                            client_settings["base_url"],
+                            headers=headers,
+                            json=payload,
+                    ) as response:
+                        if response.status_code != 200:
+                            yield {
+                                "type": "error",
+                                "error": f"模型接口返回状态码 {response.status_code}",
+                            }
+                            return
+                        async for line in response.aiter_lines():
+                            if not line or not line.startswith("data:"):
+                                continue
+                            data_str = line[5:].strip()
+                            if data_str == "[DONE]":
+                                break
+                            delta, reasoning, chunk_usage = decode_stream_data(data_str)
+                            if chunk_usage:
+                                usage = chunk_usage  # Gemini 每个 chunk 都带累计值，取最后一个
+                            if reasoning and reasoning_limit:
+                                event = _clip_reasoning(reasoning, reasoning_chars, reasoning_limit)
+                                if event:
+                                    reasoning_chars += len(event["content"])
+                                    yield event
+                            if not delta:
+                                continue
+                            chunks.append(delta)
+                            summary_extractor.feed(delta)
+                            yield {"type": "chunk", "content": delta}
+                            for patch in state_parser.feed(delta):
+                                yield {"type": "state_patch", "patch": patch}
+                # 流自然结束（即使无 DONE）
+                full_text = "".join(chunks)
+            # ---------- 非流式模式 ----------
+            else:
+                response = await client.post(
+                    client_settings["base_url"],
+                    headers=headers,
+                    json=payload,
+                )
+                if response.status_code != 200:
+                    yield {
+                        "type": "error",
+                        "error": f"模型接口返回状态码 {response.status_code}",
+                    }
+                    return
+                data = response.json()
+                usage = completion_usage(data)
+                if "choices" in data:
+                    if reasoning_limit and data["choices"]:
+                        message = data["choices"][0].get("message") or {}
+                        event = _clip_reasoning(
+                            message.get("reasoning_content") or message.get("reasoning") or "", 0, reasoning_limit,
+                        )
+                        if event:
+                            yield event
+                    for choice in data["choices"]:
+                        text = (
+                                choice.get("message", {}).get("content")
+                                or choice.get("text")
+                                or ""
+                        )
+                        if text:
+                            chunks.append(text)
+                            summary_extractor.feed(text)
+                            yield {"type": "chunk", "content": text}
+                            for patch in state_parser.feed(text):
+                                yield {"type": "state_patch", "patch": patch}
+                full_text = "".join(chunks)
     except httpx.TimeoutException:
         yield {"type": "error", "error": "模型请求超时"}
         return
@@ -241,37 +526,319 @@ async def execute_model_for_app(
         logger.exception("模型调用异常")
         yield {"type": "error", "error": str(e)}
         return
-    # ---------- 保存历史 ----------
-    if full_text.strip():
-        if SAVE_STORY_SUMMARY_ONLY:
-            summary = chat_history._extract_summary_from_assistant(full_text)
-            if summary:
-                chat_history.add_entry(user_input, summary)
-        else:
-            chat_history.add_entry(user_input, full_text)
-        chat_history.save_history()
+    # ---------- 状态 / 摘要事件（流结束即可用，无需再扫描全文） ----------
+    if state_parser.result:
+        yield {"type": "state", "state": state_parser.result}
+    summary = summary_extractor.result()
+    if summary:
+        yield {"type": "summary", "summary": summary}
+    if usage:
+        cost = estimate_cost(model_details, usage["prompt_tokens"], usage["completion_tokens"])
+        yield {"type": "usage", "usage": usage, "cost": round(cost, 6) if cost is not None else None}
     yield {"type": "end", "full": full_text}
 
 
+def save_reply(user_input: str, full_text: str, summary: str | None, model_name: str, session: str,
+               usage: dict | None = None) -> None:
+    """
+    把一轮对话（及上游返回的 token 用量）写入聊天历史
+    add_entry 本身即落盘（sqlite 立即提交，json 写文件），这里不再重复保存；在线程中调用
+    """
+    if not full_text.strip():
+        return
+    if SAVE_STORY_SUMMARY_ONLY:
+        if summary:
+            chat_history.add_entry(user_input, summary, model=model_name, session=session, usage=usage)
+        else:
+            # 模型漏写状态块时保存全文，交给后台摘要压缩，避免整轮丢失
+            logger.warning("[保存历史] 未找到动态角色状态机摘要，改为保存完整回复")
+            chat_history.add_entry(user_input, full_text, model=model_name, session=session, usage=usage)
+    else:
+        chat_history.add_entry(user_input, full_text, model=model_name, session=session, usage=usage)
+
+
+# 历史写入在 end 帧之后于线程中完成；_persist_lock 保证按顺序写入，lifecycle 停机时等待全部完成
+_persist_lock = asyncio.Lock()
+_pending_persists: set = set()
+
+
+async def persist_reply(*args) -> None:
+    async with _persist_lock:
+        try:
+            await asyncio.to_thread(save_reply, *args)
+        except Exception:
+            logger.exception("[保存历史] 写入失败")
+            return
+    if ENABLE_HISTORY_COMPACTION:
+        history_compactor.notify()
+
+
+def schedule_persist(*args) -> asyncio.Task:
+    """后台写入历史，不阻塞响应（参数同 save_reply）"""
+    task = asyncio.get_running_loop().create_task(persist_reply(*args))
+    _pending_persists.add(task)
+    task.add_done_callback(_pending_persists.discard)
+    return lifecycle.track_task(task)
+
+
+async def wait_persisted() -> None:
+    """等待已排队的历史写入完成：构建下一轮 messages、修改历史前调用，保证能看到上一轮"""
+    if _pending_persists:
+        await asyncio.gather(*list(_pending_persists), return_exceptions=True)
+
+
+async def execute_model_for_app(
+        model_name: str,
+        user_input: str,
+        system_instructions: str,
+        personas: list[str],
+        web_input: str = "",
+        nsfw: bool = True,
+        stream: bool = False,
+        session: str = "default",
+        reasoning_limit: int = 0,
+        draft_model: str | None = None,
+) -> AsyncGenerator[dict, None]:
+    """
+    高稳定性 / 高效率模型调用器
+    - 支持流式 & 非流式
+    - 按 provider 复用 AsyncClient（注册表热加载时自动重建）
+    - DONE / 非 DONE 双兜底
+    - 并发流式限流
+    - 不阻塞 event loop
+    - 首个 token 之前只做构建 messages；end 帧先发出，历史在后台写入（token 估算见 TOKEN_ESTIMATE）
+    - reasoning_limit > 0 时转发思考过程（reasoning 事件，最多 reasoning_limit 个字符），不写入历史
+    - 指定 draft_model 时（仅流式）同时用快速模型生成草稿（draft 事件），主模型输出正文后切换，只有主模型的回复写入历史
+    """
+
+    logger.info("[执行模型] model=%s stream=%s nsfw=%s", model_name, stream, nsfw,
+                extra={"category": "request", "model": model_name, "session": session})
+    # ---------- 构建 messages ----------
+    await wait_persisted()
+    # 相关历史召回会查询数据库，在线程中构建，不阻塞事件循环
+    messages = await asyncio.to_thread(build_chat_messages, user_input, system_instructions, personas, web_input, nsfw)
+    registry = current_registry()
+
+    replies = _run_candidates(model_name, messages, registry, user_input, stream, session, reasoning_limit)
+    if draft_model and stream:
+        replies = _race_draft(replies, draft_model, messages, registry)
+    async for event in replies:
+        yield event
+
+
+async def _run_candidates(model_name: str, messages: list[dict], registry, user_input: str, stream: bool,
+                          session: str, reasoning_limit: int) -> AsyncGenerator[dict, None]:
+    """execute_model_for_app 的调用部分：选择模型（"auto"）、调用、排队写入历史"""
+    # ---------- "auto"：按实时统计选择模型，尚未输出内容就失败时改用下一个候选 ----------
+    auto = model_name == AUTO_MODEL
+    if auto:
+        # 粗估输入 token 数（中文约 1 字 1 token，其余约 4 字符 1 token），只用于费用上限
+        prompt_tokens = sum(estimate_text_tokens(m.get("content", "")) for m in messages)
+        candidates = model_router.rank(session, registry, prompt_tokens=prompt_tokens)[:AUTO_MAX_ATTEMPTS]
+        if not candidates:
+            yield {"type": "error", "error": f"system_rule '{session}' 没有可用的候选模型"}
+            return
+    else:
+        candidates = [model_name]
+
+    for attempt, candidate in enumerate(candidates, 1):
+        if auto:
+            logger.info("[auto] 第 %d 次选择 %s", attempt, candidate, extra={"category": "request", "session": session})
+            yield {"type": "route", "model": candidate, "attempt": attempt}
+        summary = usage = None
+        produced = False
+        retry = False
+        async for event in generate_reply(candidate, messages, stream, registry=registry,
+                                          reasoning_limit=reasoning_limit):
+            if event["type"] == "chunk":
+                produced = True
+            elif event["type"] == "summary":
+                summary = event["summary"]
+            elif event["type"] == "usage":
+                usage = {**event["usage"], "cost": event["cost"]}
+            elif event["type"] == "error" and auto and not produced and attempt < len(candidates):
+                logger.warning("[auto] %s 失败（%s），改用下一个候选", candidate, event["error"])
+                retry = True
+                continue
+            elif event["type"] == "end":
+                # ---------- 保存历史：先排队再发送 end，客户端此时断开也不会丢失本轮 ----------
+                schedule_persist(user_input, event["full"], summary, candidate, session, usage)
+            yield event
+        if not retry:
+            return
+
+
+# -----------------------------
+# 快速草稿：思考模型首字很慢时，先用快速模型流式输出草稿，主模型开始输出正文后切换
+# -----------------------------
+async def _race_draft(replies: AsyncGenerator[dict, None], draft_model: str, messages: list[dict],
+                      registry) -> AsyncGenerator[dict, None]:
+    """
+    同时消费主模型事件流（replies）与草稿模型，合并输出：
+    - 首个事件为 draft_start；草稿正文以 draft 事件发送，草稿自然结束或失败时发送 draft_end
+    - 主模型的首个 chunk（或在此之前的 end / error）到达时取消草稿，先发送 swap，客户端丢弃草稿、改为显示主模型回复
+    - 主模型在 swap 之前的其他事件（route、reasoning）原样转发；草稿的状态块、摘要、用量等事件不转发，也不写入历史
+    草稿请求不占用流式并发名额（与主模型视为同一次请求）
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    swapped = False  # 已发送 swap（每次请求恰好一次）
+    draft_done = False  # 草稿已结束（自然结束、失败或已取消），之后不再转发草稿事件
+
+    async def pump(source: str, events: AsyncGenerator[dict, None]) -> None:
+        try:
+            async for event in events:
+                await queue.put((source, event))
+        finally:
+            await queue.put((source, None))  # 该来源结束
+
+    yield {"type": "draft_start", "model": draft_model}
+    primary = asyncio.create_task(pump("primary", replies))
+    draft = asyncio.create_task(pump("draft", generate_reply(
+        draft_model, messages, True, registry=registry, limit_concurrency=False,
+    )))
+    try:
+        while True:
+            source, event = await queue.get()
+            if source == "primary":
+                if event is None:
+                    break
+                if not swapped and event["type"] in ("chunk", "end", "error"):
+                    # 草稿无论仍在生成还是已结束，都在主模型首个正文 / 结束 / 错误之前发送一次 swap
+                    swapped = draft_done = True
+                    draft.cancel()
+                    yield {"type": "swap"}
+                yield event
+            elif draft_done:
+                continue
+            elif event is None:
+                draft_done = True
+            elif event["type"] == "chunk":
+                yield {"type": "draft", "content": event["content"]}
+            elif event["type"] in ("end", "error"):
+                yield {"type": "draft_end", **({"error": event["error"]} if event["type"] == "error" else {})}
+    finally:
+        # 客户端断开时取消仍在进行的上游请求
+        for task in (primary, draft):
+            task.cancel()
+
+
+# -----------------------------
+# 多模型对比（/chat/compare）：一次构建 messages，并发请求多个模型，结果选定后再写入历史
+# -----------------------------
+MAX_COMPARE_MODELS = 4
+MAX_PENDING_COMPARES = 20  # 最多保留多少组待选择的对比结果
+COMPARE_TTL_SECONDS = 1800
+_pending_compares: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _prune_pending_compares() -> None:
+    now = time.monotonic()
+    for compare_id in [k for k, v in _pending_compares.items() if now - v["created"] > COMPARE_TTL_SECONDS]:
+        _pending_compares.pop(compare_id, None)
+    while len(_pending_compares) > MAX_PENDING_COMPARES:
+        _pending_compares.popitem(last=False)
+
+
+async def compare_models(
+        model_names: list[str],
+        user_input: str,
+        system_instructions: str,
+        personas: list[str],
+        web_input: str = "",
+        nsfw: bool = True,
+        session: str = "default",
+) -> AsyncGenerator[dict, None]:
+    """
+    并发流式调用多个模型，事件按到达顺序合并输出，每个事件带 model 字段
+    首个事件为 compare_start（含 compare_id），最后为 compare_end；结果不写入历史，
+    由 commit_compare(compare_id, model) 选定其中一个后保存
+    """
+    compare_id = uuid.uuid4().hex[:12]
+    logger.info("[对比] compare_id=%s models=%s", compare_id, model_names,
+                extra={"category": "request", "session": session})
+    await wait_persisted()
+    # 相关历史召回会查询数据库，在线程中构建，不阻塞事件循环
+    messages = await asyncio.to_thread(build_chat_messages, user_input, system_instructions, personas, web_input, nsfw)
+    registry = current_registry()
+    results: dict[str, dict] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(name: str) -> None:
+        summary = usage = None
+        details = registry.model(name) or {}
+        try:
+            async for event in generate_reply(name, messages, details.get("supports_streaming", True),
+                                              registry=registry, limit_concurrency=False):
+                if event["type"] == "summary":
+                    summary = event["summary"]
+                elif event["type"] == "usage":
+                    usage = {**event["usage"], "cost": event["cost"]}
+                elif event["type"] == "end":
+                    results[name] = {"full": event["full"], "summary": summary, "usage": usage}
+                await queue.put({**event, "model": name})
+        finally:
+            await queue.put(None)  # 该模型结束
+
+    yield {"type": "compare_start", "compare_id": compare_id, "models": model_names}
+    # 整组对比只占用一个流式并发名额，组内各模型同时请求
+    async with _stream_semaphore:
+        tasks = [asyncio.create_task(pump(name)) for name in model_names]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event = await queue.get()
+                if event is None:
+                    remaining -= 1
+                    continue
+                yield event
+        finally:
+            # 客户端断开时取消仍在进行的上游请求
+            for task in tasks:
+                task.cancel()
+
+    committable = [name for name in model_names if results.get(name, {}).get("full", "").strip()]
+    if committable:
+        _pending_compares[compare_id] = {
+            "created": time.monotonic(),
+            "user_input": user_input,
+            "session": session,
+            "results": {name: results[name] for name in committable},
+        }
+        _prune_pending_compares()
+    yield {"type": "compare_end", "compare_id": compare_id, "committable": committable}
+
+
+async def commit_compare(compare_id: str, model_name: str) -> dict:
+    """
+    把某组对比中选定模型的回复写入历史，返回写入的内容
+    compare_id 不存在 / 已过期时抛出 KeyError，模型不在该组结果中时抛出 ValueError
+    """
+    _prune_pending_compares()
+    pending = _pending_compares.get(compare_id)
+    if pending is None:
+        raise KeyError(compare_id)
+    result = pending["results"].get(model_name)
+    if result is None:
+        raise ValueError(model_name)
+    del _pending_compares[compare_id]
+    await persist_reply(pending["user_input"], result["full"], result["summary"], model_name, pending["session"], result["usage"])
+    return {"model": model_name, "user_input": pending["user_input"], "full": result["full"], "summary": result["summary"]}
+
+
 async def test_stream():
     model_name = "claude-sonnet-4-5"
     user_input = "请用告诉我现在使用的模型版本、功能特色、发布日期等详细信息"
     system_instructions = "你是一个系统工程师"
     personas = [""]
 
-    buffer = ""
-    async for chunk in execute_model_for_app(
-            model_name, user_input, system_instructions, personas, stream=True, nsfw=False
-    ):
-        if chunk["type"] == "chunk":
-            buffer += chunk["content"]
-            for char in buffer:
-                if char == "\n":
-                    print()
-                else:
-                    print(char, end="", flush=True)
-            buffer = ""
-    # print()
+    from utils.print_messages_colored import StreamRenderer
+    with StreamRenderer() as renderer:
+        async for chunk in execute_model_for_app(
+                model_name, user_input, system_instructions, personas, stream=True, nsfw=False
+        ):
+            if chunk["type"] == "chunk":
+                renderer.write(chunk["content"])
+    print()
 
 
 if __name__ == "__main__":
@@ -279,4 +846,4 @@ if __name__ == "__main__":
 
     # messages = [{"content": "123123"}]
     # model_label = "gemini-3-pro-preview-thinking-*"
-    # total_tokens(messages, model_label)
+    # estimate_tokens(messages, "", model_label)
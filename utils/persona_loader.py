@@ -5,9 +5,10 @@ import logging
 from pathlib import Path
 from typing import Dict, Any, List
 
-# 日志配置
+from utils.console_io import ainput
+
+# 日志配置（由入口程序统一配置 handler，导入时不调用 basicConfig）
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 # 人物配置文件路径
 PERSONA_FILE = Path(__file__).parent.parent / "prompt" / "persona.json"
@@ -17,16 +18,36 @@ DEFAULT_USER_NAME = "常亮"
 # 默认出场 NPC（除玩家）
 DEFAULT_NPC_NAMES = []
 
+# 解析结果缓存：key 为文件 (mtime, 大小)，文件修改后自动重新解析
+_cache: dict = {"key": None, "value": None}
+
 
 def load_personas() -> Dict[str, Dict[str, Any]]:
     """
-    从 persona.json 读取所有人物设定
+    从 persona.json 读取所有人物设定（结果只读，调用方不要修改）
     """
-    if not PERSONA_FILE.exists():
+    try:
+        stat = PERSONA_FILE.stat()
+    except OSError:
         raise FileNotFoundError(f"未找到人物配置文件: {PERSONA_FILE}")
+    key = (stat.st_mtime_ns, stat.st_size)
+    if _cache["key"] == key:
+        return _cache["value"]
 
     with open(PERSONA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+        value = json.load(f)
+    _cache["key"] = key
+    _cache["value"] = value
+    return value
+
+
+def persona_file_version() -> tuple:
+    """persona.json 的 (mtime, 大小)，用于 ETag；文件不存在时返回 (0, 0)"""
+    try:
+        stat = PERSONA_FILE.stat()
+    except OSError:
+        return 0, 0
+    return stat.st_mtime_ns, stat.st_size
 
 
 def load_persona(name: str) -> Dict[str, Any]:
@@ -77,7 +98,7 @@ async def select_personas() -> List[str]:
     for i, name in enumerate(available):
         print(f"{i+1}. {name}")
 
-    selected = input("请输入出场人物编号（逗号分隔，可多个，留空仅使用玩家主角 {user}）: ").strip()
+    selected = (await ainput("请输入出场人物编号（逗号分隔，可多个，留空仅使用玩家主角 {user}）: ")).strip()
     if not selected:
         print(f"已选择：仅包含玩家主角 {DEFAULT_USER_NAME}")
         logger.info("[操作] 出场人物为空，仅玩家主角 {user}")
@@ -97,6 +118,7 @@ async def select_personas() -> List[str]:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
     # 调试输出
     personas = load_personas()
     print("全部人物:")
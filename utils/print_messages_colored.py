@@ -1,4 +1,7 @@
+import asyncio
 import re
+import sys
+import time
 
 from colorama import Fore, Style
 
@@ -20,30 +23,126 @@ def print_messages_colored(messages):
     print("--- End of messages ---\n")
 
 # -----------------------------
-# 彩色打印模型输出（带缓冲池）
+# 彩色打印模型输出
 # -----------------------------
+# 高亮的引号对：开引号 -> 闭引号
+QUOTE_PAIRS = {"『": "』", "「": "」", "“": "”", '"': '"'}
+_QUOTE_TOKEN = re.compile('[' + re.escape("".join(set(QUOTE_PAIRS) | set(QUOTE_PAIRS.values()))) + '\n]')
+
+
 def print_model_output_colored(text, color: str = Fore.WHITE):
     """
-    打印模型输出，『』或「」之间的文字用蓝色高亮
+    打印模型输出，『』或「」之间的文字用高亮色（单个片段，一次写入）
+    流式输出请使用 StreamRenderer，引号跨片段时也能正确高亮
     :param text: 模型对话返回的文本片段 BLUE/LIGHTBLACK_EX
     :param color: 默认输出颜色 YELLOW/WHITE
     """
-    # 正则匹配 『...』 和 「...」
-    pattern = r"(『.*?』|「.*?」|“.*?”|\".*?\")"
+    renderer = StreamRenderer(color=color, fps=0)
+    renderer.write(text)
+    renderer.flush()
+
+
+class StreamRenderer:
+    """
+    终端流式输出渲染器
+
+    - 高亮状态跨片段保持：引号被拆在两个片段之间也能正确着色（遇到换行时结束高亮）
+    - 输出先写入缓冲区，按帧率合并为一次 write + flush，减少终端系统调用
+    - 在事件循环中使用时，缓冲区内容最迟一帧后自动刷新，不会因模型停顿而滞留
+    - stdout 不是终端时输出纯文本（不带颜色控制符）
+
+    用法：
+        with StreamRenderer(color=Fore.LIGHTBLACK_EX) as renderer:
+            async for chunk in ...:
+                renderer.write(chunk)
+    """
+
+    def __init__(self, color: str = Fore.WHITE, highlight: str = Fore.WHITE, fps: float = 30,
+                 stream=None, use_color: bool | None = None):
+        self.stream = stream or sys.stdout
+        self.color = color
+        self.highlight = highlight
+        self.frame = 1.0 / fps if fps > 0 else 0.0
+        if use_color is None:
+            use_color = bool(getattr(self.stream, "isatty", lambda: False)())
+        self.use_color = use_color
+        self._closing: str | None = None  # 当前所在引号的闭引号，None 表示不在引号内
+        self._buffer: list[str] = []
+        self._buffer_color = color  # 缓冲区开头的颜色（每次写出都自带颜色，兼容 colorama autoreset）
+        self._last_flush = 0.0
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _current_color(self) -> str:
+        return self.highlight if self._closing else self.color
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        if not self._buffer:
+            self._buffer_color = self._current_color()
+        pos = 0
+        for match in _QUOTE_TOKEN.finditer(text):
+            ch = match.group(0)
+            start = match.start()
+            if self._closing is None:
+                if ch in QUOTE_PAIRS:
+                    # 开引号及其后的内容使用高亮色
+                    self._emit(text[pos:start])
+                    self._closing = QUOTE_PAIRS[ch]
+                    self._switch_color()
+                    pos = start
+            elif ch == self._closing or ch == "\n":
+                # 闭引号仍属于高亮部分；换行时强制结束，避免未闭合的引号染色后续全部文本
+                end = start + 1 if ch != "\n" else start
+                self._emit(text[pos:end])
+                self._closing = None
+                self._switch_color()
+                pos = end
+        self._emit(text[pos:])
+        self._maybe_flush()
 
-    last_end = 0
-    for match in re.finditer(pattern, text):
-        start, end = match.span()
+    def _emit(self, piece: str) -> None:
+        if piece:
+            self._buffer.append(piece)
 
-        # 打印前面的普通文本
-        if start > last_end:
-            print(f"{color}{text[last_end:start]}{Style.RESET_ALL}", end="", flush=True)
+    def _switch_color(self) -> None:
+        if self.use_color:
+            self._buffer.append(self._current_color())
 
-        # 打印高亮部分
-        print(f"{Fore.WHITE}{match.group(0)}{Style.RESET_ALL}", end="", flush=True)
+    def _maybe_flush(self) -> None:
+        now = time.monotonic()
+        if now - self._last_flush >= self.frame:
+            self.flush()
+            return
+        if self._timer is None:
+            # 在事件循环中：本帧结束时自动刷新
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._timer = loop.call_later(self.frame - (now - self._last_flush), self.flush)
 
-        last_end = end
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        self._buffer.clear()
+        if self.use_color:
+            text = f"{self._buffer_color}{text}{Style.RESET_ALL}"
+        self.stream.write(text)
+        self.stream.flush()
 
-    # 打印剩余的普通文本
-    if last_end < len(text):
-        print(f"{color}{text[last_end:]}{Style.RESET_ALL}", end="", flush=True)
+    def close(self) -> None:
+        """写出剩余内容并结束高亮状态"""
+        self.flush()
+        self._closing = None
@@ -1,9 +1,109 @@
 import json
 import re
-from pathlib import Path
+from utils.chat_history import HISTORY_DIR
 
-PROJECT_ROOT = Path(__file__).resolve().parents[1]
-CHAT_HISTORY_PATH = PROJECT_ROOT / "log" / "chat_history.json"
+CHAT_HISTORY_PATH = HISTORY_DIR / "chat_history.json"
+
+JSON_BLOCK_PATTERN = re.compile(r"```json\s*(.*?)\s*```", re.S | re.I)  # 关键：忽略大小写
+# 修复 key 中多余的冒号，如 "障碍:"
+BAD_KEY_PATTERN = re.compile(r'"([^"]+?):"\s*:')
+
+EMPTY_RESULT = {"message": "暂无历史记录"}
+
+# 解析结果缓存：key 为 (ChatHistory id, version) 或 (文件 mtime, 大小)
+_cache: dict = {"key": None, "value": None}
+
+
+def fix_keys(s: str) -> str:
+    return BAD_KEY_PATTERN.sub(r'"\1":', s)
+
+
+def _string_end(s: str, start: int) -> int:
+    """返回从 start（左引号）开始的字符串的右引号位置，未闭合返回 -1"""
+    i = start + 1
+    n = len(s)
+    while i < n:
+        ch = s[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == '"':
+            return i
+        i += 1
+    return -1
+
+
+def _match_braces(s: str) -> dict:
+    """
+    一次扫描求出每个 { 对应的 } 位置（忽略字符串内的括号）
+    未闭合的 { 不出现在结果中
+    """
+    pairs = {}
+    stack = []
+    i = 0
+    n = len(s)
+    while i < n:
+        ch = s[i]
+        if ch == '"':
+            end = _string_end(s, i)
+            if end < 0:
+                break
+            i = end + 1
+            continue
+        if ch == "{":
+            stack.append(i)
+        elif ch == "}" and stack:
+            pairs[stack.pop()] = i
+        i += 1
+    return pairs
+
+
+def tolerant_parse(content: str) -> dict:
+    """
+    伪 JSON 容错解析（线性时间）
+
+    扫描形如 "key": {...} 的片段，对象值单独解析（先修复 key 中多余的冒号），
+    解析失败时保留原始文本；已解析对象内部的 key 不再重复提取。
+    """
+    pairs = _match_braces(content)
+    result = {}
+    i = 0
+    n = len(content)
+
+    while i < n:
+        if content[i] != '"':
+            i += 1
+            continue
+        end = _string_end(content, i)
+        if end < 0:
+            break
+        key = content[i + 1:end]
+
+        # 跳过空白，判断是否为 key
+        k = end + 1
+        while k < n and content[k].isspace():
+            k += 1
+        if not key or k >= n or content[k] != ":":
+            i = end + 1
+            continue
+        k += 1
+        while k < n and content[k].isspace():
+            k += 1
+
+        close = pairs.get(k)
+        if close is not None:
+            obj_text = fix_keys(content[k:close + 1])
+            key = key.rstrip(":")
+            try:
+                result[key] = json.loads(obj_text)
+            except Exception:
+                result[key] = obj_text
+            i = close + 1
+            continue
+
+        i = k
+
+    return result
 
 
 def extract_assistant_json(text: str) -> dict:
@@ -15,11 +115,7 @@ def extract_assistant_json(text: str) -> dict:
     if not isinstance(text, str):
         return {}
 
-    block = re.search(
-        r"```json\s*(.*?)\s*```",
-        text,
-        re.S | re.I  # 关键：忽略大小写
-    )
+    block = JSON_BLOCK_PATTERN.search(text)
     if not block:
         return {}
 
@@ -33,75 +129,54 @@ def extract_assistant_json(text: str) -> dict:
         pass
 
     # ---------- fallback：伪 JSON 修复 ----------
-    def fix_keys(s: str) -> str:
-        # 修复 key 中多余的冒号，如 "障碍:"
-        return re.sub(r'"([^"]+?):"\s*:', r'"\1":', s)
-
-    def extract_object(s: str, start: int):
-        if start >= len(s) or s[start] != "{":
-            return None, None
-        depth = 0
-        for i in range(start, len(s)):
-            if s[i] == "{":
-                depth += 1
-            elif s[i] == "}":
-                depth -= 1
-                if depth == 0:
-                    return s[start:i + 1], i + 1
-        return None, None
-
-    result = {}
-    i = 0
-    n = len(content)
-
-    while i < n:
-        m = re.search(r'"([^"]+)"\s*:\s*', content[i:])
-        if not m:
-            break
-
-        key = m.group(1).rstrip(":")
-        val_start = i + m.end()
+    return tolerant_parse(content)
 
-        while val_start < n and content[val_start].isspace():
-            val_start += 1
-
-        if val_start < n and content[val_start] == "{":
-            obj_text, next_pos = extract_object(content, val_start)
-            if obj_text:
-                obj_text = fix_keys(obj_text)
-                try:
-                    result[key] = json.loads(obj_text)
-                except Exception:
-                    result[key] = obj_text
-                i = next_pos
-                continue
-
-        i = val_start + 1
-
-    return result
-
-
-def main():
-    if not CHAT_HISTORY_PATH.exists():
-        return {"message": "暂无历史记录"}
-
-    try:
-        with CHAT_HISTORY_PATH.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-    except Exception:
-        return {"message": "暂无历史记录"}
 
+def _parse_entries(data) -> dict:
     if not isinstance(data, list) or not data:
-        return {"message": "暂无历史记录"}
+        return EMPTY_RESULT
 
     assistant_text = data[-1].get("assistant", "")
     parsed = extract_assistant_json(assistant_text)
 
     if not parsed:
-        return {"message": "暂无历史记录"}
+        return EMPTY_RESULT
 
     return parsed
 
 
+def main(history=None):
+    """
+    解析最后一条历史记录中的 JSON 状态块
+    结果按历史版本缓存，历史未变化时直接返回缓存
+
+    Args:
+        history: 可选，ChatHistory 对象；不传时直接读取 chat_history.json
+    """
+    if history is not None:
+        key = ("history", id(history), history.version)
+        if _cache["key"] == key:
+            return _cache["value"]
+        value = _parse_entries(history.entries)
+    else:
+        try:
+            stat = CHAT_HISTORY_PATH.stat()
+        except OSError:
+            return EMPTY_RESULT
+        key = ("file", stat.st_mtime_ns, stat.st_size)
+        if _cache["key"] == key:
+            return _cache["value"]
+        try:
+            with CHAT_HISTORY_PATH.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return EMPTY_RESULT
+        value = _parse_entries(data)
+
+    _cache["key"] = key
+    _cache["value"] = value
+    return value
+
+
 if __name__ == "__main__":
-    print(main())
\ No newline at end of file
+    print(main())
@@ -0,0 +1,183 @@
+# utils/static_assets.py
+"""
+内存中的预压缩静态资源服务
+
+- 服务启动时（lifespan 中调用 load_all，在线程中执行）一次性读取目录下全部文件，预先生成 gzip（以及安装了 brotli 时的 br）版本；
+  导入模块、创建对象时不读文件，未经 lifespan 启动时在首个请求时加载
+- 按 Accept-Encoding 选择最小的编码返回；每种编码使用各自的强 ETag（"<hash>-gzip" / "<hash>-br"），支持 If-None-Match -> 304
+- Vite 构建的带 hash 文件名资源使用 Cache-Control: immutable
+- 请求路径上不做任何文件系统调用；前端重新构建后需重启服务
+"""
+import asyncio
+import gzip
+import logging
+import mimetypes
+import os
+from typing import Dict, Iterable, Optional
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from utils.http_cache import etag_matches, strong_etag
+
+try:
+    import brotli  # 可选依赖：pip install brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"  # 可缓存，但每次使用前用 ETag 校验
+
+MIN_COMPRESS_SIZE = 1024  # 小于该大小的文件不压缩
+# 已压缩的格式，再压缩没有收益
+_SKIP_COMPRESS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".ico", ".woff", ".woff2", ".gz", ".br", ".zip", ".mp3", ".mp4"}
+
+
+class _Asset:
+    __slots__ = ("content_type", "etags", "bodies")
+
+    def __init__(self, content_type: str, etag: str, bodies: Dict[str, bytes]):
+        self.content_type = content_type
+        self.bodies = bodies  # 编码 -> 内容，"identity" 为原文
+        # 强 ETag 必须随内容编码变化（RFC 9110 8.8.3），否则缓存 / Range 请求可能混用不同编码的内容
+        self.etags = {
+            encoding: etag if encoding == "identity" else f'{etag[:-1]}-{encoding}"'
+            for encoding in bodies
+        }
+
+
+def _build_asset(path: str, data: bytes) -> _Asset:
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type += "; charset=utf-8"
+    bodies = {"identity": data}
+    ext = os.path.splitext(path)[1].lower()
+    if len(data) >= MIN_COMPRESS_SIZE and ext not in _SKIP_COMPRESS:
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(gz) < len(data):
+            bodies["gzip"] = gz
+        if brotli is not None:
+            br = brotli.compress(data, quality=11)
+            if len(br) < len(data):
+                bodies["br"] = br
+    return _Asset(content_type, strong_etag(data), bodies)
+
+
+def _accepted_encodings(scope: Scope) -> str:
+    for key, value in scope.get("headers", []):
+        if key == b"accept-encoding":
+            return value.decode("latin-1").lower()
+    return ""
+
+
+def _header(scope: Scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def asset_response(asset: _Asset, scope: Scope, cache_control: str) -> Response:
+    """根据请求头生成 200 / 304 响应（先选定编码，再按该编码的 ETag 判断 304）"""
+    accepted = _accepted_encodings(scope)
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in asset.bodies and candidate in accepted:
+            encoding = candidate
+            break
+    headers = {"ETag": asset.etags[encoding], "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag_matches(_header(scope, b"if-none-match"), asset.etags[encoding]):
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    body = asset.bodies[encoding]
+    if scope.get("method") == "HEAD":
+        headers["Content-Length"] = str(len(body))
+        return Response(status_code=200, headers=headers, media_type=asset.content_type)
+    return Response(body, headers=headers, media_type=asset.content_type)
+
+
+class PrecompressedStaticFiles:
+    """
+    可直接 app.mount 的 ASGI 应用，替代 StaticFiles
+
+    Args:
+        directory: 静态资源目录
+        immutable: 文件名带内容 hash（Vite assets）时为 True，使用长期 immutable 缓存
+    """
+
+    def __init__(self, directory: str, immutable: bool = False):
+        self.directory = directory
+        self.cache_control = IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE
+        self.assets: Optional[Dict[str, _Asset]] = None  # load() 之前为 None
+
+    def load(self) -> None:
+        """读取并预压缩全部文件（brotli 最高压缩级别较慢，在线程中调用）"""
+        assets: Dict[str, _Asset] = {}
+        raw_size = gz_size = br_size = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full = os.path.join(root, name)
+                rel = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    asset = _build_asset(full, f.read())
+                assets[rel] = asset
+                raw_size += len(asset.bodies["identity"])
+                gz_size += len(asset.bodies.get("gzip", asset.bodies["identity"]))
+                br_size += len(asset.bodies.get("br", asset.bodies["identity"]))
+        self.assets = assets
+        logger.info(
+            f"[静态资源] {self.directory}: {len(assets)} 个文件，原始 {raw_size} B，"
+            f"gzip {gz_size} B" + (f"，br {br_size} B" if brotli is not None else "")
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return
+        if scope.get("method") not in ("GET", "HEAD"):
+            response = Response(status_code=405, headers={"Allow": "GET, HEAD"})
+        else:
+            path = scope.get("path", "")
+            root_path = scope.get("root_path", "")
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            if self.assets is None:
+                await asyncio.to_thread(self.load)
+            asset = self.assets.get(path.lstrip("/"))
+            if asset is None:
+                response = Response("Not Found", status_code=404, media_type="text/plain")
+            else:
+                response = asset_response(asset, scope, self.cache_control)
+        await response(scope, receive, send)
+
+
+class InMemoryPage:
+    """常驻内存的单个 HTML 页面（SPA 的 index.html），文件不存在时 asset 为 None"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.asset: Optional[_Asset] = None
+        self.loaded = False
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "rb") as f:
+                self.asset = _build_asset(self.path, f.read())
+        except OSError:
+            logger.warning(f"[静态资源] 未找到 {self.path}")
+        self.loaded = True
+
+    async def response(self, scope: Scope) -> Optional[Response]:
+        if not self.loaded:
+            await asyncio.to_thread(self.load)
+        if self.asset is None:
+            return None
+        return asset_response(self.asset, scope, REVALIDATE_CACHE)
+
+
+async def load_all(items: Iterable) -> None:
+    """在线程中并行加载多个 PrecompressedStaticFiles / InMemoryPage（服务启动时调用）"""
+    await asyncio.gather(*(asyncio.to_thread(item.load) for item in items))
@@ -8,8 +8,10 @@ from config.config import CLIENT_CONFIGS
 from config.models import model_registry, list_model_ids
 from prompt.get_system_prompt import get_system_prompt
 from utils.chat_history import ChatHistory
+from utils.client_pool import ClientPool
+from utils.console_io import ainput, console
 from utils.message_builder import build_messages
-from utils.print_messages_colored import print_messages_colored, print_model_output_colored
+from utils.print_messages_colored import StreamRenderer, print_messages_colored, print_model_output_colored
 
 # =========================
 # 环境设定
@@ -19,6 +21,8 @@ chat_history = ChatHistory(max_entries=50)
 MAX_HISTORY_ENTRIES = 5
 # SAVE_STORY_SUMMARY_ONLY = True              # 只保存摘要，避免文件太大
 SAVE_STORY_SUMMARY_ONLY = False               # 保存所有内容
+# 每个 provider 复用一个长连接池，不再每轮对话新建 client
+client_pool = ClientPool(lambda: httpx.AsyncClient(timeout=httpx.Timeout(connect=10.0, read=None, write=10.0, pool=5.0)))
 # =========================
 # 日志设定
 # =========================
@@ -84,25 +88,26 @@ async def execute_model(
     response_text = ""
     got_done = False
     try:
-        async with httpx.AsyncClient(timeout=None) as client:
+        async with client_pool.lease(client_key) as client:
             if stream:
                 async with client.stream("POST", client_settings["base_url"], headers=headers, json=payload) as resp:
                     if resp.status_code != 200:
                         logger.error(f"[系统] 模型接口返回非200状态码: {resp.status_code}")
                         return
                     print(Fore.CYAN + "\n--- 模型响应开始 ---\n" + Fore.RESET)
-                    async for line in resp.aiter_lines():
-                        if not (line and line.startswith("data: ")):
-                            continue
-                        data_str = line[len("data: "):].strip()
-                        if data_str == "[DONE]":
-                            got_done = True
-                            break
-                        chunk_text = parse_stream_chunk(data_str)
-                        if chunk_text:
-                            response_text += chunk_text
-                            print_model_output_colored(chunk_text, color=Fore.LIGHTBLACK_EX)
-                            yield chunk_text
+                    with StreamRenderer(color=Fore.LIGHTBLACK_EX) as renderer:
+                        async for line in resp.aiter_lines():
+                            if not (line and line.startswith("data: ")):
+                                continue
+                            data_str = line[len("data: "):].strip()
+                            if data_str == "[DONE]":
+                                got_done = True
+                                break
+                            chunk_text = parse_stream_chunk(data_str)
+                            if chunk_text:
+                                response_text += chunk_text
+                                renderer.write(chunk_text)
+                                yield chunk_text
                     print(Fore.CYAN + "\n--- 模型响应结束 ---\n" + Fore.RESET)
             else:
                 resp = await client.post(client_settings["base_url"], headers=headers, json=payload)
@@ -126,7 +131,7 @@ async def execute_model(
         logger.warning("[系统] 流式传输未检测到 [DONE]，输出可能不完整")
     # 保存历史
     if response_text.strip():
-        if SAVE_SUMMARY_ONLY:
+        if SAVE_STORY_SUMMARY_ONLY:
             summary = chat_history._extract_summary_from_assistant(response_text)
             if summary:
                 chat_history.add_entry(user_input, summary)
@@ -149,7 +154,7 @@ async def select_model() -> str:
         print(f"{i + 1}. {m}")
     while True:
         try:
-            idx = int(input("请选择模型编号: ")) - 1
+            idx = int(await ainput("请选择模型编号: ")) - 1
             if 0 <= idx < len(available_models):
                 model_name = available_models[idx]
                 logger.info(f"[系统] 已选择模型: {model_name}")
@@ -157,6 +162,10 @@ async def select_model() -> str:
             print("无效选择，请重新输入。")
         except ValueError:
             print("请输入数字。")
+async def consume(model_name: str, user_input: str, system_instructions: str) -> None:
+    """消费 execute_model 的输出（渲染在 execute_model 内完成）"""
+    async for _ in execute_model(model_name, user_input, system_instructions):
+        pass
 # =========================
 # 主循环
 # =========================
@@ -167,21 +176,16 @@ async def main_loop():
     model_name = await select_model()
     system_instructions = get_system_prompt("prompt")
     while True:
-        print("\n请输入内容 (命令: {clear}, {history}, {switch}, {personas}):")
-        lines = []
-        empty_count = 0
-        while True:
-            line = input()
-            if line.strip() == "END":
-                break
-            if line.strip() == "":
-                empty_count += 1
-                if empty_count >= 2:
-                    break
-            else:
-                empty_count = 0
-            lines.append(line)
-        user_input = "\n".join(lines).strip()
+        print("\n请输入内容 (命令: {clear}, {history}, {switch}, {exit}):")
+        try:
+            # 输入 END 或连续两个空行结束
+            user_input = await console.read_block(end_marker="END", blank_lines=2)
+        except EOFError:
+            break
+        if not user_input:
+            continue
+        if user_input == "{exit}":
+            break
         if user_input == "{clear}":
             chat_history.clear_history()
             logger.info("[系统] 历史记录已清空")
@@ -192,9 +196,11 @@ async def main_loop():
         if user_input.startswith("{switch}"):
             model_name = await select_model()
             continue
-        logger.info("[系统] 正在调用模型...")
-        async for text_chunk in execute_model(model_name, user_input, system_instructions):
-            pass
+        logger.info("[系统] 正在调用模型...（按回车中断）")
+        finished, _ = await console.run_cancellable(consume(model_name, user_input, system_instructions))
+        if not finished:
+            logger.info("[系统] [已中断] 本轮回复未保存")
+    await client_pool.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main_loop())
@@ -12,9 +12,11 @@ from config.config import CLIENT_CONFIGS
 from config.models import model_registry, list_model_ids
 from prompt.get_system_prompt import get_system_prompt
 from utils.chat_history import ChatHistory
+from utils.client_pool import ClientPool
+from utils.console_io import ainput, console
 from utils.message_builder import build_messages
 from utils.persona_loader import select_personas, get_default_personas
-from utils.print_messages_colored import print_messages_colored, print_model_output_colored
+from utils.print_messages_colored import StreamRenderer, print_messages_colored
 
 # 初始化颜色输出
 init(autoreset=True)
@@ -33,6 +35,9 @@ MAX_HISTORY_ENTRIES = 1                     # 最近几条对话传给模型
 # SAVE_STORY_SUMMARY_ONLY = True              # 只保存摘要，避免文件太大
 SAVE_STORY_SUMMARY_ONLY = False               # 保存所有内容
 
+# 每个 provider 复用一个长连接池，不再每轮对话新建 client
+client_pool = ClientPool(lambda: httpx.AsyncClient(timeout=httpx.Timeout(connect=10.0, read=None, write=10.0, pool=5.0)))
+
 
 # -----------------------------
 # 统一的流解析函数
@@ -107,7 +112,7 @@ async def execute_model(
     got_done_flag = False
 
     try:
-        async with httpx.AsyncClient(timeout=None) as client:
+        async with client_pool.lease(client_key) as client:
             if stream:
                 # 流式处理
                 async with client.stream("POST", client_settings["base_url"], headers=headers, json=payload) as response:
@@ -181,7 +186,7 @@ async def select_model() -> str:
 
     while True:
         try:
-            idx = int(input("请选择模型编号: ")) - 1
+            idx = int(await ainput("请选择模型编号: ")) - 1
             if 0 <= idx < len(available_models):
                 model_name = available_models[idx]
                 logger.info(f"[已选择模型] {model_name}")
@@ -194,14 +199,32 @@ async def select_model() -> str:
 # -----------------------------
 # 主循环
 # -----------------------------
+async def stream_reply(model_name, user_input, system_instructions, current_personas) -> bool:
+    """
+    流式输出一轮回复，期间按回车可中断
+
+    Returns:
+        bool: 是否完整输出（被中断时返回 False，本轮不写入历史）
+    """
+    async def _render():
+        with StreamRenderer(color=Fore.LIGHTBLACK_EX) as renderer:
+            async for text_chunk in execute_model(model_name, user_input, system_instructions, current_personas):
+                renderer.write(text_chunk)
+
+    print(Fore.CYAN + "（生成中，按回车中断）")
+    finished, _ = await console.run_cancellable(_render())
+    if not finished:
+        print(Fore.YELLOW + "\n[已中断] 本轮回复未保存")
+    return finished
+
+
 async def auto_fill_initial_story(model_name, system_instructions, current_personas):
     """仅在历史记录为空时填充初始剧情"""
     if chat_history.is_empty():
         AUTO_START_MESSAGE = '''你好'''
         logger.info(f"[自动输入] {AUTO_START_MESSAGE}")
-        async for text_chunk in execute_model(model_name, AUTO_START_MESSAGE, system_instructions, current_personas):
-            print_model_output_colored(text_chunk, color=Fore.LIGHTBLACK_EX)
-        logger.info("\n[生成完成] 初始剧情输出完成")
+        if await stream_reply(model_name, AUTO_START_MESSAGE, system_instructions, current_personas):
+            logger.info("\n[生成完成] 初始剧情输出完成")
     else:
         logger.info("[跳过] 历史记录非空，未填充初始剧情")
 
@@ -219,22 +242,16 @@ async def main_loop():
     await auto_fill_initial_story(model_name, system_instructions, current_personas)
 
     while True:
-        print("\n请输入内容 (命令: {clear}, {history}, {switch}, {personas}):")
-        lines = []
-        empty_line_count = 0
-        while True:
-            line = input()
-            # 检测 END 结束符
-            if line.strip() == "END":
-                break
-            # 检测连续两次空行结束
-            if line.strip() == "":
-                empty_line_count += 1
-                break
-            else:
-                empty_line_count = 0  # 重置计数器
-            lines.append(line)
-        user_input = "\n".join(lines).strip()
+        print("\n请输入内容 (命令: {clear}, {history}, {switch}, {personas}, {exit}):")
+        try:
+            # 输入 END 或一个空行结束
+            user_input = await console.read_block(end_marker="END", blank_lines=1)
+        except EOFError:
+            break
+        if not user_input:
+            continue
+        if user_input == "{exit}":
+            break
         # 特殊指令
         if user_input == "{clear}":
             chat_history.clear_history()
@@ -251,9 +268,11 @@ async def main_loop():
             logger.info(f"[人物更新] 当前出场人物: {current_personas}")
             continue
 
-        async for text_chunk in execute_model(model_name, user_input, system_instructions, current_personas):
-            print_model_output_colored(text_chunk, color=Fore.LIGHTBLACK_EX)
-        logger.info("\n[生成完成] 模型回复已输出完成 ")
+        if await stream_reply(model_name, user_input, system_instructions, current_personas):
+            logger.info("\n[生成完成] 模型回复已输出完成 ")
+
+    await client_pool.aclose()
+
 
 if __name__ == "__main__":
     asyncio.run(main_loop())
@@ -3,6 +3,7 @@
 import asyncio
 import json
 import logging
+import os
 from typing import AsyncGenerator
 
 import httpx
@@ -11,6 +12,7 @@ from colorama import init
 from config.config import CLIENT_CONFIGS
 from config.models import model_registry
 from utils.chat_history import ChatHistory
+from utils.log_config import clip
 from utils.message_builder import build_messages
 from utils.print_messages_colored import print_messages_colored
 
@@ -22,8 +24,8 @@ init(autoreset=True)
 # -----------------------------
 # 日志配置
 # -----------------------------
+# handler 由入口程序 setup_logging() 统一配置
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 # -----------------------------
 # 全局变量
@@ -33,6 +35,7 @@ MAX_HISTORY_ENTRIES = 1                     # 最近几条对话传给模型
 SAVE_STORY_SUMMARY_ONLY = True              # 只保存摘要，避免文件太大
 # SAVE_STORY_SUMMARY_ONLY = False               # 保存所有内容
 DEBUG_STREAM = False                        # 是否打印原始流，调试用
+DEBUG_PROMPTS = os.getenv("DEBUG_PROMPTS", "false").lower() == "true"  # 是否打印完整 messages，调试用
 
 
 # -----------------------------
@@ -50,13 +53,13 @@ def parse_stream_chunk(data_str: str) -> str | None:
             choices = chunk.get("choices")
             # 防御性判断：必须是非空列表
             if not isinstance(choices, list) or len(choices) == 0:
-                logger.debug(f"[空或非法 choices] {chunk}")
+                logger.debug("[空或非法 choices] %s", chunk)
                 return None
 
             choice = choices[0]
             # 有些 chunk 只包含 finish_reason，不包含 delta
             if "delta" not in choice:
-                logger.debug(f"[无 delta 字段] {chunk}")
+                logger.debug("[无 delta 字段] %s", chunk)
                 return None
 
             delta = choice.get("delta", {})
@@ -66,21 +69,21 @@ def parse_stream_chunk(data_str: str) -> str | None:
         elif "candidates" in chunk:
             candidates = chunk.get("candidates", [])
             if not isinstance(candidates, list) or len(candidates) == 0:
-                logger.debug(f"[空 candidates] {chunk}")
+                logger.debug("[空 candidates] %s", chunk)
                 return None
 
             parts = candidates[0].get("content", {}).get("parts", [])
             return "".join(p.get("text", "") for p in parts if "text" in p)
 
         # 其他未知结构
-        logger.debug(f"[未知结构] {chunk}")
+        logger.debug("[未知结构] %s", chunk)
         return None
 
     except json.JSONDecodeError:
-        logger.warning(f"无效 JSON: {data_str}")
+        logger.warning("无效 JSON: %s", clip(data_str, 200), extra={"category": "stream"})
         return None
     except Exception as e:
-        logger.warning(f"[parse_stream_chunk 异常] {e} - 原始数据: {data_str}")
+        logger.warning("[parse_stream_chunk 异常] %s - 原始数据: %s", e, clip(data_str, 200), extra={"category": "stream"})
         return None
 
 
@@ -117,7 +120,9 @@ async def execute_model_for_app(
         nsfw=nsfw,
         max_history_entries=MAX_HISTORY_ENTRIES,
     )
-    print_messages_colored(messages)
+    if DEBUG_PROMPTS:
+        # 整段 prompt 打印较慢，放到线程中执行，不阻塞事件循环
+        await asyncio.to_thread(print_messages_colored, messages)
 
     # 模型配置
     model_details = model_registry(model_name)
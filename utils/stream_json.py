@@ -0,0 +1,206 @@
+# utils/stream_json.py
+
+import json
+from typing import Any, Dict, List, Optional
+
+from utils.read_chat_history import fix_keys, tolerant_parse
+
+JSON_FENCE = "```json"
+CLOSING_FENCE = "```"
+
+
+class _Frame:
+    """解析栈中的一个容器（对象或数组）"""
+    __slots__ = ("kind", "key", "expect", "val_start")
+
+    def __init__(self, kind: str):
+        self.kind = kind  # "{" 或 "["
+        self.key: Optional[str] = None  # 对象中当前正在解析的 key
+        self.expect = "key" if kind == "{" else "value"
+        self.val_start: Optional[int] = None  # 当前值在 body 中的起始位置
+
+
+class StreamingJsonBlockParser:
+    """
+    流式解析回复中的 ```json 代码块
+
+    - 在片段流中识别 ```json 围栏（围栏被拆分在多个片段之间也能识别）
+    - 围栏后的对象边接收边解析，顶层 key 或二级 key 的值一旦完整即产出补丁
+      顶层：{"key": value}；二级：{"key": {"sub": value}}（调用方按深合并处理）
+    - 容忍 read_chat_history 能修复的常见错误：key 多余冒号、**加粗**、缺失逗号
+    只解析第一个 ```json 块，与 extract_assistant_json 一致
+    """
+
+    def __init__(self):
+        self._window = ""  # 寻找围栏时保留的尾部
+        self.state = "scan"  # scan -> open -> body -> done
+        self.body = ""  # 从 { 开始的对象文本
+        self._pos = 0  # body 中已处理到的位置
+        self._stack: List[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        self._str_start = 0
+        self._str_role = ""  # key / value / skip
+        self._fence_tail = 0  # body 末尾连续反引号计数
+        self.result: Optional[Dict[str, Any]] = None  # 完整对象（解析完成后）
+
+    # -----------------------------
+    # 对外接口
+    # -----------------------------
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """
+        喂入一个流式片段
+
+        Returns:
+            list: 本次新产生的补丁列表
+        """
+        if not chunk or self.state == "done":
+            return []
+        patches: List[Dict[str, Any]] = []
+
+        if self.state == "scan":
+            window = self._window + chunk
+            idx = window.lower().find(JSON_FENCE)
+            if idx < 0:
+                keep = len(JSON_FENCE) - 1
+                self._window = window[-keep:] if len(window) > keep else window
+                return patches
+            self._window = ""
+            self.state = "open"
+            chunk = window[idx + len(JSON_FENCE):]
+
+        if self.state == "open":
+            stripped = chunk.lstrip()
+            if not stripped:
+                return patches
+            if stripped[0] != "{":
+                # 不是对象（例如数组），放弃本块，继续寻找下一个围栏
+                self.state = "scan"
+                return self.feed(stripped)
+            self.state = "body"
+            chunk = stripped
+
+        self.body += chunk
+        self._consume(patches)
+        return patches
+
+    # -----------------------------
+    # 内部实现
+    # -----------------------------
+    @staticmethod
+    def _loads(text: str) -> Any:
+        text = text.replace("**", "")
+        try:
+            return json.loads(text)
+        except ValueError:
+            return json.loads(fix_keys(text))
+
+    def _complete_value(self, end: int, patches: List[Dict[str, Any]]) -> None:
+        """当前栈顶容器中的一个值在 end（不含）处结束"""
+        frame = self._stack[-1]
+        start = frame.val_start
+        frame.val_start = None
+        frame.expect = "comma"
+        if frame.kind != "{" or start is None or frame.key is None:
+            return
+        depth = len(self._stack)
+        if depth > 2:
+            return
+        try:
+            value = self._loads(self.body[start:end])
+        except Exception:
+            return
+        if depth == 1:
+            patches.append({frame.key: value})
+        elif self._stack[0].key is not None:
+            patches.append({self._stack[0].key: {frame.key: value}})
+
+    def _finish(self, end: int) -> None:
+        self._pos = end
+        self.state = "done"
+        text = self.body[:end]
+        try:
+            self.result = json.loads(text.replace("**", ""))
+        except ValueError:
+            self.result = tolerant_parse(text.replace("**", "")) or None
+
+    def _consume(self, patches: List[Dict[str, Any]]) -> None:
+        body = self.body
+        i = self._pos
+        n = len(body)
+        while i < n:
+            ch = body[i]
+
+            # ---------- 字符串内部 ----------
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    frame = self._stack[-1]
+                    if self._str_role == "key":
+                        frame.key = body[self._str_start + 1:i].replace("**", "").rstrip(":")
+                        frame.expect = "colon"
+                    elif self._str_role == "value":
+                        self._complete_value(i + 1, patches)
+                i += 1
+                continue
+
+            # ---------- 代码块提前结束（对象未闭合） ----------
+            if ch == "`":
+                self._fence_tail += 1
+                if self._fence_tail >= len(CLOSING_FENCE):
+                    self._finish(i + 1 - len(CLOSING_FENCE))
+                    return
+                i += 1
+                continue
+            self._fence_tail = 0
+
+            frame = self._stack[-1] if self._stack else None
+
+            # 标量值在分隔符处结束
+            if frame is not None and frame.expect == "scalar" and (ch in ",}]" or ch.isspace()):
+                self._complete_value(i, patches)
+
+            if ch.isspace():
+                i += 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._str_start = i
+                if frame is None:
+                    self._str_role = "skip"
+                elif frame.kind == "{" and frame.expect in ("key", "comma"):
+                    # 容忍缺失逗号：上一个值结束后直接出现 key
+                    self._str_role = "key"
+                else:
+                    self._str_role = "value" if frame.kind == "{" else "skip"
+                    frame.val_start = i
+                    frame.expect = "string"
+            elif ch in "{[":
+                if frame is not None:
+                    frame.val_start = i
+                    frame.expect = "container"
+                self._stack.append(_Frame(ch))
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if not self._stack:
+                    self._finish(i + 1)
+                    return
+                self._complete_value(i + 1, patches)
+            elif ch == ":":
+                if frame is not None and frame.kind == "{":
+                    frame.expect = "value"
+            elif ch == ",":
+                if frame is not None:
+                    frame.expect = "key" if frame.kind == "{" else "value"
+            elif frame is not None and frame.expect == "value":
+                # 数字 / true / false / null 等标量
+                frame.val_start = i
+                frame.expect = "scalar"
+            i += 1
+        self._pos = i
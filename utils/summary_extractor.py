@@ -0,0 +1,70 @@
+# utils/summary_extractor.py
+
+import re
+from typing import List, Optional
+
+# 摘要块标记：动态角色状态机-YYYY-MM-DD HH:MM，从标记开始到回复结尾都属于摘要
+SUMMARY_MARKER = "动态角色状态机-"
+SUMMARY_PATTERN = re.compile(r"动态角色状态机-\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}[\s\S]*$")
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}")
+# 日期尚未接收完整时，判断已收到的部分是否仍可能匹配
+_DATE_PREFIX = re.compile(
+    r"\d{0,4}|\d{4}-\d{0,2}|\d{4}-\d{2}-\d{0,2}|\d{4}-\d{2}-\d{2}\s*"
+    r"|\d{4}-\d{2}-\d{2}\s+\d{1,2}|\d{4}-\d{2}-\d{2}\s+\d{2}:\d?"
+)
+
+
+class StreamingSummaryExtractor:
+    """
+    流式提取“动态角色状态机”摘要块
+
+    - 逐个喂入流式片段，标记被拆分在多个片段之间也能识别
+    - 未命中标记前只保留可能构成标记的尾部字符
+    - 命中后只累积摘要部分，流结束时即可拿到结果，无需再扫描全文
+    结果与 ChatHistory._extract_summary_from_assistant 对完整文本的结果一致
+    """
+
+    def __init__(self):
+        self._window = ""  # 未确认部分（可能包含标记的开头）
+        self._parts: List[str] = []  # 已确认的摘要片段
+        self.found = False
+
+    def feed(self, chunk: str) -> bool:
+        """
+        喂入一个流式片段
+
+        Returns:
+            bool: 本次片段是否首次确认了摘要标记
+        """
+        if not chunk:
+            return False
+        if self.found:
+            self._parts.append(chunk)
+            return False
+
+        window = self._window + chunk
+        pos = 0
+        while True:
+            idx = window.find(SUMMARY_MARKER, pos)
+            if idx < 0:
+                # 保留可能是标记前缀的尾部
+                keep = len(SUMMARY_MARKER) - 1
+                self._window = window[-keep:] if len(window) > keep else window
+                return False
+            rest = window[idx + len(SUMMARY_MARKER):]
+            if _DATE.match(rest):
+                self.found = True
+                self._window = ""
+                self._parts.append(window[idx:])
+                return True
+            if _DATE_PREFIX.fullmatch(rest):
+                # 日期还没收完，等待下一个片段
+                self._window = window[idx:]
+                return False
+            pos = idx + 1
+
+    def result(self) -> Optional[str]:
+        """返回摘要文本（含标记），未找到时返回 None"""
+        if not self.found:
+            return None
+        return "".join(self._parts).strip() or None